@@ -0,0 +1,412 @@
+"""
+This module is the asyncio counterpart of db_adaptor, over Motor.
+Functions mirror db_adaptor ones and raise the same errors.
+User cache, users counter and delete hooks are shared with db_adaptor.
+"""
+import asyncio
+import os
+from typing import (
+    List, Dict, Union, Any,
+    AsyncIterator, Optional,
+    MutableMapping, Tuple, Set, Iterable
+)
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import ASCENDING
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.raw_bson import RawBSONDocument
+
+import errors
+from cache import user_cache
+from config import DATABASE, BULK, CACHE
+from db_monitoring import event_listeners
+from db_adaptor import (
+    DB_HOST, DB_PORT, DB_NAME, COLLECTION_NAME,
+    DUPLICATE_KEY_ERROR, INSERTED, DUPLICATE, FAILED, UNKNOWN,
+    RAW_CODEC_OPTIONS, users_counter, delete_hooks, count_users_inserted,
+    duplicate_key_field
+)
+from scripts import log_exception
+from timing import timed, DB
+
+_clients: Dict[Tuple[int, str, int], AsyncIOMotorClient] = {}
+
+
+def get_client(host: str = DB_HOST, port: int = DB_PORT) \
+        -> AsyncIOMotorClient:
+    """
+    Returns the process-wide Motor client for host:port.
+    Runs in the event loop thread only, so no locking is needed.
+    """
+    key = (os.getpid(), host, port)
+    client = _clients.get(key)
+    if client is None:
+        client = AsyncIOMotorClient(
+            host, port,
+            maxPoolSize=DATABASE['MAX_POOL_SIZE'],
+            minPoolSize=DATABASE['MIN_POOL_SIZE'],
+            waitQueueTimeoutMS=DATABASE['WAIT_QUEUE_TIMEOUT_MS'],
+            # Explains run in a thread, on the pymongo client under Motor
+            event_listeners=event_listeners(
+                lambda: get_client(host, port).delegate)
+        )
+        _clients[key] = client
+    return client
+
+
+def get_collection() -> AsyncIOMotorCollection:
+    return get_client()[DB_NAME][COLLECTION_NAME]
+
+
+async def iter_users(batch_size: int) \
+        -> AsyncIterator[Dict[Union[str, int], Any]]:
+    """
+    Returns iterator over all user objects from users collection ordered
+    by uuid. The first batch is fetched here, so a failing DB raises
+    before a response starts.
+    Raises errors.InternalServerError is any other errors.
+    """
+    first: List[Dict[Union[str, int], Any]] = []
+    try:
+        cursor = get_collection().find(projection={'_id': False},
+                                       sort=[('uuid', ASCENDING)],
+                                       batch_size=batch_size).__aiter__()
+        first.append(await cursor.__anext__())
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+    return iter_cursor(first, cursor)
+
+
+async def iter_cursor(first: List[Any], cursor: AsyncIterator[Any]) \
+        -> AsyncIterator[Any]:
+    """
+    Yields first items (documents or raw batches), then the rest of cursor.
+    Raises errors.InternalServerError is any errors.
+    """
+    for item in first:
+        yield item
+    try:
+        async for item in cursor:
+            yield item
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+async def iter_raw_user_batches(batch_size: int) -> AsyncIterator[bytes]:
+    """
+    Returns iterator over all users ordered by uuid, as raw BSON batches
+    of concatenated documents. _id is left for the transcoder to drop.
+    The first batch is fetched here, as by iter_users.
+    Raises errors.InternalServerError is any other errors.
+    """
+    first: List[bytes] = []
+    try:
+        cursor = get_collection().find_raw_batches(
+            sort=[('uuid', ASCENDING)], batch_size=batch_size
+        ).__aiter__()
+        first.append(await cursor.__anext__())
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+    return iter_cursor(first, cursor)
+
+
+@timed(DB)
+async def get_raw_users_page(limit: int,
+                             after: Optional[str] = None) -> bytes:
+    """
+    Returns up to limit users ordered by uuid, starting right after
+    the user with given uuid, as concatenated raw BSON documents.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        search_filter = {'uuid': {'$gt': after}} if after else {}
+        cursor = get_collection().find_raw_batches(
+            search_filter, sort=[('uuid', ASCENDING)], limit=limit
+        )
+        return b''.join([batch async for batch in cursor])
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def get_users_page(limit: int, after: Optional[str] = None) \
+        -> List[Dict[Union[str, int], Any]]:
+    """
+    Returns up to limit user objects ordered by uuid,
+    starting right after the user with given uuid.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        search_filter = {'uuid': {'$gt': after}} if after else {}
+        cursor = get_collection().find(search_filter,
+                                       projection={'_id': False},
+                                       sort=[('uuid', ASCENDING)],
+                                       limit=limit)
+        return await cursor.to_list(length=limit)
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def make_drop() -> Optional[Iterable[str]]:
+    """
+    Drops users collection.
+    Raises errors.InternalServerError is any errors.
+    """
+    try:
+        await get_collection().drop()
+        user_cache.clear()
+        users_counter.reset(0)
+        return await get_client()[DB_NAME].list_collection_names()
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def delete_by_uuid(user_uuid: str) -> Dict[Union[str, int], Any]:
+    """
+    Deletes user from collection given by user_uuid. Returns deleted user.
+    Raises errors.UserNotFound if user is not found by user_uuid.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        user = await get_collection().find_one_and_delete(
+            {'uuid': user_uuid}, projection={'_id': False}
+        )
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+    if user is None:
+        raise errors.UserNotFound()
+
+    user_cache.invalidate(user_uuid)
+    users_counter.add(-1)
+    for hook in delete_hooks:
+        try:
+            hook(user)
+        except Exception as e:
+            log_exception(e)
+    return user
+
+
+@timed(DB)
+async def read_by_uuid(user_uuid: str) \
+        -> Optional[Dict[Union[str, int], Any]]:
+    """
+    Get user obj from collection by given user_uuid.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        # Taken before the read, a racing invalidation drops the put
+        token = user_cache.token()
+        if CACHE['ENABLED']:
+            user = user_cache.get(('uuid', user_uuid))
+            if user is not None:
+                return user
+        user = await get_collection().find_one({'uuid': user_uuid},
+                                               projection={'_id': False})
+        if CACHE['ENABLED'] and user is not None:
+            user_cache.put(('uuid', user_uuid), user, token)
+        return user
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def count_tot_users() -> Optional[int]:
+    """
+    Returns current size of Users collection.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        count = users_counter.peek()
+        if count is None:
+            count = await get_collection().estimated_document_count()
+            users_counter.reset(count)
+        return count
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def insert_user(required_fields_digest: MutableMapping[Any, Any]) \
+        -> Optional[str]:
+    """
+    Inserts one user to users collection. Returns id.
+    Returns None if a user with the same email is already there.
+    """
+    try:
+        result = await get_collection().insert_one(required_fields_digest)
+        users_counter.add(1)
+        return result.inserted_id
+    except DuplicateKeyError as e:
+        if duplicate_key_field(e.details) == 'email':
+            return None
+        log_exception(e)
+        raise errors.InternalServerError()
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def insert_batch(users_to_insert: List[MutableMapping[Any, Any]]) \
+        -> List[str]:
+    """
+    Inserts one batch with an unordered bulk write.
+    Returns INSERTED, DUPLICATE, FAILED or UNKNOWN status per user.
+    """
+    statuses = [INSERTED] * len(users_to_insert)
+    try:
+        await get_collection().insert_many(users_to_insert, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            statuses[error['index']] = DUPLICATE \
+                if error['code'] == DUPLICATE_KEY_ERROR \
+                and duplicate_key_field(error) == 'email' else FAILED
+        if e.details.get('writeConcernErrors'):
+            log_exception(e)
+    except Exception as e:
+        log_exception(e)
+        statuses = await recheck_batch(users_to_insert)
+    return statuses
+
+
+async def recheck_batch(users_to_insert: List[MutableMapping[Any, Any]]) \
+        -> List[str]:
+    """
+    Returns statuses of a batch, which insert failed midway: users found
+    by uuid are INSERTED, the others FAILED, or all UNKNOWN.
+    """
+    try:
+        cursor = get_collection().find(
+            {'uuid': {'$in': [user['uuid'] for user in users_to_insert]}},
+            projection={'uuid': True, '_id': False}
+        )
+        inserted = {user['uuid'] async for user in cursor}
+    except Exception as e:
+        log_exception(e)
+        return [UNKNOWN] * len(users_to_insert)
+    return [INSERTED if user['uuid'] in inserted else FAILED
+            for user in users_to_insert]
+
+
+@timed(DB)
+async def insert_users(users_to_insert:
+                       List[MutableMapping[Any, Any]]) -> List[str]:
+    """
+    Inserts new users in INSERT_BATCH_SIZE batches,
+    INSERT_CONCURRENCY batches at a time.
+    Returns INSERTED, DUPLICATE, FAILED or UNKNOWN status per user.
+    """
+    batch_size = BULK['INSERT_BATCH_SIZE']
+    semaphore = asyncio.Semaphore(BULK['INSERT_CONCURRENCY'])
+
+    async def insert_limited(batch):
+        async with semaphore:
+            return await insert_batch(batch)
+
+    batch_statuses = await asyncio.gather(*[
+        insert_limited(users_to_insert[i:i + batch_size])
+        for i in range(0, len(users_to_insert), batch_size)
+    ])
+    statuses = [status for statuses in batch_statuses for status in statuses]
+    count_users_inserted(statuses)
+    return statuses
+
+
+@timed(DB)
+async def find_raw_user(search_filter: Dict[Union[str, int], Any]) \
+        -> Optional[RawBSONDocument]:
+    """
+    Find one user as raw BSON, to be sent as is. User cache holds
+    decoded users, so it is not used here.
+    """
+    try:
+        collection = get_collection().with_options(
+            codec_options=RAW_CODEC_OPTIONS
+        )
+        return await collection.find_one(search_filter,
+                                         projection={'_id': False})
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def find_one_by_email(search_filter: Dict[Union[str, int], Any]) \
+        -> Optional[Dict[Union[str, int], Any]]:
+    """Find one user by email. Returns user object."""
+    try:
+        cacheable = CACHE['ENABLED'] and list(search_filter) == ['email']
+        token = user_cache.token()
+        if cacheable:
+            user = user_cache.get(('email', search_filter['email']))
+            if user is not None:
+                return user
+        res = await get_collection().find_one(search_filter,
+                                              projection={'_id': False})
+        if cacheable and res is not None:
+            user_cache.put(('email', search_filter['email']), res,
+                           token)
+        return res
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def find_existing_emails(emails: Iterable[str]) -> Set[str]:
+    """
+    Returns those of emails which are already in users collection,
+    with one $in query per LOOKUP_CHUNK_SIZE emails.
+    """
+    try:
+        emails = list(emails)
+        chunk_size = BULK['LOOKUP_CHUNK_SIZE']
+        existing: Set[str] = set()
+        for i in range(0, len(emails), chunk_size):
+            cursor = get_collection().find(
+                {'email': {'$in': emails[i:i + chunk_size]}},
+                projection={'email': True, '_id': False}
+            )
+            async for user in cursor:
+                existing.add(user['email'])
+        return existing
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
+async def update_user(user_uuid: str,
+                      user_to_db: MutableMapping[Any, Any]) \
+        -> Optional[Dict[Union[str, int], Any]]:
+    """
+    Updates single user object by given user_uuid.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        updated = await get_collection().find_one_and_update(
+            {'uuid': user_uuid},
+            {'$set': user_to_db},
+            projection={'_id': False},
+            return_document=ReturnDocument.AFTER
+        )
+        user_cache.invalidate(user_uuid)
+        return updated
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
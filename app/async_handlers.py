@@ -0,0 +1,532 @@
+"""
+This module serves the same routes as handlers, on asyncio and aiohttp.
+Requests are validated by validators and processed by async_processors,
+so a request in flight holds no thread while it waits for MongoDB.
+"""
+import os
+import time
+from typing import Any, Tuple, List, Optional
+
+from aiohttp import web
+from bottle import template
+
+import errors
+from async_processors import (
+    process_list_users, process_update_user, process_stream_users,
+    process_post_user, process_post_users, process_list_users_json,
+    process_stream_users_json, process_read_user_json
+)
+from async_db_adaptor import (
+    count_tot_users, find_one_by_email, find_raw_user,
+    read_by_uuid, delete_by_uuid, make_drop
+)
+from compression import accepted_encodings, is_compressible
+from config import (
+    SUPPORTED_METHODS, SUPPORTED_CONTENT_TYPE, NDJSON_CONTENT_TYPE,
+    PAGINATION, SERVER_SETTINGS, COMPRESSION, REQUEST_ID_HEADER, METRICS
+)
+from logger_setup import logger, request_id
+from metrics import (
+    request_metrics, render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+)
+from profiler import admin_action, ADMIN_ACTIONS
+from timing import (
+    start_timings, finish_timings, timing_enabled, timed, PARSE
+)
+from scripts import (
+    log_exception, dumps_body, error_object, error_body,
+    encode_json_batch, load_swagger_yaml, load_definitions_yaml,
+    set_pretty_output,
+    user_etag, page_etag, etag_matches, representation_etag,
+    set_response_content_type, response_content_type, loads_body,
+    wants_bson, raw_reads, wants_compact_json, set_request_id
+)
+from validators import (
+    validate_request_headers,
+    validate_user_uuid,
+    validate_json_object,
+    validate_json_objects,
+    validate_request_method,
+    validate_user_email,
+    validate_page_query,
+    validate_stream_query,
+    compile_spec_validators
+)
+
+
+def json_response(obj: Any, status: int = 200,
+                  headers: Optional[dict] = None) -> web.Response:
+    """
+    Makes right json response message. The body is msgpack or bson
+    instead, if the client asked for them.
+    """
+    headers = dict(headers or {}, Vary='Accept')
+    return web.Response(body=dumps_body(obj),
+                        content_type=response_content_type.get(),
+                        status=status, headers=headers)
+
+
+def conditional_json_response(request: web.Request, obj: Any,
+                              etag: Optional[str]) -> web.Response:
+    """
+    Makes json response with ETag header, or empty 304 response
+    if the client already has this etag.
+    """
+    if etag is None:
+        return json_response(obj)
+    etag = representation_etag(etag)
+    headers = {'ETag': etag, 'Vary': 'Accept'}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    return json_response(obj, headers=headers)
+
+
+def json_error_response(e: errors.ServerError) -> web.Response:
+    if wants_compact_json():
+        return web.Response(body=error_body(e), status=e.status_code,
+                            content_type=SUPPORTED_CONTENT_TYPE,
+                            headers={'Vary': 'Accept'})
+    return json_response(error_object(e), status=e.status_code)
+
+
+async def json_stream_response(request: web.Request, objs, chunk_size: int,
+                               ndjson: bool = False,
+                               encoded: bool = False) -> web.StreamResponse:
+    """
+    Streams objs as a chunked JSON array (or NDJSON).
+    If encoded, objs are batches of encoded items, as the transcoder
+    makes them.
+    """
+    response = web.StreamResponse()
+    response.content_type = NDJSON_CONTENT_TYPE if ndjson \
+        else SUPPORTED_CONTENT_TYPE
+    response.enable_chunked_encoding()
+    response.headers[REQUEST_ID_HEADER] = request_id.get()
+    if COMPRESSION['ENABLED']:
+        response.headers['Vary'] = 'Accept-Encoding'
+        coding = accepted_coding(request)
+        if coding is not None:
+            response.enable_compression(coding)
+    await response.prepare(request)
+    prefix = b'' if ndjson else b'['
+    if encoded:
+        async for encoded_batch in objs:
+            if encoded_batch:
+                await response.write(prefix + encoded_batch)
+                prefix = b'' if ndjson else b','
+        if not ndjson:
+            await response.write(b'[]' if prefix == b'[' else b']')
+        await response.write_eof()
+        return response
+    batch: List[Any] = []
+    first = True
+    async for obj in objs:
+        batch.append(obj)
+        if len(batch) == chunk_size:
+            await response.write(prefix +
+                                 encode_json_batch(batch, first, ndjson))
+            prefix, first, batch = b'', False, []
+    await response.write(prefix + encode_json_batch(batch, first, ndjson)
+                         + (b'' if ndjson else b']'))
+    await response.write_eof()
+    return response
+
+
+def get_spec_digest(request: web.Request) -> Tuple[Any, Any]:
+    """Get swagger spec, user_obj, keys_to_digest"""
+    user_obj_spec = request.app['api.swagger_spec']['definitions']['User']
+    return user_obj_spec['required'], user_obj_spec
+
+
+def validate_request(request: web.Request, supported_methods):
+    """Returns error response if headers or method are not supported."""
+    try:
+        validate_request_method(request.method, supported_methods)
+        validate_request_headers(request.headers)
+    except (errors.WrongMethod, errors.AcceptTypeError,
+            errors.ContentTypeError) as e:
+        log_exception(e)
+        return json_error_response(e)
+    return None
+
+
+@timed(PARSE)
+async def read_json_body(request: web.Request) -> Any:
+    """Loads request body, json or msgpack/bson by its Content-Type."""
+    try:
+        if request.content_type != SUPPORTED_CONTENT_TYPE:
+            return loads_body(await request.read(), request.content_type)
+        return await request.json()
+    except Exception as e:
+        log_exception(e)
+        raise errors.BadRequestBody()
+
+
+async def index(request: web.Request) -> web.Response:
+    """Front page of the API."""
+    data = {"developer_name": "Valentin Sheboldaev",
+            "developer_organization": "[W]NETWorks"}
+    return web.Response(text=template('index', data=data),
+                        content_type='text/html')
+
+
+async def docs(request: web.Request) -> web.Response:
+    return json_response(request.app['api.swagger_spec'])
+
+
+async def by_uuid(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/get_user_by_uuid'])
+    if error:
+        return error
+    user_uuid = request.match_info['user_uuid']
+    try:  # Validate the UUID parameter
+        validate_user_uuid(user_uuid)
+    except errors.BadRequestQuery as e:
+        e.message_json = f'Wrong user UUID: {user_uuid}'
+        log_exception(e)
+        return json_error_response(e)
+
+    try:
+        if wants_bson():  # Raw BSON from the driver, sent as is
+            user = fields = await find_raw_user({'uuid': user_uuid})
+        elif raw_reads(single_user=True):
+            user, fields = await process_read_user_json({'uuid': user_uuid})
+        else:
+            user = fields = await read_by_uuid(user_uuid)
+        return conditional_json_response(request, user, user_etag(fields))
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def by_email(request: web.Request) -> web.Response:
+    error = validate_request(request,
+                             SUPPORTED_METHODS['/get_user_by_email'])
+    if error:
+        return error
+    user_email = request.match_info['user_email']
+    try:  # Validate the email parameter
+        validate_user_email(user_email)
+    except errors.BadRequestQuery as e:
+        e.message_json = f'Wrong user email: {user_email}'
+        log_exception(e)
+        return json_error_response(e)
+
+    try:
+        if wants_bson():  # Raw BSON from the driver, sent as is
+            user = fields = await find_raw_user({'email': user_email})
+        elif raw_reads(single_user=True):
+            user, fields = await process_read_user_json(
+                {'email': user_email})
+        else:
+            user = fields = await find_one_by_email({'email': user_email})
+        return conditional_json_response(request, user, user_etag(fields))
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def count_users(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/count_users'])
+    if error:
+        return error
+    try:  # Count users
+        return json_response(await count_tot_users())
+    except errors.InternalServerError as e:
+        e.message_json = 'Error while executing count'
+        return json_error_response(e)
+
+
+async def get_total_users(request: web.Request) -> web.StreamResponse:
+    error = validate_request(request, SUPPORTED_METHODS['/get_total_users'])
+    if error:
+        return error
+    stream = request.query.get('stream')
+    if stream is not None:
+        try:  # Stream all system users
+            ndjson = validate_stream_query(stream)
+        except errors.BadRequestQuery as e:
+            e.message_json = f'Wrong stream format: {stream}, ' \
+                             f'should be json or ndjson.'
+            log_exception(e)
+            return json_error_response(e)
+        batch_size = PAGINATION['STREAM_BATCH_SIZE']
+        encoded = raw_reads()
+        users: Any
+        try:  # First batch is read before the response starts
+            if encoded:
+                users = await process_stream_users_json(batch_size, ndjson)
+            else:
+                users = await process_stream_users(batch_size)
+        except errors.InternalServerError as e:
+            e.message_json = 'Error while reading users'
+            return json_error_response(e)
+        return await json_stream_response(request, users, batch_size,
+                                          ndjson, encoded)
+
+    try:  # Validate the paging parameters
+        limit, after = validate_page_query(request.query.get('limit'),
+                                           request.query.get('after'))
+    except errors.BadRequestQuery as e:
+        e.message_json = f'Wrong paging parameters, limit should be ' \
+                         f'1..{PAGINATION["MAX_LIMIT"]} and after ' \
+                         f'should be a user UUID.'
+        log_exception(e)
+        return json_error_response(e)
+
+    try:  # Get a page of system users
+        href = str(request.url.with_query(None))
+        users_page: Any
+        if raw_reads():
+            users_page, page_fields = await process_list_users_json(
+                href, limit, after)
+        else:
+            users_page = page_fields = await process_list_users(
+                href, limit, after)
+        return conditional_json_response(request, users_page,
+                                         page_etag(page_fields))
+    except errors.InternalServerError as e:
+        e.message_json = 'Error while executing find_cursor.'
+        return json_error_response(e)
+
+
+async def post_user(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/post_user'])
+    if error:
+        return error
+    try:  # Load and validate JSON object
+        user_to_create = await read_json_body(request)
+        keys_to_digest, user_obj_spec = get_spec_digest(request)
+        validate_json_object(user_to_create, user_obj_spec)
+    except errors.BadRequestBody as e:
+        log_exception(e)
+        return json_error_response(e)
+
+    try:  # Process post user
+        new, result = await process_post_user(user_to_create,
+                                              keys_to_digest)
+        return json_response(result, status=201 if new else 200)
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def post_users(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/post_users'])
+    if error:
+        return error
+    try:  # Load and validate JSON object
+        users_to_create = await read_json_body(request)
+        keys_to_digest, user_obj_spec = get_spec_digest(request)
+        validate_json_objects(users_to_create, user_obj_spec)
+    except errors.BadRequestBody as e:
+        log_exception(e)
+        return json_error_response(e)
+
+    try:  # Post users
+        new, res = await process_post_users(users_to_create, keys_to_digest)
+        return json_response(res, status=201 if new else 200)
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def update_user(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/update_user'])
+    if error:
+        return error
+    user_uuid = request.match_info['user_uuid']
+    try:  # Validate the UUID parameter
+        validate_user_uuid(user_uuid)
+    except errors.BadRequestQuery as e:
+        e.message_json = f'Wrong user UUID: {user_uuid}'
+        log_exception(e)
+        return json_error_response(e)
+
+    try:  # Load and validate JSON object
+        new_user = await read_json_body(request)
+        keys_to_digest, user_obj_spec = get_spec_digest(request)
+        validate_json_object(new_user, user_obj_spec)
+    except errors.BadRequestBody as e:
+        log_exception(e)
+        return json_error_response(e)
+
+    try:  # Update user
+        return json_response(await process_update_user(
+            user_uuid, new_user, keys_to_digest))
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def delete_user(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/delete_user'])
+    if error:
+        return error
+    user_uuid = request.match_info['user_uuid']
+    try:
+        await delete_by_uuid(user_uuid)
+        return web.Response(status=204)
+    except errors.UserNotFound as e:
+        e.message_json = f'User {user_uuid} not found'
+        log_exception(e)
+        return json_error_response(e)
+    except errors.InternalServerError as e:
+        log_exception(e)
+        return json_error_response(e)
+
+
+async def drop_collection(request: web.Request) -> web.Response:
+    error = validate_request(request, SUPPORTED_METHODS['/drop_collection'])
+    if error:
+        return error
+    try:
+        return json_response(await make_drop(), status=202)
+    except errors.InternalServerError as e:
+        e.message_json = 'Error while dropping collection.'
+        log_exception(e)
+        return json_error_response(e)
+
+
+@web.middleware
+async def output_middleware(request: web.Request, handler):
+    """Sets response encoding of the request: pretty json, msgpack..."""
+    set_pretty_output(request.query.get('pretty'))
+    set_response_content_type(request.headers.get('Accept'))
+    return await handler(request)
+
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    """Metrics of the worker in Prometheus text format."""
+    return web.Response(body=render_metrics(),
+                        headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+async def profiler_admin(request: web.Request) -> web.Response:
+    """Starts, stops the profiler or sends its samples."""
+    try:
+        body, content_type = admin_action(
+            request.match_info['action'], request.method,
+            request.headers.get('X-Admin-Token'),
+            request.query.get('seconds')
+        )
+    except (errors.Forbidden, errors.WrongMethod,
+            errors.BadRequestQuery) as e:
+        log_exception(e)
+        return json_error_response(e)
+    if content_type is None:
+        return json_response(body)
+    return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """Records request metrics by route resource."""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.perf_counter()
+    request_metrics.started()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request_metrics.finished(route, request.method, status,
+                                 time.perf_counter() - start)
+
+
+@web.middleware
+async def timing_middleware(request: web.Request, handler):
+    """Times phases of the request, see timing module."""
+    timings = start_timings()
+    response = await handler(request)
+    headers = response.headers if not response.prepared else {}
+    finish_timings(timings, headers, request.method, request.path,
+                   response.status)
+    return response
+
+
+@web.middleware
+async def request_id_middleware(request: web.Request, handler):
+    """Gives every request an id, echoed in X-Request-ID header."""
+    rid = set_request_id(request.headers.get(REQUEST_ID_HEADER))
+    response = await handler(request)
+    if not response.prepared:
+        response.headers[REQUEST_ID_HEADER] = rid
+    return response
+
+
+def accepted_coding(request: web.Request) -> Optional[web.ContentCoding]:
+    """Content coding aiohttp encodes the response with, if any."""
+    encodings = accepted_encodings(request.headers.get('Accept-Encoding'),
+                                   ['gzip', 'deflate'])
+    return web.ContentCoding(encodings[0]) if encodings else None
+
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler):
+    """
+    Compresses response bodies from MIN_SIZE on. Static files are served
+    from their precompressed .gz siblings by aiohttp itself.
+    """
+    response = await handler(request)
+    if type(response) is web.Response and response.status == 200 \
+            and isinstance(response.body, bytes) \
+            and len(response.body) >= COMPRESSION['MIN_SIZE'] \
+            and is_compressible(response.content_type) \
+            and 'Content-Encoding' not in response.headers:
+        response.headers.add('Vary', 'Accept-Encoding')
+        coding = accepted_coding(request)
+        if coding is None:
+            return response
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # Encoded body is not byte-equal to the identity one
+            response.headers['ETag'] = 'W/' + etag
+        response.enable_compression(coding)
+    return response
+
+
+def make_app() -> web.Application:
+    """Builds aiohttp application with the routes of main.setup_routing"""
+    logger.info({"Message": "Initializing aiohttp..."})
+    middlewares = [request_id_middleware, output_middleware]
+    if timing_enabled():
+        middlewares.insert(0, timing_middleware)
+    if METRICS['ENABLED']:
+        middlewares.insert(0, metrics_middleware)
+    if COMPRESSION['ENABLED']:
+        middlewares.append(compression_middleware)
+    app = web.Application(middlewares=middlewares)
+    app['api.swagger_spec'] = load_swagger_yaml()
+    compile_spec_validators(app['api.swagger_spec'], load_definitions_yaml())
+    wb = SERVER_SETTINGS['WEB_BASE']
+    app.add_routes([
+        web.get(wb + '/get_user_by_uuid/{user_uuid}', by_uuid),
+        web.get(wb + '/get_user_by_email/{user_email}', by_email),
+        web.get(wb + '/get_total_users', get_total_users),
+        web.get(wb + '/count_users', count_users),
+        web.get(wb + '/home', index),
+        web.post(wb + '/post_user', post_user),
+        web.post(wb + '/post_users', post_users),
+        web.put(wb + '/update_user/{user_uuid}', update_user),
+        web.delete(wb + '/delete_user/{user_uuid}', delete_user),
+        web.post(wb + '/drop_collection/{col_name}', drop_collection),
+        web.get(wb + '/docs', docs),
+        web.static('/static', os.path.join(os.getcwd(), 'static')),
+    ])
+    if METRICS['ENABLED']:
+        app.router.add_get('/metrics', serve_metrics)
+    app.router.add_route(
+        '*', '/admin/profiler/{action:%s}' % '|'.join(ADMIN_ACTIONS),
+        profiler_admin
+    )
+    return app
+
+
+def run(host: str, port: int):
+    web.run_app(make_app(), host=host, port=port, access_log=None)
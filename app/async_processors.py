@@ -0,0 +1,133 @@
+"""
+This module is the asyncio counterpart of processors.
+It reuses processors' record building and differs only in awaiting
+async_db_adaptor. Errors are not handled here, same as in processors.
+"""
+from typing import (
+    Tuple, List, Dict,
+    Union, Any, Optional,
+    Iterable, AsyncIterator
+)
+
+from async_db_adaptor import (
+    update_user,
+    find_existing_emails, insert_user,
+    insert_users, count_tot_users, get_users_page,
+    iter_users, find_raw_user, get_raw_users_page, iter_raw_user_batches
+)
+from processors import (
+    make_user_record, make_users_page, make_page_links,
+    collect_new_users, summarize_post_users, ETAG_FIELDS
+)
+from scripts import dumps_json, JSONBytes
+from transcoder import transcode_batch, transcode_document
+
+
+async def process_list_users(href: str, limit: int,
+                             after: Optional[str] = None) -> Dict[str, Any]:
+    """Returns one page of users from Users collection. Counts result."""
+    count_users = await count_tot_users()
+    # One extra record tells whether there is a next page
+    users_list = await get_users_page(limit + 1, after)
+    return make_users_page(count_users, users_list, href, limit, after)
+
+
+async def process_list_users_json(href: str, limit: int,
+                                  after: Optional[str] = None) \
+        -> Tuple[JSONBytes, Dict[str, Any]]:
+    """
+    Returns one page of users as json transcoded from raw BSON, and the
+    page object with only uuid and digest of users, to make its ETag.
+    """
+    count_users = await count_tot_users()
+    # One extra record tells whether there is a next page
+    users_json, users, count = transcode_batch(
+        await get_raw_users_page(limit + 1, after), limit=limit,
+        capture=ETAG_FIELDS
+    )
+    links = make_page_links(href, limit, after,
+                            users[-1]['uuid'] if count > limit else None)
+    page_json = JSONBytes(
+        b'{"usersCount":%s,"totalUsers":[%s],"links":%s}' % (
+            dumps_json(count_users, pretty=False), users_json,
+            dumps_json(links, pretty=False)
+        )
+    )
+    return page_json, {
+        'usersCount': count_users,
+        'totalUsers': users,
+        'links': links,
+    }
+
+
+async def process_stream_users(batch_size: int) \
+        -> AsyncIterator[Dict[Union[str, int], Any]]:
+    """Returns lazy iterator over all users of Users collection."""
+    return await iter_users(batch_size)
+
+
+async def process_stream_users_json(batch_size: int, ndjson: bool = False) \
+        -> AsyncIterator[bytes]:
+    """
+    Returns lazy iterator over all users of Users collection, as batches
+    of json array items (or NDJSON lines) transcoded from raw BSON.
+    """
+    batches = await iter_raw_user_batches(batch_size)
+    return (transcode_batch(batch, ndjson=ndjson)[0]
+            async for batch in batches)
+
+
+async def process_read_user_json(search_filter: Dict[Union[str, int], Any]) \
+        -> Tuple[Optional[JSONBytes], Dict[str, Any]]:
+    """
+    Returns user as json transcoded from raw BSON, and its uuid
+    and digest, to make its ETag.
+    """
+    user = await find_raw_user(search_filter)
+    if user is None:
+        return None, {}
+    user_json, fields = transcode_document(user.raw, capture=ETAG_FIELDS)
+    return JSONBytes(user_json), fields
+
+
+async def process_update_user(user_uuid: str,
+                              new_user: Dict[Union[str, int], Any],
+                              keys_to_digest: List[str]) \
+        -> Optional[Dict[Union[str, int], Any]]:
+    """Updates user by given fields. Searches by uuid."""
+    user_to_db = make_user_record(new_user, keys_to_digest, user_uuid)
+    return await update_user(user_uuid, user_to_db)
+
+
+async def process_post_user(user_to_create: Dict[Union[str, int], Any],
+                            fields_to_digest: List[str]) \
+        -> Tuple[bool, Union[str, Optional[Dict[Union[str, int], Any]]]]:
+    """Adds only one user to collection, in one round trip."""
+    user_email = user_to_create.get('email')
+    record = make_user_record(user_to_create, fields_to_digest)
+    user_id = await insert_user(record)
+    if user_id is None:
+        new: bool = False
+        return new, f"User with email: {user_email}, is in the DB."
+
+    record.pop('_id', None)
+    new = True
+    return new, record
+
+
+async def process_post_users(
+        users_to_add: Iterable[Dict[Union[str, int], Any]],
+        fields_to_digest: List[str]) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Adds new users to Users collection.
+    Returns per-user results in input order and their summary.
+    """
+    users_to_add = list(users_to_add)
+    known_emails = await find_existing_emails(
+        {user['email'] for user in users_to_add}
+    )
+    results, users_to_insert = collect_new_users(
+        users_to_add, known_emails, fields_to_digest
+    )
+    statuses = await insert_users(users_to_insert)
+    return summarize_post_users(results, statuses)
@@ -0,0 +1,332 @@
+"""
+This module implements read-through cache of user objects.
+UserCache lives in process memory, it is bounded by entries and bytes.
+SharedUserCache is a hash table in a memory mapped file shared by all
+workers on the host. Entries of both expire after TTL.
+All entries of a user are registered under its uuid, so one
+invalidation drops every key (uuid, email) the user was cached by.
+
+A reader takes token() before it reads the DB and passes it to put().
+The put is dropped if any user was invalidated in between, so a read
+racing an update or delete never caches the old user.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Set, Hashable
+
+from bson import json_util
+
+from config import CACHE, DATABASE
+
+CacheKey = Tuple[str, Hashable]
+
+
+def sizeof_user(user: Dict[Any, Any]) -> int:
+    """Cheap estimate of user object size in bytes."""
+    return sum(len(str(key)) + len(str(value))
+               for key, value in user.items())
+
+
+class UserCache:
+    """
+    LRU cache of user objects with TTL and hit/miss counters.
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, size, user)
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, int, Dict]]' = \
+            OrderedDict()
+        self._keys_by_uuid: Dict[str, Set[CacheKey]] = {}
+        self._bytes = 0
+        # Invalidations and clears so far, see token()
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: CacheKey) -> Optional[Dict[Any, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[2])
+
+    def token(self) -> int:
+        """Taken before the DB read of a user, which is put() later."""
+        return self._invalidations
+
+    def put(self, key: CacheKey, user: Dict[Any, Any],
+            token: Optional[int] = None):
+        """Caches user, unless anything was invalidated since token."""
+        size = sizeof_user(user)
+        if size > self._max_bytes or 'uuid' not in user:
+            return
+        with self._lock:
+            if token is not None and token != self._invalidations:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self._ttl,
+                                  size, dict(user))
+            self._keys_by_uuid.setdefault(user['uuid'], set()).add(key)
+            self._bytes += size
+            while len(self._entries) > self._max_entries \
+                    or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, user_uuid: str):
+        """Drops every entry of the user with given uuid."""
+        with self._lock:
+            self._invalidations += 1
+            for key in list(self._keys_by_uuid.get(user_uuid, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self._keys_by_uuid.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key: CacheKey):
+        _, size, user = self._entries.pop(key)
+        self._bytes -= size
+        keys = self._keys_by_uuid.get(user['uuid'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_uuid[user['uuid']]
+
+
+def key_hash(value: str) -> int:
+    """Stable across processes, unlike hash()."""
+    return int.from_bytes(
+        hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(),
+        'little'
+    )
+
+
+class SharedUserCache:
+    """
+    Direct mapped hash table of user objects in a shared memory file.
+    Slot is chosen by key hash, a new entry replaces the old one.
+
+    Readers do not lock, every slot is guarded by a sequence counter,
+    which is odd while the slot is written. The even counter is stored
+    on its own, after every other field. Writers take a byte range lock
+    of the slot, so workers never write one slot at the same time.
+
+    Invalidation bumps a generation counter of the uuid bucket,
+    entries stored with an older generation are treated as missing.
+    Clearing bumps the global generation. Both bump the invalidation
+    counter first, the token of readers. put() reads generations before
+    it compares the token, so an invalidation it misses leaves the entry
+    stamped with an old generation.
+    """
+    MAGIC = 0x55534552434143  # 'USERCAC'
+    # magic, slots, slot size, global gen, invalidations
+    HEADER = struct.Struct('<QQQQQ')
+    GLOBAL_GEN_OFFSET = 24
+    INVALIDATIONS_OFFSET = 32
+    # seq, key, expires, bucket, bucket gen, global gen, payload length
+    SLOT = struct.Struct('<QQdQQQI')
+    SEQ = struct.Struct('<Q')
+    GEN = struct.Struct('<Q')
+
+    def __init__(self, path: str, slots: int, slot_size: int, ttl: float):
+        self._slots = slots
+        self._slot_size = slot_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._gens_offset = self.HEADER.size
+        self._slots_offset = self._gens_offset + slots * self.GEN.size
+        size = self._slots_offset + slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked(0, self.HEADER.size):
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            layout = self.HEADER.unpack(header)[:3] \
+                if len(header) == self.HEADER.size else None
+            if os.fstat(self._fd).st_size != size or \
+                    layout != (self.MAGIC, slots, slot_size):
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, slots,
+                                                     slot_size, 0, 0), 0)
+        self._map = mmap.mmap(self._fd, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def get(self, key: CacheKey) -> Optional[Dict[Any, Any]]:
+        hashed = key_hash('%s:%s' % key)
+        offset = self._slot_offset(hashed)
+        seq, slot_key, expires, bucket, bucket_gen, global_gen, length = \
+            self.SLOT.unpack_from(self._map, offset)
+        if seq & 1 or slot_key != hashed or expires < time.time() \
+                or bucket >= self._slots \
+                or length > self._slot_size - self.SLOT.size:
+            self.misses += 1
+            return None
+        payload_offset = offset + self.SLOT.size
+        payload = self._map[payload_offset:payload_offset + length]
+        if global_gen != self._global_gen() \
+                or bucket_gen != self._bucket_gen(bucket) \
+                or self.SEQ.unpack_from(self._map, offset)[0] != seq:
+            self.misses += 1
+            return None
+        try:
+            user = json_util.loads(payload)
+        except ValueError:  # A torn slot is a miss, not an error
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user
+
+    def token(self) -> int:
+        """Taken before the DB read of a user, which is put() later."""
+        return self.GEN.unpack_from(self._map, self.INVALIDATIONS_OFFSET)[0]
+
+    def put(self, key: CacheKey, user: Dict[Any, Any],
+            token: Optional[int] = None):
+        """Caches user, unless anything was invalidated since token."""
+        if 'uuid' not in user:
+            return
+        payload = json_util.dumps(user).encode('utf-8')
+        if self.SLOT.size + len(payload) > self._slot_size:
+            return
+        hashed = key_hash('%s:%s' % key)
+        bucket = key_hash(user['uuid']) % self._slots
+        offset = self._slot_offset(hashed)
+        payload_offset = offset + self.SLOT.size
+        bucket_gen = self._bucket_gen(bucket)
+        global_gen = self._global_gen()
+        if token is not None and token != self.token():
+            return
+        with self._locked(offset, self._slot_size):
+            seq, slot_key, expires = \
+                self.SLOT.unpack_from(self._map, offset)[:3]
+            if slot_key not in (0, hashed) and expires >= time.time():
+                self.evictions += 1
+            self.SEQ.pack_into(self._map, offset, seq + 1)
+            self._map[payload_offset:payload_offset + len(payload)] = payload
+            self.SLOT.pack_into(self._map, offset, seq + 1, hashed,
+                                time.time() + self._ttl, bucket,
+                                bucket_gen, global_gen, len(payload))
+            self.SEQ.pack_into(self._map, offset, seq + 2)
+
+    def invalidate(self, user_uuid: str):
+        """Drops every entry of the user with given uuid."""
+        self._count_invalidation()
+        bucket = key_hash(user_uuid) % self._slots
+        offset = self._gens_offset + bucket * self.GEN.size
+        with self._locked(offset, self.GEN.size):
+            self.GEN.pack_into(self._map, offset,
+                               self._bucket_gen(bucket) + 1)
+
+    def clear(self):
+        self._count_invalidation()
+        with self._locked(self.GLOBAL_GEN_OFFSET, self.GEN.size):
+            self.GEN.pack_into(self._map, self.GLOBAL_GEN_OFFSET,
+                               self._global_gen() + 1)
+
+    def stats(self) -> Dict[str, int]:
+        """Counters are of this worker, the table is of the host."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'slots': self._slots,
+        }
+
+    def _slot_offset(self, hashed: int) -> int:
+        return self._slots_offset + (hashed % self._slots) * self._slot_size
+
+    def _bucket_gen(self, bucket: int) -> int:
+        return self.GEN.unpack_from(
+            self._map, self._gens_offset + bucket * self.GEN.size)[0]
+
+    def _global_gen(self) -> int:
+        return self.GEN.unpack_from(self._map, self.GLOBAL_GEN_OFFSET)[0]
+
+    def _count_invalidation(self):
+        with self._locked(self.INVALIDATIONS_OFFSET, self.GEN.size):
+            self.GEN.pack_into(self._map, self.INVALIDATIONS_OFFSET,
+                               self.token() + 1)
+
+    def _locked(self, offset: int, length: int) -> '_RangeLock':
+        return _RangeLock(self._fd, self._lock, offset, length)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+
+class _RangeLock:
+    """
+    Locks a byte range of the file against other processes,
+    and against other threads of this process.
+    """
+    def __init__(self, fd: int, thread_lock: threading.Lock,
+                 offset: int, length: int):
+        self._fd = fd
+        self._thread_lock = thread_lock
+        self._offset = offset
+        self._length = length
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._length, self._offset)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, self._length, self._offset)
+        self._thread_lock.release()
+
+
+def shared_cache_path() -> str:
+    """
+    File of the shared cache, one per database and collection, so apps
+    of other deployments on the host never read each other's users.
+    """
+    return '%s.%s.%s' % (CACHE['SHARED_PATH'], DATABASE['DB_NAME'],
+                         DATABASE['COL_NAME'])
+
+
+def make_user_cache():
+    """Builds user cache of configured backend."""
+    if CACHE['BACKEND'] == 'shared':
+        return SharedUserCache(shared_cache_path(), CACHE['SHARED_SLOTS'],
+                               CACHE['SHARED_SLOT_SIZE'], CACHE['TTL'])
+    return UserCache(CACHE['MAX_ENTRIES'], CACHE['MAX_BYTES'],
+                     CACHE['TTL'])
+
+
+user_cache = make_user_cache()
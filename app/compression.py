@@ -0,0 +1,209 @@
+"""
+This module compresses responses the client accepts encoded.
+CompressionPlugin encodes Bottle responses above COMPRESSION['MIN_SIZE'],
+static files are precompressed at build time with the CLI:
+
+    python compression.py [static_dir]
+"""
+import argparse
+import gzip
+import mimetypes
+import os
+import sys
+import zlib
+from typing import Any, Iterable, Iterator, List, Optional
+
+from bottle import HTTPResponse, request, response, static_file
+
+from config import COMPRESSION
+from logger_setup import logger
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/x-ndjson',
+    'application/javascript', 'application/x-yaml',
+}
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.json', '.yaml')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def accepted_encodings(accept_encoding: Optional[str],
+                       supported: Iterable[str]) -> List[str]:
+    """
+    Returns those of supported encodings which Accept-Encoding header
+    allows, most preferred first. Ties keep the order of supported.
+    """
+    if not accept_encoding:
+        return []
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    allowed = [coding for coding in supported
+               if weights.get(coding, default) > 0]
+    return sorted(allowed, key=lambda coding: -weights.get(coding, default))
+
+
+def runtime_encodings() -> List[str]:
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def is_compressible(content_type: str) -> bool:
+    mime_type = content_type.split(';')[0].strip()
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION['BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=COMPRESSION['GZIP_LEVEL'])
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) \
+        -> Iterator[bytes]:
+    """Compresses a streamed body, every chunk is flushed as it comes."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(
+            quality=COMPRESSION['BROTLI_QUALITY'])
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(COMPRESSION['GZIP_LEVEL'],
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def compress_response(out: Any, accept_encoding: Optional[str]) -> Any:
+    """
+    Encodes handler result out, an HTTPResponse or a body of the global
+    response. Bodies below MIN_SIZE, files and error responses pass as is.
+    """
+    resp = out if isinstance(out, HTTPResponse) else response
+    body = out.body if isinstance(out, HTTPResponse) else out
+    content_type = resp.content_type or resp.default_content_type
+    if resp.status_code != 200 or 'Content-Encoding' in resp.headers \
+            or not is_compressible(content_type):
+        return out
+    if isinstance(body, str):
+        body = body.encode(resp.charset or 'utf-8')
+    if isinstance(body, bytes):
+        if len(body) < COMPRESSION['MIN_SIZE']:
+            return out
+    elif hasattr(body, 'read') or not hasattr(body, '__iter__'):
+        return out
+
+    resp.add_header('Vary', 'Accept-Encoding')
+    encodings = accepted_encodings(accept_encoding, runtime_encodings())
+    if not encodings:
+        return out
+    encoding = encodings[0]
+    resp.set_header('Content-Encoding', encoding)
+    if 'Content-Length' in resp.headers:
+        del resp.headers['Content-Length']
+    etag = resp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        # Encoded body is not byte-equal to the identity one
+        resp.set_header('ETag', 'W/' + etag)
+    if isinstance(body, bytes):
+        body = compress(body, encoding)
+    else:
+        body = compress_chunks(body, encoding)
+    if isinstance(out, HTTPResponse):
+        out.body = body
+        return out
+    return body
+
+
+class CompressionPlugin:
+    """Bottle plugin compressing responses of all routes."""
+    name = 'compression'
+    api = 2
+
+    def apply(self, callback, route):
+        if not COMPRESSION['ENABLED']:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            return compress_response(callback(*args, **kwargs),
+                                     request.get_header('Accept-Encoding'))
+        return wrapper
+
+
+def precompressed_static_file(filename: str, root: str,
+                              accept_encoding: Optional[str]) -> Any:
+    """
+    Serves filename from root, or its precompressed .br/.gz sibling
+    if there is one the client accepts.
+    """
+    for encoding in accepted_encodings(accept_encoding, ['br', 'gzip']):
+        encoded_name = filename + SUFFIXES[encoding]
+        if os.path.isfile(os.path.join(root, encoded_name)):
+            mimetype = mimetypes.guess_type(filename)[0] or 'auto'
+            resp = static_file(encoded_name, root=root, mimetype=mimetype)
+            resp.set_header('Vary', 'Accept-Encoding')
+            if resp.status_code in (200, 206):
+                resp.set_header('Content-Encoding', encoding)
+            return resp
+    resp = static_file(filename, root=root)
+    if filename.endswith(PRECOMPRESS_EXTENSIONS):
+        resp.set_header('Vary', 'Accept-Encoding')
+    return resp
+
+
+def precompress(static_dir: str) -> int:
+    """Writes .gz (and .br) siblings of static assets. Returns their count."""
+    written = 0
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+        if not name.endswith(PRECOMPRESS_EXTENSIONS) \
+                or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        encoded = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            encoded['br'] = brotli.compress(data, quality=11)
+        for encoding, body in encoded.items():
+            encoded_path = path + SUFFIXES[encoding]
+            if len(body) >= len(data):
+                if os.path.exists(encoded_path):
+                    os.remove(encoded_path)
+                continue
+            with open(encoded_path, 'wb') as f:
+                f.write(body)
+            written += 1
+            logger.info("Precompressed %s: %s -> %s bytes.",
+                        encoded_path, len(data), len(body))
+    return written
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Precompress static assets with gzip and brotli.'
+    )
+    parser.add_argument('static_dir', nargs='?',
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args(argv)
+    precompress(args.static_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
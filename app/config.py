@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import configparser
-import json
 import os
 import logging
+from typing import Any, Dict
 
 from version import VERSION
-from logger_setup import logger
+from logger_setup import logger, configure_logging, LazyJson
 
 script_dir = os.path.dirname(__file__)
 default_config_file = os.path.join(script_dir, "default_config.ini")
@@ -32,6 +32,15 @@ def get_env(section, var, default=None) -> str:
 
 UUID_MATCH_PATTERN = 'USER-[0-9A-F]{32}\\Z'
 SUPPORTED_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+REQUEST_ID_HEADER = 'X-Request-ID'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+BSON_CONTENT_TYPE = 'application/bson'
+# Encodings of request and response bodies, negotiated by Accept
+# and Content-Type headers. The first one is the default.
+BODY_CONTENT_TYPES = (
+    SUPPORTED_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, BSON_CONTENT_TYPE
+)
 SUPPORTED_METHODS = {
     '/home': {'GET'},
     '/get_user_by_uuid': {'GET'},
@@ -52,41 +61,147 @@ def to_boolean(var: str) -> bool:
                  else True
 
 
-DATABASE = {
+DATABASE: Dict[str, Any] = {
     'ADDRESS': get_env('DATABASE', 'ADDRESS', 'db'),
     'PORT': int(get_env('DATABASE', 'PORT', 27017)),
     'DB_NAME': get_env('DATABASE', 'DB_NAME', 'userAPI'),
-    'COL_NAME': get_env('DATABASE', 'COL_NAME', 'users')
+    'COL_NAME': get_env('DATABASE', 'COL_NAME', 'users'),
+    'MAX_POOL_SIZE': int(get_env('DATABASE', 'MAX_POOL_SIZE', 100)),
+    'MIN_POOL_SIZE': int(get_env('DATABASE', 'MIN_POOL_SIZE', 0)),
+    'WAIT_QUEUE_TIMEOUT_MS': int(
+        get_env('DATABASE', 'WAIT_QUEUE_TIMEOUT_MS', 1000)
+    ),
+    'ENSURE_INDEXES': to_boolean(
+        get_env('DATABASE', 'ENSURE_INDEXES', True)
+    ),
+    'STRICT_INDEXES': to_boolean(
+        get_env('DATABASE', 'STRICT_INDEXES', False)
+    ),
+    'COUNT_RECONCILE_INTERVAL': float(
+        get_env('DATABASE', 'COUNT_RECONCILE_INTERVAL', 60)
+    ),
+    'RAW_READS': to_boolean(get_env('DATABASE', 'RAW_READS', False))
 }
 
-HTTP_SERVER = {
+HTTP_SERVER: Dict[str, Any] = {
     'ADDRESS': get_env('HTTP_SERVER', 'ADDRESS'),
 }
 
-SERVER_SETTINGS = {
+SERVER_SETTINGS: Dict[str, Any] = {
     'SERVER_PORT': int(get_env('SERVER_SETTINGS', 'SERVER_PORT', 8080)),
     'SERVER_IP': get_env('SERVER_SETTINGS', 'SERVER_IP', "0.0.0.0"),
     'WEB_BASE': get_env('SERVER_SETTINGS', 'WEB_BASE', "/api/v1"),
-    'WEB_SCHEME': get_env('SERVER_SETTINGS', 'WEB_SCHEME', "http")
+    'WEB_SCHEME': get_env('SERVER_SETTINGS', 'WEB_SCHEME', "http"),
+    'MODE': get_env('SERVER_SETTINGS', 'MODE', "wsgi"),
+    'SERVER': get_env('SERVER_SETTINGS', 'SERVER', "dev"),
+    'WORKERS': int(get_env('SERVER_SETTINGS', 'WORKERS', 0)),
+    'WORKER_CLASS': get_env('SERVER_SETTINGS', 'WORKER_CLASS', "sync"),
+    'THREADS': int(get_env('SERVER_SETTINGS', 'THREADS', 1)),
+    'WORKER_CONNECTIONS': int(
+        get_env('SERVER_SETTINGS', 'WORKER_CONNECTIONS', 1000)
+    ),
+    'REUSE_PORT': to_boolean(get_env('SERVER_SETTINGS', 'REUSE_PORT', True)),
+    'MAX_REQUESTS': int(get_env('SERVER_SETTINGS', 'MAX_REQUESTS', 10000)),
+    'MAX_REQUESTS_JITTER': int(
+        get_env('SERVER_SETTINGS', 'MAX_REQUESTS_JITTER', 1000)
+    )
 }
 
-APPLICATION_SETTINGS = {
+PAGINATION: Dict[str, Any] = {
+    'DEFAULT_LIMIT': int(get_env('PAGINATION', 'DEFAULT_LIMIT', 100)),
+    'MAX_LIMIT': int(get_env('PAGINATION', 'MAX_LIMIT', 1000)),
+    'STREAM_BATCH_SIZE': int(get_env('PAGINATION', 'STREAM_BATCH_SIZE', 500))
+}
+
+BULK: Dict[str, Any] = {
+    'LOOKUP_CHUNK_SIZE': int(get_env('BULK', 'LOOKUP_CHUNK_SIZE', 1000)),
+    'INSERT_BATCH_SIZE': int(get_env('BULK', 'INSERT_BATCH_SIZE', 1000)),
+    'INSERT_CONCURRENCY': int(get_env('BULK', 'INSERT_CONCURRENCY', 1))
+}
+
+CACHE: Dict[str, Any] = {
+    'ENABLED': to_boolean(get_env('CACHE', 'ENABLED', True)),
+    'MAX_ENTRIES': int(get_env('CACHE', 'MAX_ENTRIES', 10000)),
+    'MAX_BYTES': int(get_env('CACHE', 'MAX_BYTES', 64 * 1024 * 1024)),
+    'TTL': float(get_env('CACHE', 'TTL', 60)),
+    'BACKEND': get_env('CACHE', 'BACKEND', 'auto'),
+    'SHARED_PATH': get_env('CACHE', 'SHARED_PATH',
+                           '/dev/shm/userapi_cache'),
+    'SHARED_SLOTS': int(get_env('CACHE', 'SHARED_SLOTS', 16384)),
+    'SHARED_SLOT_SIZE': int(get_env('CACHE', 'SHARED_SLOT_SIZE', 1024))
+}
+if CACHE['BACKEND'] == 'auto':
+    CACHE['BACKEND'] = 'shared' if SERVER_SETTINGS['SERVER'] == 'prefork' \
+        else 'local'
+
+COMPRESSION: Dict[str, Any] = {
+    'ENABLED': to_boolean(get_env('COMPRESSION', 'ENABLED', True)),
+    'MIN_SIZE': int(get_env('COMPRESSION', 'MIN_SIZE', 1024)),
+    'GZIP_LEVEL': int(get_env('COMPRESSION', 'GZIP_LEVEL', 6)),
+    'BROTLI_QUALITY': int(get_env('COMPRESSION', 'BROTLI_QUALITY', 5))
+}
+
+METRICS: Dict[str, Any] = {
+    'ENABLED': to_boolean(get_env('METRICS', 'ENABLED', True)),
+    'BUCKETS': [float(bound) for bound in get_env(
+        'METRICS', 'BUCKETS',
+        '0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5'
+    ).split(',')]
+}
+
+DB_MONITORING: Dict[str, Any] = {
+    'ENABLED': to_boolean(get_env('DB_MONITORING', 'ENABLED', True)),
+    'SLOW_QUERY_MS': float(get_env('DB_MONITORING', 'SLOW_QUERY_MS', 100)),
+    'EXPLAIN_SAMPLE_RATE': float(
+        get_env('DB_MONITORING', 'EXPLAIN_SAMPLE_RATE', 0)),
+    'EXPLAIN_MAX_SHAPES': int(
+        get_env('DB_MONITORING', 'EXPLAIN_MAX_SHAPES', 1000))
+}
+
+PROFILER: Dict[str, Any] = {
+    'ENABLED': to_boolean(get_env('PROFILER', 'ENABLED', False)),
+    'INTERVAL': float(get_env('PROFILER', 'INTERVAL', 0.05)),
+    'WINDOW': int(get_env('PROFILER', 'WINDOW', 300)),
+    'ADMIN_TOKEN': get_env('PROFILER', 'ADMIN_TOKEN', '')
+}
+
+TIMING: Dict[str, Any] = {
+    'SERVER_TIMING': to_boolean(get_env('TIMING', 'SERVER_TIMING', False)),
+    'SLOW_REQUEST_MS': float(get_env('TIMING', 'SLOW_REQUEST_MS', 1000))
+}
+
+APPLICATION_SETTINGS: Dict[str, Any] = {
     'VERSION': VERSION,
     'BASE_PATH': os.getcwd(),
 }
 
-LOG = {
-    'LEVEL': get_env('LOG', 'LEVEL', 'INFO')
+LOG: Dict[str, Any] = {
+    'LEVEL': get_env('LOG', 'LEVEL', 'INFO'),
+    'ERRORS_PER_INTERVAL': int(get_env('LOG', 'ERRORS_PER_INTERVAL', 10)),
+    'ERROR_INTERVAL': float(get_env('LOG', 'ERROR_INTERVAL', 60)),
+    'FILE': get_env('LOG', 'FILE', 'static/logging.txt'),
+    'MAX_BYTES': int(get_env('LOG', 'MAX_BYTES', 10485760)),
+    'BACKUP_COUNT': int(get_env('LOG', 'BACKUP_COUNT', 5))
 }
 
 # check sanity and set appropriate logging level
 if LOG['LEVEL'] not in logging._levelToName.values():
     LOG['LEVEL'] = 'INFO'
-logger.info("Setting LOG_LEVEL to {}.".format(LOG['LEVEL']))
+configure_logging(LOG['FILE'], LOG['MAX_BYTES'], LOG['BACKUP_COUNT'])
+logger.info("Setting LOG_LEVEL to %s.", LOG['LEVEL'])
 logger.setLevel(LOG['LEVEL'])
 
-logger.debug("APPLICATION_SETTINGS: " + json.dumps(APPLICATION_SETTINGS))
-logger.debug("HTTP_SERVER: " + json.dumps(HTTP_SERVER))
-logger.debug("DATABASE: " + json.dumps(DATABASE))
-logger.debug("SERVER_SETTINGS: " + json.dumps(SERVER_SETTINGS))
-logger.debug("LOG: " + json.dumps(LOG))
+logger.debug("APPLICATION_SETTINGS: %s", LazyJson(APPLICATION_SETTINGS))
+logger.debug("HTTP_SERVER: %s", LazyJson(HTTP_SERVER))
+logger.debug("DATABASE: %s", LazyJson(DATABASE))
+logger.debug("SERVER_SETTINGS: %s", LazyJson(SERVER_SETTINGS))
+logger.debug("PAGINATION: %s", LazyJson(PAGINATION))
+logger.debug("BULK: %s", LazyJson(BULK))
+logger.debug("CACHE: %s", LazyJson(CACHE))
+logger.debug("COMPRESSION: %s", LazyJson(COMPRESSION))
+logger.debug("METRICS: %s", LazyJson(METRICS))
+logger.debug("DB_MONITORING: %s", LazyJson(DB_MONITORING))
+logger.debug("PROFILER: %s", LazyJson(
+    dict(PROFILER, ADMIN_TOKEN='***' if PROFILER['ADMIN_TOKEN'] else '')))
+logger.debug("TIMING: %s", LazyJson(TIMING))
+logger.debug("LOG: %s", LazyJson(LOG))
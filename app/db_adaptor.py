@@ -1,23 +1,102 @@
 """
 This module is responsible for high and low level database operations.
 """
+import itertools
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     List, Dict, Union, Iterable,
     Any, Iterator, Optional,
-    MutableMapping
+    Mapping, MutableMapping, Tuple, Set, Callable
 )
 from pymongo import results
 from pymongo import MongoClient
 from pymongo import ReturnDocument
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
 import errors
-from config import DATABASE
+from cache import user_cache
+from config import DATABASE, BULK, CACHE
+from db_monitoring import event_listeners
 from scripts import log_exception
+from timing import timed, DB
 
 DB_HOST = DATABASE['ADDRESS']
 DB_PORT = DATABASE['PORT']
 DB_NAME = DATABASE['DB_NAME']
 COLLECTION_NAME = DATABASE['COL_NAME']
+DUPLICATE_KEY_ERROR = 11000
+
+# Called with every deleted user object
+delete_hooks: List[Callable[[Dict[Union[str, int], Any]], Any]] = []
+
+# Documents are returned undecoded, as the driver got them
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+INSERTED = 'inserted'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+# Insert failed midway and the DB could not tell what was written
+UNKNOWN = 'unknown'
+
+
+def duplicate_key_field(error: Optional[Mapping[str, Any]]) -> Optional[str]:
+    """
+    Field of the unique index a duplicate key write error is about,
+    from keyPattern or, for older servers, the error message.
+    """
+    error = error or {}
+    if error.get('keyPattern'):
+        return next(iter(error['keyPattern']))
+    match = re.search(r'index: (\w+?)_-?1 dup key', error.get('errmsg', ''))
+    return match.group(1) if match else None
+
+
+# MongoClient objects are thread-safe and keep their own connection pool,
+# so one client per (process, host, port) is shared by every request.
+_clients: Dict[Tuple[int, str, int], MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host: str = DB_HOST, port: int = DB_PORT) -> MongoClient:
+    """
+    Returns the process-wide MongoClient for host:port.
+    Client is created lazily on first use and is never shared across fork.
+    """
+    key = (os.getpid(), host, port)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = MongoClient(
+                    host, port,
+                    maxPoolSize=DATABASE['MAX_POOL_SIZE'],
+                    minPoolSize=DATABASE['MIN_POOL_SIZE'],
+                    waitQueueTimeoutMS=DATABASE['WAIT_QUEUE_TIMEOUT_MS'],
+                    event_listeners=event_listeners(
+                        lambda: get_client(host, port)),
+                    connect=False
+                )
+                _clients[key] = client
+    return client
+
+
+def reset_clients():
+    """
+    Forgets all clients inherited from the parent process.
+    Sockets of the parent are not closed, they still belong to it.
+    """
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+    DBAdapter._shared_state.clear()
 
 
 class DBAdapter:
@@ -26,18 +105,23 @@ class DBAdapter:
     Low level methods mimics PyMongo function names.
     Database client and database objects are singletons (Borg actually).
     """
+    _shared_state: Dict[str, Any] = {}
+
     def __init__(self):
-        self._client = MongoClient(DB_HOST, DB_PORT)
-        self._db = self._client[DB_NAME]
-        self._col_name = COLLECTION_NAME
+        self.__dict__ = self._shared_state
+        if self.__dict__.get('_pid') != os.getpid():
+            self._client = get_client()
+            self._db = self._client[DB_NAME]
+            self._col_name = COLLECTION_NAME
+            self._pid = os.getpid()
 
     def drop(self) -> Optional[Iterable[str]]:
         self._db[self._col_name].drop()
         return self._db.list_collection_names()
 
-    def insert_many(self, to_insert: List[MutableMapping[Any, Any]]) \
-            -> results.InsertManyResult:
-        return self._db[self._col_name].insert_many(to_insert)
+    def insert_many(self, to_insert: List[MutableMapping[Any, Any]],
+                    **kwargs) -> results.InsertManyResult:
+        return self._db[self._col_name].insert_many(to_insert, **kwargs)
 
     def insert_one(self, to_insert: MutableMapping[Any, Any]) \
             -> results.InsertOneResult:
@@ -47,18 +131,28 @@ class DBAdapter:
             -> results.DeleteResult:
         return self._db[self._col_name].delete_one(delete_filter)
 
-    def count(self) -> Optional[int]:
-        return self._db[self._col_name].count()
+    def estimated_document_count(self) -> int:
+        return self._db[self._col_name].estimated_document_count()
 
     def find_cursor(self, **kwargs) -> Iterator:
         cursor_iter = self._db[self._col_name].find(**kwargs)
         return cursor_iter
 
+    def find_raw_batches(self, **kwargs) -> Iterator[bytes]:
+        return self._db[self._col_name].find_raw_batches(**kwargs)
+
     def find_one(self,
                  filter_q: Dict[Union[str, int], Any], *args, **kwargs) \
             -> Optional[Dict[Union[str, int], Any]]:
         return self._db[self._col_name].find_one(filter_q, *args, **kwargs)
 
+    def find_one_raw(self, filter_q: Dict[Union[str, int], Any],
+                     **kwargs) -> Optional[RawBSONDocument]:
+        collection = self._db[self._col_name].with_options(
+            codec_options=RAW_CODEC_OPTIONS
+        )
+        return collection.find_one(filter_q, **kwargs)
+
     def find_one_and_update(self, search_filter: Dict[Union[str, int], Any],
                             update: Dict[Union[str, int], Any], **kwargs) \
             -> Optional[Dict[Union[str, int], Any]]:
@@ -66,6 +160,70 @@ class DBAdapter:
             search_filter, update, **kwargs
         )
 
+    def find_one_and_delete(self, search_filter: Dict[Union[str, int], Any],
+                            **kwargs) -> Optional[Dict[Union[str, int], Any]]:
+        return self._db[self._col_name].find_one_and_delete(
+            search_filter, **kwargs
+        )
+
+    def create_index(self, keys: List[Tuple[str, int]], **kwargs) -> str:
+        return self._db[self._col_name].create_index(keys, **kwargs)
+
+    def index_information(self) -> Dict[str, Any]:
+        return self._db[self._col_name].index_information()
+
+    def current_op(self, op_filter: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(self._client.admin.aggregate(
+            [{'$currentOp': {}}, {'$match': op_filter}]
+        ))
+
+
+class UsersCounter:
+    """
+    Size of users collection, kept up to date by insert and delete paths
+    of this process. It is reconciled with the collection metadata every
+    interval seconds, which also picks up writes of other processes.
+    """
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._value: Optional[int] = None
+        self._reconcile_at = 0.0
+
+    def get(self, fetch: Callable[[], int]) -> int:
+        value = self.peek()
+        if value is None:
+            value = fetch()
+            self.reset(value)
+        return value
+
+    def peek(self) -> Optional[int]:
+        """Returns the count, None if it has to be reconciled."""
+        with self._lock:
+            if time.monotonic() < self._reconcile_at:
+                return self._value
+            return None
+
+    def add(self, delta: int):
+        with self._lock:
+            if self._value is not None:
+                self._value = max(self._value + delta, 0)
+
+    def reset(self, value: Optional[int] = None):
+        with self._lock:
+            self._value = value
+            self._reconcile_at = time.monotonic() + self._interval
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+
+users_counter = UsersCounter(DATABASE['COUNT_RECONCILE_INTERVAL'])
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_clients)
+    os.register_at_fork(after_in_child=users_counter.after_fork)
+
 
 def get_db_adaptor():
     """
@@ -74,19 +232,95 @@ def get_db_adaptor():
     return DBAdapter()
 
 
-def get_users() -> List[Dict[Union[str, int], Any]]:
+def iter_users(batch_size: int) -> Iterator[Dict[Union[str, int], Any]]:
+    """
+    Returns iterator over all user objects from users collection ordered
+    by uuid. Documents are fetched lazily, batch_size at a time. The first
+    batch is fetched here, so a failing DB raises before a response starts.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        cursor = db_adaptor.find_cursor(projection={'_id': False},
+                                        sort=[('uuid', ASCENDING)],
+                                        batch_size=batch_size)
+        first = list(itertools.islice(cursor, 1))
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+    return iter_cursor(first, cursor)
+
+
+def iter_cursor(first: List[Any], cursor: Iterator[Any]) -> Iterator[Any]:
+    """
+    Yields first items (documents or raw batches), then the rest of cursor.
+    Raises errors.InternalServerError is any errors.
+    """
+    yield from first
+    try:
+        yield from cursor
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+def iter_raw_user_batches(batch_size: int) -> Iterator[bytes]:
     """
-    Returns list of user objects from users collection.
+    Returns iterator over all users ordered by uuid, as raw BSON batches
+    of concatenated documents. _id is left for the transcoder to drop.
+    The first batch is fetched here, as by iter_users.
     Raises errors.InternalServerError is any other errors.
     """
     try:
         db_adaptor = get_db_adaptor()
-        return [i for i in db_adaptor.find_cursor()]
+        cursor = db_adaptor.find_raw_batches(sort=[('uuid', ASCENDING)],
+                                             batch_size=batch_size)
+        first = list(itertools.islice(cursor, 1))
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
+    return iter_cursor(first, cursor)
+
 
+@timed(DB)
+def get_raw_users_page(limit: int, after: Optional[str] = None) -> bytes:
+    """
+    Returns up to limit users ordered by uuid, starting right after
+    the user with given uuid, as concatenated raw BSON documents.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        search_filter = {'uuid': {'$gt': after}} if after else {}
+        return b''.join(db_adaptor.find_raw_batches(
+            filter=search_filter, sort=[('uuid', ASCENDING)], limit=limit
+        ))
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
 
+
+@timed(DB)
+def get_users_page(limit: int, after: Optional[str] = None) \
+        -> List[Dict[Union[str, int], Any]]:
+    """
+    Returns up to limit user objects ordered by uuid,
+    starting right after the user with given uuid.
+    Raises errors.InternalServerError is any other errors.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        search_filter = {'uuid': {'$gt': after}} if after else {}
+        return list(db_adaptor.find_cursor(filter=search_filter,
+                                           projection={'_id': False},
+                                           sort=[('uuid', ASCENDING)],
+                                           limit=limit))
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
 def make_drop() -> Optional[Iterable[str]]:
     """
     Drops users collection.
@@ -95,35 +329,51 @@ def make_drop() -> Optional[Iterable[str]]:
     """
     try:
         db_adaptor = get_db_adaptor()
-        return db_adaptor.drop()
+        collections = db_adaptor.drop()
+        user_cache.clear()
+        users_counter.reset(0)
+        return collections
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
 
 
-def delete_by_uuid(user_uuid: str):
+def register_delete_hook(hook: Callable[[Dict[Union[str, int], Any]], Any]):
     """
-    Deletes user from collection given by user_uuid.
-    Raises errors.InternalServerError is any errors.
+    Registers hook called with every deleted user object, e.g. for audit.
+    """
+    delete_hooks.append(hook)
+
+
+@timed(DB)
+def delete_by_uuid(user_uuid: str) -> Dict[Union[str, int], Any]:
+    """
+    Deletes user from collection given by user_uuid,
+    atomically and in one round trip. Returns deleted user object.
+    Raises errors.UserNotFound if user is not found by user_uuid.
+    Raises errors.InternalServerError is any other errors.
     """
     try:
-        # Check that user is actually present
         db_adaptor = get_db_adaptor()
-        user = db_adaptor.find_one({'uuid': user_uuid},
-                                   projection={'_id': False})
-        if user is None:
-            raise errors.UserNotFound()
-
-        # Delete user
-        result = db_adaptor.delete_one({'uuid': user_uuid})
-        if not result.acknowledged:
-            raise errors.InternalServerError()
-        return result
+        user = db_adaptor.find_one_and_delete({'uuid': user_uuid},
+                                              projection={'_id': False})
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
+    if user is None:
+        raise errors.UserNotFound()
+
+    user_cache.invalidate(user_uuid)
+    users_counter.add(-1)
+    for hook in delete_hooks:
+        try:
+            hook(user)
+        except Exception as e:
+            log_exception(e)
+    return user
 
 
+@timed(DB)
 def read_by_uuid(user_uuid: str) -> Optional[Dict[Union[str, int], Any]]:
     """
     Get user obj from collection by given user_uuid.
@@ -131,9 +381,18 @@ def read_by_uuid(user_uuid: str) -> Optional[Dict[Union[str, int], Any]]:
     Raises errors.InternalServerError is any other errors.
     """
     try:
+        # Taken before the read, a racing invalidation drops the put
+        token = user_cache.token()
+        if CACHE['ENABLED']:
+            user = user_cache.get(('uuid', user_uuid))
+            if user is not None:
+                return user
         db_adaptor = get_db_adaptor()
-        return db_adaptor.find_one({'uuid': user_uuid},
+        user = db_adaptor.find_one({'uuid': user_uuid},
                                    projection={'_id': False})
+        if CACHE['ENABLED'] and user is not None:
+            user_cache.put(('uuid', user_uuid), user, token)
+        return user
     except errors.UserNotFound as e:
         log_exception(e)
         raise
@@ -142,40 +401,121 @@ def read_by_uuid(user_uuid: str) -> Optional[Dict[Union[str, int], Any]]:
         raise errors.InternalServerError()
 
 
+@timed(DB)
 def count_tot_users() -> Optional[int]:
     """
-    Returns current size of Users collection.
+    Returns current size of Users collection, from the counter kept by
+    write paths, falls back to estimated_document_count.
     Raises errors.InternalServerError is any other errors.
     """
     try:
         db_adaptor = get_db_adaptor()
-        return db_adaptor.count()
+        return users_counter.get(db_adaptor.estimated_document_count)
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
 
 
-def insert_user(required_fields_digest: MutableMapping[Any, Any]) -> str:
-    """Inserts one user to users collection. Returns id."""
+@timed(DB)
+def insert_user(required_fields_digest: MutableMapping[Any, Any]) \
+        -> Optional[str]:
+    """
+    Inserts one user to users collection. Returns id.
+    Returns None if a user with the same email is already there,
+    this relies on the unique email index.
+    """
     try:
         db_adaptor = get_db_adaptor()
-        return db_adaptor.insert_one(required_fields_digest).inserted_id
+        user_id = db_adaptor.insert_one(required_fields_digest).inserted_id
+        users_counter.add(1)
+        return user_id
+    except DuplicateKeyError as e:
+        if duplicate_key_field(e.details) == 'email':
+            return None
+        log_exception(e)
+        raise errors.InternalServerError()
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
 
 
-def insert_users(users_to_insert:
-                 List[MutableMapping[Any, Any]]) -> List[str]:
-    """Insert new users to collection, return ids."""
+@timed(DB)
+def insert_batch(users_to_insert: List[MutableMapping[Any, Any]]) \
+        -> List[str]:
+    """
+    Inserts one batch with an unordered bulk write.
+    Returns INSERTED, DUPLICATE, FAILED or UNKNOWN status per user.
+    """
+    statuses = [INSERTED] * len(users_to_insert)
     try:
         db_adaptor = get_db_adaptor()
-        return db_adaptor.insert_many(users_to_insert).inserted_ids
+        db_adaptor.insert_many(users_to_insert, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            statuses[error['index']] = DUPLICATE \
+                if error['code'] == DUPLICATE_KEY_ERROR \
+                and duplicate_key_field(error) == 'email' else FAILED
+        if e.details.get('writeConcernErrors'):
+            log_exception(e)
     except Exception as e:
         log_exception(e)
-        raise errors.InternalServerError()
+        statuses = recheck_batch(users_to_insert)
+    return statuses
 
 
+def recheck_batch(users_to_insert: List[MutableMapping[Any, Any]]) \
+        -> List[str]:
+    """
+    Returns statuses of a batch, which insert failed midway: users found
+    by uuid are INSERTED, the others FAILED. All are UNKNOWN if the
+    users can not be looked up either.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        cursor = db_adaptor.find_cursor(
+            filter={'uuid': {'$in': [user['uuid']
+                                     for user in users_to_insert]}},
+            projection={'uuid': True, '_id': False}
+        )
+        inserted = {user['uuid'] for user in cursor}
+    except Exception as e:
+        log_exception(e)
+        return [UNKNOWN] * len(users_to_insert)
+    return [INSERTED if user['uuid'] in inserted else FAILED
+            for user in users_to_insert]
+
+
+@timed(DB)
+def insert_users(users_to_insert:
+                 List[MutableMapping[Any, Any]]) -> List[str]:
+    """
+    Inserts new users to collection in INSERT_BATCH_SIZE batches,
+    INSERT_CONCURRENCY batches at a time.
+    Returns INSERTED, DUPLICATE, FAILED or UNKNOWN status per user.
+    A failed batch does not stop the others.
+    """
+    batch_size = BULK['INSERT_BATCH_SIZE']
+    batches = [users_to_insert[i:i + batch_size]
+               for i in range(0, len(users_to_insert), batch_size)]
+    if BULK['INSERT_CONCURRENCY'] > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(BULK['INSERT_CONCURRENCY']) as executor:
+            batch_statuses = list(executor.map(insert_batch, batches))
+    else:
+        batch_statuses = [insert_batch(batch) for batch in batches]
+    statuses = [status for statuses in batch_statuses for status in statuses]
+    count_users_inserted(statuses)
+    return statuses
+
+
+def count_users_inserted(statuses: List[str]):
+    """Adds inserted users to the counter, which is re-read if unsure."""
+    if UNKNOWN in statuses:
+        users_counter.reset()
+    else:
+        users_counter.add(statuses.count(INSERTED))
+
+
+@timed(DB)
 def find_one_by_filter(search_filter: Dict[Union[str, int], Any]) \
         -> Optional[Dict[Union[str, int], Any]]:
     """Find one user by search_filter. Returns user object."""
@@ -188,19 +528,70 @@ def find_one_by_filter(search_filter: Dict[Union[str, int], Any]) \
         raise errors.InternalServerError()
 
 
+@timed(DB)
+def find_raw_user(search_filter: Dict[Union[str, int], Any]) \
+        -> Optional[RawBSONDocument]:
+    """
+    Find one user as raw BSON, to be sent as is. User cache holds
+    decoded users, so it is not used here.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        return db_adaptor.find_one_raw(search_filter,
+                                       projection={'_id': False})
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
 def find_one_by_email(search_filter: Dict[Union[str, int], Any]) \
                       -> Optional[Dict[Union[str, int], Any]]:
     """Find one user by email. Returns user object."""
     try:
+        cacheable = CACHE['ENABLED'] and list(search_filter) == ['email']
+        token = user_cache.token()
+        if cacheable:
+            user = user_cache.get(('email', search_filter['email']))
+            if user is not None:
+                return user
         db_adaptor = get_db_adaptor()
         res = db_adaptor.find_one(search_filter,
                                   projection={'_id': False})
+        if cacheable and res is not None:
+            user_cache.put(('email', search_filter['email']), res,
+                           token)
         return res if res is not None else None
     except Exception as e:
         log_exception(e)
         raise errors.InternalServerError()
 
 
+@timed(DB)
+def find_existing_emails(emails: Iterable[str]) -> Set[str]:
+    """
+    Returns those of emails which are already in users collection.
+    Emails are looked up with one $in query per LOOKUP_CHUNK_SIZE emails,
+    projected on email only, so that the email index covers the query.
+    """
+    try:
+        db_adaptor = get_db_adaptor()
+        emails = list(emails)
+        chunk_size = BULK['LOOKUP_CHUNK_SIZE']
+        existing: Set[str] = set()
+        for i in range(0, len(emails), chunk_size):
+            cursor = db_adaptor.find_cursor(
+                filter={'email': {'$in': emails[i:i + chunk_size]}},
+                projection={'email': True, '_id': False}
+            )
+            existing.update(user['email'] for user in cursor)
+        return existing
+    except Exception as e:
+        log_exception(e)
+        raise errors.InternalServerError()
+
+
+@timed(DB)
 def update_user(user_uuid: str, user_to_db: MutableMapping[Any, Any]) \
                 -> Optional[Dict[Union[str, int], Any]]:
     """
@@ -211,12 +602,14 @@ def update_user(user_uuid: str, user_to_db: MutableMapping[Any, Any]) \
     try:
         fields = {'_id': False}
         db_adaptor = get_db_adaptor()
-        return db_adaptor.find_one_and_update(
+        updated = db_adaptor.find_one_and_update(
             {'uuid': user_uuid},
             {'$set': user_to_db},
             projection=fields,
             return_document=ReturnDocument.AFTER
         )
+        user_cache.invalidate(user_uuid)
+        return updated
     except errors.UserNotFound as e:
         log_exception(e)
         raise
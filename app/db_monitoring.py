@@ -0,0 +1,273 @@
+"""
+This module monitors MongoDB commands of the shared clients: latency,
+documents returned (or written) and errors per command and collection,
+added to /metrics. Commands slower than SLOW_QUERY_MS are logged with
+the shape of their filter. A sample of queries is explained, once per
+filter shape, and collection scans are logged and counted.
+"""
+import bisect
+import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, Callable, Dict, Iterator, List, Mapping, Optional, Set, Tuple
+)
+
+from pymongo import monitoring
+
+import metrics
+from config import DB_MONITORING, METRICS
+from logger_setup import logger, LazyJson
+
+# Commands, which filter can be explained, and where the filter is
+FILTER_FIELDS = {
+    'find': 'filter',
+    'count': 'query',
+    'findAndModify': 'query',
+    'distinct': 'query',
+}
+WRITE_FIELDS = {'update': 'updates', 'delete': 'deletes'}
+IGNORED_COMMANDS = {'explain', 'endSessions', 'killCursors'}
+
+
+def command_collection(name: str, command: Mapping[str, Any]) -> str:
+    target = command.get('collection' if name == 'getMore' else name)
+    return target if isinstance(target, str) else '-'
+
+
+def command_filter(name: str, command: Mapping[str, Any]) \
+        -> Optional[Mapping[str, Any]]:
+    """Query filter of a command, None if it has none."""
+    if name in FILTER_FIELDS:
+        return command.get(FILTER_FIELDS[name]) or {}
+    if name in WRITE_FIELDS:
+        statements = command.get(WRITE_FIELDS[name]) or [{}]
+        return statements[0].get('q') or {}
+    if name == 'aggregate':
+        for stage in command.get('pipeline') or []:
+            if '$match' in stage:
+                return stage['$match']
+        return {}
+    return None
+
+
+def filter_shape(value: Any) -> Any:
+    """Filter with its values replaced by '?', operators and fields kept."""
+    if isinstance(value, Mapping):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(value[0])] if value else []
+    return '?'
+
+
+def reply_documents(name: str, reply: Mapping[str, Any]) -> int:
+    """Documents a command returned, or wrote."""
+    cursor = reply.get('cursor')
+    if isinstance(cursor, Mapping):
+        batch = cursor.get('firstBatch', cursor.get('nextBatch'))
+        return len(batch) if isinstance(batch, list) else 0
+    if name == 'findAndModify':
+        return 1 if reply.get('value') is not None else 0
+    count = reply.get('n')
+    return count if isinstance(count, int) else 0
+
+
+def plan_stages(plan: Mapping[str, Any]) -> Iterator[str]:
+    yield plan.get('stage', '')
+    for child in plan.get('inputStages', ()):
+        yield from plan_stages(child)
+    if 'inputStage' in plan:
+        yield from plan_stages(plan['inputStage'])
+
+
+class CommandMonitor:
+    """
+    Records every command of the clients it gets the events of, through
+    ClientCommands. Started commands are kept until they succeed or fail.
+    """
+    def __init__(self, slow_query_ms: float, explain_sample_rate: float,
+                 explain_max_shapes: int):
+        self.slow_query_ms = slow_query_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_max_shapes = explain_max_shapes
+        self.buckets = tuple(sorted(METRICS['BUCKETS']))
+        self.counters = metrics.ShardedCounters()
+        # Filter shapes explained (or being explained) by this worker
+        self._explained: Set[str] = set()
+        # (request id, connection id) -> (name, collection, db, command)
+        self._started: Dict[Tuple[int, Any], Tuple[str, str, str, Any]] = {}
+        self._explain_lock = threading.Lock()
+        self._explainer: Optional[ThreadPoolExecutor] = None
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        name = event.command_name
+        if name in IGNORED_COMMANDS:
+            return
+        self._started[(event.request_id, event.connection_id)] = (
+            name, command_collection(name, event.command),
+            event.database_name, event.command
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent,
+                  explain_client: Optional[Callable[[], Any]] = None):
+        """Samples the query for explain, if the client to use is given."""
+        started = self._started.pop((event.request_id, event.connection_id),
+                                    None)
+        if started is None:
+            return
+        name, collection, database, command = started
+        try:
+            documents = reply_documents(name, event.reply)
+        except Exception:  # Raw BSON replies are not counted
+            documents = 0
+        self._record(name, collection, event.duration_micros, documents)
+        if event.duration_micros >= self.slow_query_ms * 1000:
+            self._log_slow(name, collection, event.duration_micros, command)
+        if explain_client is not None and self.explain_sample_rate > 0 \
+                and name in FILTER_FIELDS \
+                and random.random() < self.explain_sample_rate:
+            self._sample_explain(explain_client, name, collection, database,
+                                 command)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        started = self._started.pop((event.request_id, event.connection_id),
+                                    None)
+        if started is None:
+            return
+        name, collection = started[:2]
+        self._record(name, collection, event.duration_micros, 0)
+        self.counters.add(('errors', name, collection))
+        logger.warning('Command %s on %s failed in %.1fms: %s', name,
+                       collection, event.duration_micros / 1000,
+                       event.failure.get('errmsg', event.failure))
+
+    def _record(self, name: str, collection: str, micros: int,
+                documents: int):
+        seconds = micros / 1e6
+        shard = self.counters.shard()
+        for key, amount in (
+                (('commands', name, collection), 1),
+                (('documents', name, collection), documents),
+                (('bucket', name, collection,
+                  bisect.bisect_left(self.buckets, seconds)), 1),
+                (('sum', name, collection), seconds)):
+            shard[key] = shard.get(key, 0) + amount
+
+    def _log_slow(self, name: str, collection: str, micros: int,
+                  command: Mapping[str, Any]):
+        query = command_filter(name, command)
+        logger.warning('Slow query %s on %s: %.1fms filter %s', name,
+                       collection, micros / 1000,
+                       LazyJson(filter_shape(query)) if query is not None
+                       else '-')
+
+    def _sample_explain(self, explain_client: Callable[[], Any], name: str,
+                        collection: str, database: str,
+                        command: Mapping[str, Any]):
+        """Explains the command in background, once per filter shape."""
+        shape_key = '%s %s %s' % (
+            name, collection,
+            json.dumps(filter_shape(command_filter(name, command))))
+        with self._explain_lock:
+            if shape_key in self._explained \
+                    or len(self._explained) >= self.explain_max_shapes:
+                return
+            self._explained.add(shape_key)
+            if self._explainer is None:
+                self._explainer = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='explain')
+        explained = {key: value for key, value in command.items()
+                     if key not in ('lsid', '$db', '$clusterTime',
+                                    '$readPreference', 'txnNumber')}
+        self._explainer.submit(self._explain, explain_client, shape_key,
+                               collection, database, explained)
+
+    def _explain(self, explain_client: Callable[[], Any], shape_key: str,
+                 collection: str, database: str, command: Dict[str, Any]):
+        try:
+            result = explain_client()[database].command(
+                'explain', command, verbosity='queryPlanner')
+        except Exception as e:
+            logger.info('Explain of %s failed: %s', shape_key, e)
+            return
+        plan = result.get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in plan_stages(plan):
+            self.counters.add(('collscans', collection))
+            logger.warning('Collection scan: %s, index is missing',
+                           shape_key)
+
+    def after_fork(self):
+        self._started = {}
+        self._explained = set()
+        self._explain_lock = threading.Lock()
+        self._explainer = None
+
+
+class ClientCommands(monitoring.CommandListener):
+    """
+    Command listener of one client, recording into the shared monitor.
+    Sampled queries are explained through explain_client, a synchronous
+    client of the same deployment (the delegate of a Motor client).
+    """
+    def __init__(self, monitor: CommandMonitor,
+                 explain_client: Callable[[], Any]):
+        self.monitor = monitor
+        self.explain_client = explain_client
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        self.monitor.started(event)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.monitor.succeeded(event, self.explain_client)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.monitor.failed(event)
+
+
+def command_samples(out: 'metrics.Exposition'):
+    totals = command_monitor.counters.totals()
+    for kind, help_text in (
+            ('commands', 'MongoDB commands, by command and collection.'),
+            ('documents', 'Documents returned or written by commands.'),
+            ('errors', 'Failed MongoDB commands.')):
+        metric = 'mongodb_%s_total' % kind
+        out.family(metric, 'counter', help_text)
+        for key, value in sorted((key[1:], value)
+                                 for key, value in totals.items()
+                                 if key[0] == kind):
+            out.sample(metric, value, command=key[0], collection=key[1])
+    series, sums = metrics.histogram_series(totals, command_monitor.buckets)
+    metrics.histogram_samples(out, 'mongodb_command_duration_seconds',
+                              'MongoDB command latency.',
+                              command_monitor.buckets, series, sums,
+                              ('command', 'collection'))
+    out.family('mongodb_collection_scans_total', 'counter',
+               'Explained queries planned as collection scans.')
+    for key, value in sorted(totals.items()):
+        if key[0] == 'collscans':
+            out.sample('mongodb_collection_scans_total', value,
+                       collection=key[1])
+
+
+command_monitor = CommandMonitor(DB_MONITORING['SLOW_QUERY_MS'],
+                                 DB_MONITORING['EXPLAIN_SAMPLE_RATE'],
+                                 DB_MONITORING['EXPLAIN_MAX_SHAPES'])
+if DB_MONITORING['ENABLED']:
+    metrics.collectors.append(command_samples)
+
+
+def event_listeners(explain_client: Callable[[], Any]) -> List[Any]:
+    """
+    Listeners MongoDB clients of the app are created with. explain_client
+    returns the synchronous client sampled queries are explained with.
+    """
+    listeners: List[Any] = [metrics.pool_listener]
+    if DB_MONITORING['ENABLED']:
+        listeners.append(ClientCommands(command_monitor, explain_client))
+    return listeners
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=command_monitor.after_fork)
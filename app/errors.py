@@ -1,44 +1,70 @@
 """
 This module contains all high level server errors.
+Error fields are class attributes, an instance only carries a custom
+message_json and its debug_id, which is made on first use.
 """
+import itertools
+import os
 from uuid import uuid4
 
 
+class DebugIds:
+    """
+    Makes unique ids: a random uuid4 prefix of the process
+    and a counter, no urandom call per id.
+    """
+    def __init__(self):
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self._prefix = str(uuid4())[:24]
+        self._counter = itertools.count()
+
+    def next(self) -> str:
+        return '%s%012x' % (self._prefix, next(self._counter))
+
+
+debug_ids = DebugIds()
+
+
 class ServerError(Exception):
     """
     Base class for all server errors.
     """
-    pass
+    status_code = 500
+    name_json = 'ERR_SERVER'
+    message_json = ''
+    information_link_json = None
+    links_json = None
+    _debug_id = None
+
+    @property
+    def debug_id_json(self) -> str:
+        if self._debug_id is None:
+            self._debug_id = debug_ids.next()
+        return self._debug_id
 
 
 class UserNotFound(ServerError):
     """
     Implements 404 HTTP Not Found
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 404
-        self.name_json = 'ERR_USER_NOT_FOUND'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'The User you are requesting ' \
-                            'is not found or does not exist.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 404
+    name_json = 'ERR_USER_NOT_FOUND'
+    message_json = 'The User you are requesting ' \
+                   'is not found or does not exist.'
 
 
 class InternalServerError(ServerError):
     """
     Implements 500 Internal Server HTTP Error
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 500
-        self.name_json = 'ERR_SERVER_INTERNAL'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'Internal server error. ' \
-                            'No additional info will be provided.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 500
+    name_json = 'ERR_SERVER_INTERNAL'
+    message_json = 'Internal server error. ' \
+                   'No additional info will be provided.'
 
 
 class RequestValidationError(ServerError):
@@ -52,96 +78,79 @@ class BadRequest(RequestValidationError):
     """
     Implements 400 Bad Request Entity HTTP Error
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 400
+    status_code = 400
 
 
 class BadRequestBody(BadRequest):
     """
     Implements bad body error
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.name_json = 'ERR_IN_BODY'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'You are requesting user ' \
-                            'with a wrong body scheme.'
-        self.information_link_json = None
-        self.links_json = None
+    name_json = 'ERR_IN_BODY'
+    message_json = 'You are requesting user ' \
+                   'with a wrong body scheme.'
 
 
 class BadRequestQuery(BadRequest):
     """
     Implements error in request query
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.name_json = 'ERR_IN_QUERY'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'You are requesting user ' \
-                            'with a wrong request parameters.'
-        self.information_link_json = None
-        self.links_json = None
+    name_json = 'ERR_IN_QUERY'
+    message_json = 'You are requesting user ' \
+                   'with a wrong request parameters.'
 
 
 class WrongMethod(RequestValidationError):
     """
     Implements error in request method
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 405
-        self.name_json = 'ERR_HTTP_METHOD'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'You are requesting user with WrongMethod.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 405
+    name_json = 'ERR_HTTP_METHOD'
+    message_json = 'You are requesting user with WrongMethod.'
 
 
 class AcceptTypeError(RequestValidationError):
     """
     Implements error in Accept header field
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 406
-        self.name_json = 'ERR_TYPE_NOT_SUPPORTED'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'Accept header is provided but ' \
-                            'application/json is not requested. ' \
-                            'Make a request with Accept: application/json'\
-                            ' header or with no Accept header at all.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 406
+    name_json = 'ERR_TYPE_NOT_SUPPORTED'
+    message_json = 'Accept header is provided but ' \
+                   'application/json is not requested. ' \
+                   'Make a request with Accept: application/json' \
+                   ' (or application/msgpack, application/bson)' \
+                   ' header or with no Accept header at all.'
 
 
 class ContentTypeError(RequestValidationError):
     """
     Implements error in Content-Type header field
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 415
-        self.name_json = 'ERR_UNSUPPORTED_MEDIA_TYPE'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'Content-Type header is provided but ' \
-                            'application/json is not requested. Make a ' \
-                            'request with Content-Type: application/json '\
-                            'header or with no Content-Type header at all.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 415
+    name_json = 'ERR_UNSUPPORTED_MEDIA_TYPE'
+    message_json = 'Content-Type header is provided but ' \
+                   'application/json is not requested. Make a ' \
+                   'request with Content-Type: application/json ' \
+                   '(or application/msgpack, application/bson) ' \
+                   'header or with no Content-Type header at all.'
+
+
+class Forbidden(ServerError):
+    """
+    Implements 403 Forbidden HTTP Error
+    """
+    status_code = 403
+    name_json = 'ERR_FORBIDDEN'
+    message_json = 'X-Admin-Token header is missing or wrong.'
 
 
 class ExternalResource(ServerError):
     """
     Implements 422 Unprocessable Entity HTTP Error
     """
-    def __init__(self, message=''):
-        super().__init__(message)
-        self.status_code = 422
-        self.name_json = 'ERR_EXTERNAL_RESOURCE'
-        self.debug_id_json = str(uuid4())
-        self.message_json = 'The requested action cannot be performed.'
-        self.information_link_json = None
-        self.links_json = None
+    status_code = 422
+    name_json = 'ERR_EXTERNAL_RESOURCE'
+    message_json = 'The requested action cannot be performed.'
+
+
+# Errors caused by the client, logged without traceback
+CLIENT_ERRORS = (RequestValidationError, UserNotFound, Forbidden)
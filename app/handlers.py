@@ -5,33 +5,50 @@ import os
 
 from bottle import (
     static_file, template, request,
-    Response, BaseResponse,
+    HTTPResponse, Response, BaseResponse,
 )
 from typing import Union, Optional, Tuple, Any
 
+from compression import precompressed_static_file
+from metrics import render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from profiler import admin_action
+from timing import timed, PARSE
 from db_adaptor import (
-    count_tot_users, find_one_by_email,
+    count_tot_users, find_one_by_email, find_raw_user,
     read_by_uuid, delete_by_uuid, make_drop
 )
 import errors
 from config import (
-    SUPPORTED_METHODS
+    SUPPORTED_METHODS,
+    SUPPORTED_CONTENT_TYPE,
+    PAGINATION
 )
 from processors import (
-    process_list_users, process_update_user,
-    process_post_user, process_post_users
+    process_list_users, process_update_user, process_stream_users,
+    process_post_user, process_post_users, process_list_users_json,
+    process_stream_users_json, process_read_user_json
 )
 from validators import (
     validate_request_headers,
     validate_user_uuid,
     validate_json_object,
+    validate_json_objects,
     validate_request_method,
-    validate_user_email
+    validate_user_email,
+    validate_page_query,
+    validate_stream_query
 )
 from scripts import (
     log_exception,
     json_error_response,
     json_response,
+    json_stream_response,
+    conditional_json_response,
+    user_etag,
+    page_etag,
+    loads_body,
+    wants_bson,
+    raw_reads,
     load_definitions_yaml
 )
 
@@ -44,10 +61,42 @@ def get_spec_digest() -> Tuple[Any, Any]:
     return keys_to_digest, user_obj_spec
 
 
+@timed(PARSE)
+def read_request_body() -> Any:
+    """Loads request body, json or msgpack/bson by its Content-Type."""
+    content_type = request.content_type.split(';')[0].strip().lower()
+    if content_type and content_type != SUPPORTED_CONTENT_TYPE:
+        return loads_body(request.body.read(), content_type)
+    return request.json
+
+
 def serve_static(filename: str) -> static_file:
     """Serves to filenames from static folder."""
     my_root = os.path.join(os.getcwd(), 'static')
-    return static_file(filename, root=my_root)
+    return precompressed_static_file(filename, my_root,
+                                     request.get_header('Accept-Encoding'))
+
+
+def serve_metrics() -> HTTPResponse:
+    """Metrics of the worker in Prometheus text format."""
+    return HTTPResponse(body=render_metrics(),
+                        headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+def profiler_admin(action: str) -> HTTPResponse:
+    """Starts, stops the profiler or sends its samples."""
+    try:
+        body, content_type = admin_action(
+            action, request.method, request.get_header('X-Admin-Token'),
+            request.query.get('seconds')
+        )
+    except (errors.Forbidden, errors.WrongMethod,
+            errors.BadRequestQuery) as e:
+        log_exception(e)
+        return json_error_response(e)
+    if content_type is None:
+        return json_response(body)
+    return HTTPResponse(body=body, headers={'Content-Type': content_type})
 
 
 definitions = load_definitions_yaml()
@@ -92,6 +141,8 @@ def by_uuid(user_uuid: str) -> Union[Response, None]:
       responses:
         '200':
           description: OK
+        '304':
+          description: Not modified, If-None-Match holds current ETag
         '400':
           description: Validation error
           schema:
@@ -117,10 +168,12 @@ def by_uuid(user_uuid: str) -> Union[Response, None]:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(
+    error = validate_request(
         request.headers, request.method,
         SUPPORTED_METHODS['/get_user_by_uuid']
     )
+    if error:
+        return error
     try:  # Validate the UUID parameter
         validate_user_uuid(user_uuid)
     except errors.BadRequestQuery as e:
@@ -130,8 +183,15 @@ def by_uuid(user_uuid: str) -> Union[Response, None]:
 
     if request.method == 'GET':
         try:
-            user = read_by_uuid(user_uuid)
-            return json_response(user)
+            if wants_bson():  # Raw BSON from the driver, sent as is
+                user = fields = find_raw_user({'uuid': user_uuid})
+            elif raw_reads(single_user=True):
+                user, fields = process_read_user_json({'uuid': user_uuid})
+            else:
+                user = fields = read_by_uuid(user_uuid)
+            return conditional_json_response(
+                user, user_etag(fields), request.get_header('If-None-Match')
+            )
         except errors.UserNotFound as e:
             e.message_json = f'User with this ' \
                              f'{user_uuid} was not found.'
@@ -157,6 +217,8 @@ def by_email(user_email: str) -> Union[Response, None]:
       responses:
         '200':
           description: OK
+        '304':
+          description: Not modified, If-None-Match holds current ETag
         '400':
           description: Validation error
           schema:
@@ -182,10 +244,12 @@ def by_email(user_email: str) -> Union[Response, None]:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(
+    error = validate_request(
         request.headers, request.method,
         SUPPORTED_METHODS['/get_user_by_email']
     )
+    if error:
+        return error
     try:  # Validate the email parameter
         validate_user_email(user_email)
     except errors.BadRequestQuery as e:
@@ -195,8 +259,15 @@ def by_email(user_email: str) -> Union[Response, None]:
 
     if request.method == 'GET':
         try:
-            user = find_one_by_email({'email': user_email})
-            return json_response(user)
+            if wants_bson():  # Raw BSON from the driver, sent as is
+                user = fields = find_raw_user({'email': user_email})
+            elif raw_reads(single_user=True):
+                user, fields = process_read_user_json({'email': user_email})
+            else:
+                user = fields = find_one_by_email({'email': user_email})
+            return conditional_json_response(
+                user, user_etag(fields), request.get_header('If-None-Match')
+            )
         except errors.UserNotFound as e:
             e.message_json = f'User with this ' \
                              f'{user_email} was not found.'
@@ -209,10 +280,12 @@ def by_email(user_email: str) -> Union[Response, None]:
 
 def count_users() -> Union[int, None, Response]:
     """Implements GET logic of '/count_users' endpoint"""
-    validate_request(
+    error = validate_request(
         request.headers, request.method,
         SUPPORTED_METHODS['/count_users']
     )
+    if error:
+        return error
 
     if request.method == 'GET':
         try:  # Count users
@@ -228,9 +301,35 @@ def get_total_users() -> BaseResponse:
       tags:
         - userAPI
       summary: Get all system users
+      description: >-
+        Users are returned in pages ordered by uuid. Follow the 'next'
+        link to get the following page. With 'stream' the whole collection
+        is streamed as a chunked JSON array or NDJSON instead.
+      parameters:
+        - name: limit
+          in: query
+          description: Page size
+          required: false
+          type: integer
+        - name: after
+          in: query
+          description: UUID of the last user of the previous page
+          required: false
+          type: string
+        - name: stream
+          in: query
+          description: Stream all users, 'json' or 'ndjson'
+          required: false
+          type: string
       responses:
         '200':
           description: OK
+        '304':
+          description: Not modified, If-None-Match holds current ETag
+        '400':
+          description: Validation error
+          schema:
+            $ref: '#/definitions/Error'
         '405':
           description: Wrong method
           schema:
@@ -248,15 +347,59 @@ def get_total_users() -> BaseResponse:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(  # validation of headers and method
+    error = validate_request(  # validation of headers and method
         request.headers, request.method,
         SUPPORTED_METHODS['/get_total_users']
     )
+    if error:
+        return error
+    stream = request.query.get('stream')
+    if stream is not None and request.method == 'GET':
+        try:  # Stream all system users
+            ndjson = validate_stream_query(stream)
+        except errors.BadRequestQuery as e:
+            e.message_json = f'Wrong stream format: {stream}, ' \
+                             f'should be json or ndjson.'
+            log_exception(e)
+            return json_error_response(e)
+        batch_size = PAGINATION['STREAM_BATCH_SIZE']
+        encoded = raw_reads()
+        users: Any
+        try:  # First batch is read before the response starts
+            if encoded:
+                users = process_stream_users_json(batch_size, ndjson)
+            else:
+                users = process_stream_users(batch_size)
+        except errors.InternalServerError as e:
+            e.message_json = 'Error while reading users'
+            return json_error_response(e)
+        return json_stream_response(users, batch_size, ndjson, encoded)
+
+    try:  # Validate the paging parameters
+        limit, after = validate_page_query(request.query.get('limit'),
+                                           request.query.get('after'))
+    except errors.BadRequestQuery as e:
+        e.message_json = f'Wrong paging parameters, limit should be ' \
+                         f'1..{PAGINATION["MAX_LIMIT"]} and after ' \
+                         f'should be a user UUID.'
+        log_exception(e)
+        return json_error_response(e)
 
     if request.method == 'GET':
-        try:  # Get all system users
-            users_list = process_list_users()
-            return json_response(users_list)
+        try:  # Get a page of system users
+            scheme, netloc, path = request.urlparts[:3]
+            href = f'{scheme}://{netloc}{path}'
+            users_page: Any
+            if raw_reads():
+                users_page, page_fields = process_list_users_json(
+                    href, limit, after)
+            else:
+                users_page = page_fields = process_list_users(
+                    href, limit, after)
+            return conditional_json_response(
+                users_page, page_etag(page_fields),
+                request.get_header('If-None-Match')
+            )
         except errors.InternalServerError as e:
             e.message_json = 'Error while executing find_cursor.'
             return json_error_response(e)
@@ -302,13 +445,15 @@ def post_user() -> Optional[BaseResponse]:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(  # do the validation
+    error = validate_request(  # do the validation
         request.headers, request.method,
         SUPPORTED_METHODS['/post_user']
     )
+    if error:
+        return error
     if request.method == 'POST':
         try:
-            user_to_create = request.json
+            user_to_create = read_request_body()
         except Exception as e:
             log_exception(e)
             return json_error_response(errors.BadRequestBody())
@@ -372,22 +517,23 @@ def post_users() -> Union[BaseResponse, None]:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(  # do the validation
+    error = validate_request(  # do the validation
         request.headers, request.method,
         SUPPORTED_METHODS['/post_users']
     )
+    if error:
+        return error
 
     if request.method == 'POST':
         try:  # Load JSON object
-            users_to_create = request.json
+            users_to_create = read_request_body()
         except Exception as e:
             log_exception(e)
             return json_error_response(errors.BadRequestBody())
 
         try:  # Validate JSON schema
             keys_to_digest, user_obj_spec = get_spec_digest()
-            [validate_json_object(user, user_obj_spec)
-             for user in users_to_create]
+            validate_json_objects(users_to_create, user_obj_spec)
         except errors.BadRequestBody as e:
             log_exception(e)
             return json_error_response(e)
@@ -448,10 +594,12 @@ def update_user(user_uuid: str) -> Union[BaseResponse, None]:
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(  # do the validation
+    error = validate_request(  # do the validation
         request.headers, request.method,
         SUPPORTED_METHODS['/update_user']
     )
+    if error:
+        return error
     try:  # Validate the UUID parameter
         validate_user_uuid(user_uuid)
     except errors.BadRequestQuery as e:
@@ -462,7 +610,7 @@ def update_user(user_uuid: str) -> Union[BaseResponse, None]:
     if request.method == 'PUT':
         # Request new user
         try:
-            new_user = request.json
+            new_user = read_request_body()
         except Exception as e:
             log_exception(e)
             return json_error_response(errors.BadRequestBody())
@@ -507,14 +655,16 @@ def delete_user(user_uuid: str):
           schema:
             $ref: '#/definitions/Error'
     """
-    validate_request(  # do the validation
+    error = validate_request(  # do the validation
         request.headers, request.method,
         SUPPORTED_METHODS['/delete_user']
     )
+    if error:
+        return error
     if request.method == 'DELETE':
         try:
             delete_by_uuid(user_uuid)
-            return Response(status=204)
+            return HTTPResponse(status=204)
         except errors.UserNotFound as e:
             e.message_json = f'User {user_uuid} not found'
             log_exception(e)
@@ -526,10 +676,12 @@ def delete_user(user_uuid: str):
 
 def drop_collection() -> Union[BaseResponse, None]:
     """Drop collection endpoint."""
-    validate_request(  # do the validation
+    error = validate_request(  # do the validation
         request.headers, request.method,
         SUPPORTED_METHODS['/drop_collection']
     )
+    if error:
+        return error
     if request.method == 'POST':
         try:
             result = make_drop()
@@ -0,0 +1,117 @@
+"""
+This module declares indexes of users collection and makes sure they exist.
+It runs at application startup and can be used as a CLI:
+
+    python indexes.py [--check] [--strict]
+"""
+import argparse
+import sys
+import threading
+import time
+from typing import List, Dict, Any, Tuple
+
+from pymongo import ASCENDING
+
+from config import DATABASE
+from db_adaptor import get_db_adaptor, COLLECTION_NAME
+from logger_setup import logger
+from scripts import log_exception
+
+PROGRESS_INTERVAL = 5.0
+
+# name -> (keys, options). Unique indexes are required by the create path.
+INDEXES: Dict[str, Tuple[List[Tuple[str, int]], Dict[str, Any]]] = {
+    'uuid_1': ([('uuid', ASCENDING)], {'unique': True}),
+    'email_1': ([('email', ASCENDING)], {'unique': True}),
+    'digest_1': ([('digest', ASCENDING)], {}),
+}
+REQUIRED_INDEXES = ('uuid_1', 'email_1')
+# Required in any mode: nothing but this index rejects duplicate emails
+ENFORCED_INDEXES = ('email_1',)
+
+
+def missing_indexes() -> List[str]:
+    """Returns names of declared indexes not present in collection."""
+    existing = get_db_adaptor().index_information()
+    return [name for name in INDEXES if name not in existing]
+
+
+def _report_progress(done: threading.Event):
+    """Logs index build progress from $currentOp until done is set."""
+    db_adaptor = get_db_adaptor()
+    while not done.wait(PROGRESS_INTERVAL):
+        try:
+            ops = db_adaptor.current_op(
+                {'command.createIndexes': COLLECTION_NAME}
+            )
+        except Exception as e:
+            log_exception(e)
+            return
+        for op in ops:
+            logger.info("Index build on %s: %s",
+                        COLLECTION_NAME, op.get('msg', 'in progress'))
+
+
+def build_index(name: str) -> bool:
+    """Builds one declared index. Returns False if the build failed."""
+    keys, options = INDEXES[name]
+    logger.info("Building index %s on %s...", name, COLLECTION_NAME)
+    started = time.monotonic()
+    done = threading.Event()
+    reporter = threading.Thread(target=_report_progress, args=(done,),
+                                daemon=True)
+    reporter.start()
+    try:
+        get_db_adaptor().create_index(keys, name=name, **options)
+    except Exception as e:
+        log_exception(e)
+        return False
+    finally:
+        done.set()
+    logger.info("Index %s is ready in %.2fs.",
+                name, time.monotonic() - started)
+    return True
+
+
+def ensure_indexes(create: bool = True, strict: bool = False) -> List[str]:
+    """
+    Makes sure declared indexes exist, building the missing ones
+    if create is set. Returns names of indexes which are still missing.
+    Raises RuntimeError if an enforced index is missing, or in strict
+    mode a required one.
+    """
+    missing = missing_indexes()
+    if create:
+        missing = [name for name in missing if not build_index(name)]
+    for name in missing:
+        logger.warning("Index %s is missing on %s.", name, COLLECTION_NAME)
+
+    required = REQUIRED_INDEXES if strict else ENFORCED_INDEXES
+    missing_required = [name for name in missing if name in required]
+    if missing_required:
+        raise RuntimeError(
+            "Required indexes are missing: " + ", ".join(missing_required)
+        )
+    return missing
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Ensure indexes of %s collection.' % COLLECTION_NAME
+    )
+    parser.add_argument('--check', action='store_true',
+                        help='only report missing indexes, build nothing')
+    parser.add_argument('--strict', action='store_true',
+                        default=DATABASE['STRICT_INDEXES'],
+                        help='fail if a required index is missing')
+    args = parser.parse_args(argv)
+    try:
+        missing = ensure_indexes(create=not args.check, strict=args.strict)
+    except RuntimeError as e:
+        logger.error(e)
+        return 1
+    return 1 if missing and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
 # coding=utf-8
-import logging
+"""
+Logging of the app goes through a queue: the logging thread only
+enqueues records, a listener thread writes them to stderr and as JSON
+lines to a size-rotated file. Records carry the id of their request.
 
-# set up logs to file
+Only the process which configured logging writes. Its forked workers
+send their records to it as datagrams, so one process rotates the file.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import pickle
+import queue
+import socket
 import sys
+from typing import Optional
+
+# Id of the request being served, '-' outside of requests
+request_id = contextvars.ContextVar('request_id', default='-')
 
 
 # Some colors for the console
@@ -20,14 +39,221 @@ class AnsiColors:
     ENDCOLOR = '\033[0m'
 
 
-logformat = "%(asctime)s [%(levelname)s] " \
+logformat = "%(asctime)s [%(levelname)s] [%(request_id)s] " \
             "%(module)s::%(filename)s::%(funcName)s():L%(lineno)s:" \
             + AnsiColors.BLUE + "%(message)s" + AnsiColors.ENDCOLOR
+datefmt = "[%Y-%m-%d %H:%M:%S %z]"
 LOG_FILENAME = 'static/logging.txt'
-logging.basicConfig(filename=LOG_FILENAME, filemode='w')
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Longest record a worker sends, longer messages and tracebacks are cut
+MAX_DATAGRAM = 64 * 1024
+
+
+class LazyJson:
+    """Logging argument, dumped to json only if its record is emitted."""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the request id of the thread logging them."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        if not hasattr(record, 'debug_id'):
+            record.debug_id = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        debug_id = getattr(record, 'debug_id', None)
+        if debug_id:
+            entry['debug_id'] = debug_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records without formatting them. Only the message args are
+    merged and the traceback rendered, as they may not outlive the call.
+    """
+    _traceback_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = \
+                self._traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class WorkerRecords:
+    """
+    Records sent by forked workers over a datagram socket pair. Quacks
+    like the queue of a QueueListener: an empty datagram is its sentinel.
+    Datagrams are never interleaved, and no lock is shared with workers,
+    so a killed worker can not block the others.
+    """
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_DGRAM)
+
+    def get(self, block: bool = True) -> Optional[logging.LogRecord]:
+        data = self.reader.recv(MAX_DATAGRAM)
+        return logging.makeLogRecord(pickle.loads(data)) if data else None
+
+    def put_nowait(self, record: Optional[logging.LogRecord]):
+        self.writer.send(b'' if record is None else pickle_record(record))
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def pickle_record(record: logging.LogRecord) -> bytes:
+    """Pickles a prepared record, cut to fit one datagram."""
+    data = pickle.dumps(vars(record))
+    if len(data) > MAX_DATAGRAM:
+        cut = MAX_DATAGRAM // 16  # characters, up to 4 bytes each
+        data = pickle.dumps(dict(
+            vars(record), msg=str(record.msg)[:cut] + ' [cut]', args=None,
+            exc_text=record.exc_text and record.exc_text[:cut],
+            stack_info=None
+        ))
+    return data
+
+
+class WorkerHandler(logging.Handler):
+    """Sends records of a forked worker to the writing process."""
+    def __init__(self, records: WorkerRecords):
+        super().__init__()
+        self.records = records
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.records.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+def console_handler() -> logging.Handler:
+    handler = logging.StreamHandler(stream=sys.stderr)
+    handler.setFormatter(logging.Formatter(logformat, datefmt=datefmt))
+    return handler
+
+
+def file_handler(filename: str, max_bytes: int,
+                 backup_count: int) -> logging.Handler:
+    handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count,
+        encoding='utf-8', delay=True
+    )
+    handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S%z'))
+    return handler
+
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(ContextFilter())
+listener = None
+# Records of forked workers and the thread writing them, see share_writer()
+worker_records: Optional[WorkerRecords] = None
+worker_listener = None
+
+
+def start_listener(*handlers: logging.Handler):
+    """(Re)starts the writer threads with handlers."""
+    global listener, worker_listener
+    stop_listener()
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    if worker_records is not None:
+        worker_listener = logging.handlers.QueueListener(
+            worker_records, *handlers, respect_handler_level=True)
+        worker_listener.start()
+
+
+def stop_listener():
+    """Writes out queued records, stops the writer threads."""
+    global listener, worker_listener
+    if worker_listener is not None:
+        worker_listener.stop()
+        worker_listener = None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+def configure_logging(filename: str = LOG_FILENAME,
+                      max_bytes: int = LOG_MAX_BYTES,
+                      backup_count: int = LOG_BACKUP_COUNT):
+    """Writes records to stderr and to filename, rotated at max_bytes."""
+    start_listener(console_handler(),
+                   file_handler(filename, max_bytes, backup_count))
+
+
+def share_writer():
+    """
+    Before the first fork of a writing process, opens the socket pair its
+    workers send records through and starts the thread writing them.
+    """
+    global worker_records, worker_listener
+    if listener is not None and worker_records is None:
+        worker_records = WorkerRecords()
+        worker_listener = logging.handlers.QueueListener(
+            worker_records, *listener.handlers, respect_handler_level=True)
+        worker_listener.start()
+
+
+def _forward_after_fork():
+    # Writer threads of the parent are gone, its queue may be locked.
+    # The worker keeps a queue of its own, drained into the socket.
+    global log_queue, listener, worker_listener, worker_records
+    log_queue = queue_handler.queue = queue.SimpleQueue()
+    worker_listener = None
+    if listener is not None and worker_records is not None:
+        worker_records.reader.close()
+        listener = logging.handlers.QueueListener(
+            log_queue, WorkerHandler(worker_records))
+        worker_records = None
+        listener.start()
+
+
 logger = logging.getLogger()
-handler = logging.StreamHandler(stream=sys.stderr)
-formatter = logging.Formatter(logformat, datefmt="[%Y-%m-%d %H:%M:%S %z]")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+logger.addHandler(queue_handler)
 logger.setLevel(logging.DEBUG)
+configure_logging()
+atexit.register(stop_listener)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=share_writer,
+                        after_in_child=_forward_after_fork)
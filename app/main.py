@@ -1,15 +1,24 @@
 from bottle import (
-    Bottle, run, debug
+    Bottle, run, debug, request
 )
-from config import SERVER_SETTINGS
+from compression import CompressionPlugin
+from config import SERVER_SETTINGS, DATABASE, METRICS
+from indexes import ensure_indexes
+from metrics import MetricsPlugin
+from profiler import ADMIN_ACTIONS
+from timing import TimingPlugin
 from logger_setup import logger
-from scripts import load_swagger_yaml, uuid_filter
+from scripts import (
+    load_swagger_yaml, uuid_filter, log_exception,
+    set_pretty_output, set_response_content_type, RequestIdPlugin
+)
+from validators import compile_spec_validators
 
 from handlers import (
     by_uuid, index, drop_collection,
-    get_total_users, by_email,
+    get_total_users, by_email, count_users,
     post_user, post_users, update_user,
-    delete_user, serve_static,
+    delete_user, serve_static, serve_metrics, profiler_admin, definitions,
 )
 
 logger.info({"Message": "Initializing Bottle..."})
@@ -20,12 +29,22 @@ wb = SERVER_SETTINGS['WEB_BASE']
 app.router.add_filter("uuid", uuid_filter)
 swagger_from_yaml = load_swagger_yaml()
 app.config["api.swagger_spec"] = swagger_from_yaml
+compile_spec_validators(swagger_from_yaml, definitions)
+app.install(MetricsPlugin())
+app.install(TimingPlugin())
+app.install(CompressionPlugin())
+app.install(RequestIdPlugin())
+app.add_hook('before_request',
+             lambda: set_pretty_output(request.query.get('pretty')))
+app.add_hook('before_request',
+             lambda: set_response_content_type(request.get_header('Accept')))
 
 
 def setup_routing(app):
     app.route(wb+"/get_user_by_uuid/<user_uuid>", ['GET'], by_uuid)
     app.route(wb+"/get_user_by_email/<user_email>", ['GET'], by_email)
     app.route(wb+"/get_total_users", ['GET'], get_total_users)
+    app.route(wb+"/count_users", ['GET'], count_users)
     app.route(wb+"/home", ['GET'], index)
     app.route(wb+"/post_user", ['POST'], post_user)
     app.route(wb+"/post_users", ['POST'], post_users)
@@ -33,16 +52,46 @@ def setup_routing(app):
     app.route(wb+"/delete_user/<user_uuid>", ['DELETE'], delete_user)
     app.route(wb+"/drop_collection/<col_name>", ['DROP'], drop_collection)
     app.route(wb+"/docs", ['GET'], app.config["api.swagger_spec"])
-    app.route("/static/<filename>", serve_static)
-    app.route("/static/<filename:re:.*\\.css>", serve_static)
-    app.route("/static/<filename:re:.*\\.js>", serve_static)
+    app.route("/static/<filename>", ['GET'], serve_static)
+    app.route("/static/<filename:re:.*\\.css>", ['GET'], serve_static)
+    app.route("/static/<filename:re:.*\\.js>", ['GET'], serve_static)
+    if METRICS['ENABLED']:
+        app.route("/metrics", ['GET'], serve_metrics)
+    app.route("/admin/profiler/<action:re:%s>" % '|'.join(ADMIN_ACTIONS),
+              ['GET', 'POST'], profiler_admin)
+
+
+def setup_indexes():
+    """
+    Builds missing indexes. Stops startup if the email index can not be
+    made sure of, or in strict mode any required index.
+    """
+    try:
+        ensure_indexes(create=DATABASE['ENSURE_INDEXES'],
+                       strict=DATABASE['STRICT_INDEXES'])
+    except Exception as e:
+        log_exception(e)
+        raise
 
 
 setup_routing(app)
+setup_indexes()
 
 # --- Run API-----------------------------------------------
 if __name__ == '__main__':
-    debug(True)
-    run(app=app, host=SERVER_SETTINGS["SERVER_IP"],
-        port=SERVER_SETTINGS["SERVER_PORT"],
-        reloader=True)
+    if SERVER_SETTINGS['SERVER'] == 'prefork':
+        from server import run_prefork
+        if SERVER_SETTINGS['MODE'] == 'asyncio':
+            from async_handlers import make_app
+            run_prefork(make_app())
+        else:
+            run_prefork(app)
+    elif SERVER_SETTINGS['MODE'] == 'asyncio':
+        from async_handlers import run as run_async
+        run_async(host=SERVER_SETTINGS["SERVER_IP"],
+                  port=SERVER_SETTINGS["SERVER_PORT"])
+    else:
+        debug(True)
+        run(app=app, host=SERVER_SETTINGS["SERVER_IP"],
+            port=SERVER_SETTINGS["SERVER_PORT"],
+            reloader=True)
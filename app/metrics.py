@@ -0,0 +1,386 @@
+"""
+This module collects request, cache and MongoDB pool metrics of the
+worker and renders them in Prometheus text exposition format.
+Samples are counted in shards of threads, recording takes no lock;
+shards are summed when /metrics is scraped.
+"""
+import bisect
+import itertools
+import os
+import threading
+import time
+import weakref
+from typing import (
+    Any, Callable, Dict, Hashable, Iterable, Iterator, List, Tuple
+)
+
+from bottle import HTTPResponse, response
+from pymongo import monitoring
+
+from cache import user_cache
+from config import METRICS, DATABASE
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+INF = float('inf')
+
+
+class _ShardOwner:
+    """Referenced by thread local storage only, dies with its thread."""
+    __slots__ = ('__weakref__',)
+
+
+class ShardedCounters:
+    """
+    Counters by key, every thread adds to its own thread local shard.
+    Shards of ended threads are folded into the base counters, so
+    short-lived threads do not pile up.
+    """
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._keys = itertools.count()
+        self._shards: Dict[int, Dict[Any, float]] = {}
+        self._base: Dict[Any, float] = {}
+
+    def shard(self) -> Dict[Any, float]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._new_shard()
+
+    def _new_shard(self) -> Dict[Any, float]:
+        shard: Dict[Any, float] = {}
+        owner = _ShardOwner()
+        key = next(self._keys)
+        with self._lock:
+            self._shards[key] = shard
+        weakref.finalize(owner, self._fold, key)
+        self._local.shard, self._local.owner = shard, owner
+        return shard
+
+    def _fold(self, key: int):
+        """Adds the shard of an ended thread to the base counters."""
+        with self._lock:
+            for name, value in self._shards.pop(key, {}).items():
+                self._base[name] = self._base.get(name, 0) + value
+
+    def add(self, key: Hashable, amount: float = 1):
+        shard = self.shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def totals(self) -> Dict[Any, float]:
+        with self._lock:
+            shards = list(self._shards.values())
+            totals = self._base.copy()
+        for shard in shards:
+            for key, value in shard.copy().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class RequestMetrics:
+    """Request counters, in-flight gauge and latency histograms by route."""
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counters = ShardedCounters()
+
+    def started(self):
+        self.counters.add('in_flight')
+
+    def finished(self, route: str, method: str, status: int,
+                 seconds: float):
+        shard = self.counters.shard()
+        for key, amount in (
+                ('in_flight', -1),
+                (('requests', route, method, status), 1),
+                (('bucket', route,
+                  bisect.bisect_left(self.buckets, seconds)), 1),
+                (('sum', route), seconds)):
+            shard[key] = shard.get(key, 0) + amount
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events of MongoDB clients."""
+    def __init__(self):
+        self.counters = ShardedCounters()
+
+    def _add(self, name: str, event: Any):
+        self.counters.add((name, '%s:%s' % event.address))
+
+    def connection_created(self, event):
+        self._add('created', event)
+
+    def connection_closed(self, event):
+        self._add('closed', event)
+
+    def connection_check_out_started(self, event):
+        self._add('check_out_started', event)
+
+    def connection_checked_out(self, event):
+        self._add('checked_out', event)
+
+    def connection_check_out_failed(self, event):
+        self._add('check_out_failed', event)
+
+    def connection_checked_in(self, event):
+        self._add('checked_in', event)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add('cleared', event)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+request_metrics = RequestMetrics(METRICS['BUCKETS'])
+pool_listener = PoolMetricsListener()
+# Functions adding samples of other modules to /metrics
+collectors: List[Callable[['Exposition'], Any]] = []
+
+
+class ClosingBody:
+    """
+    Body of a streamed response. on_close runs once, when the body is
+    exhausted, fails or is closed by the server.
+    """
+    def __init__(self, body: Iterator[bytes], on_close: Callable[[], Any]):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._body)
+        except BaseException:
+            self._closed()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._closed()
+
+    def _closed(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+
+def is_streamed(body: Any) -> bool:
+    """Tells iterators sent chunk by chunk from bodies and files."""
+    return hasattr(body, '__next__') and not hasattr(body, 'read')
+
+
+class MetricsPlugin:
+    """
+    Bottle plugin recording request metrics of all routes.
+    Streamed responses are recorded once their body is sent.
+    """
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        if not METRICS['ENABLED']:
+            return callback
+        rule, method = route.rule, route.method
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            request_metrics.started()
+            status = 500
+            streamed = False
+
+            def finished():
+                request_metrics.finished(rule, method, status,
+                                         time.perf_counter() - start)
+            try:
+                out = callback(*args, **kwargs)
+                status = out.status_code if isinstance(out, HTTPResponse) \
+                    else response.status_code
+                body = out.body if isinstance(out, HTTPResponse) else out
+                if is_streamed(body):
+                    body = ClosingBody(body, finished)
+                    streamed = True
+                    if isinstance(out, HTTPResponse):
+                        out.body = body
+                    else:
+                        out = body
+                return out
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                if not streamed:
+                    finished()
+        return wrapper
+
+
+def escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in labels.items())
+
+
+def format_value(value: float) -> str:
+    if value == INF:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Exposition:
+    """Lines of metrics in Prometheus text format."""
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def family(self, name: str, kind: str, help_text: str):
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name: str, value: float, **labels: Any):
+        self.lines.append('%s%s %s' % (name, format_labels(labels),
+                                       format_value(value)))
+
+    def render(self) -> bytes:
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
+
+
+def histogram_samples(out: Exposition, name: str, help_text: str,
+                      bounds: Tuple[float, ...],
+                      series: Dict[Tuple[Any, ...], List[float]],
+                      sums: Dict[Tuple[Any, ...], float],
+                      labelnames: Tuple[str, ...]):
+    """
+    Renders histogram name, series hold non-cumulative bucket counts
+    (the last one of +Inf) by label values.
+    """
+    out.family(name, 'histogram', help_text)
+    for values in sorted(series):
+        labels = dict(zip(labelnames, values))
+        cumulative = 0.0
+        for bound, count in zip(bounds + (INF,), series[values]):
+            cumulative += count
+            out.sample(name + '_bucket', cumulative,
+                       **labels, le=format_value(bound))
+        out.sample(name + '_sum', sums.get(values, 0.0), **labels)
+        out.sample(name + '_count', cumulative, **labels)
+
+
+def histogram_series(totals: Dict[Any, float],
+                     bounds: Tuple[float, ...]) \
+        -> Tuple[Dict[Tuple[Any, ...], List[float]],
+                 Dict[Tuple[Any, ...], float]]:
+    """
+    Collects ('bucket', *labels, index) and ('sum', *labels) counters
+    into bucket counts and sums by label values.
+    """
+    series: Dict[Tuple[Any, ...], List[float]] = {}
+    sums: Dict[Tuple[Any, ...], float] = {}
+    for key, value in totals.items():
+        if key[0] == 'bucket':
+            counts = series.setdefault(key[1:-1], [0] * (len(bounds) + 1))
+            counts[key[-1]] += value
+        elif key[0] == 'sum':
+            sums[key[1:]] = value
+    return series, sums
+
+
+def request_samples(out: Exposition, metrics: RequestMetrics):
+    totals = metrics.counters.totals()
+    requests = sorted((key[1:], value) for key, value in totals.items()
+                      if key[0] == 'requests')
+
+    out.family('http_requests_total', 'counter',
+               'Requests served, by route, method and status.')
+    for (route, method, status), value in requests:
+        out.sample('http_requests_total', value,
+                   route=route, method=method, status=status)
+
+    out.family('http_requests_in_flight', 'gauge',
+               'Requests being served.')
+    out.sample('http_requests_in_flight', totals.get('in_flight', 0))
+
+    series, sums = histogram_series(totals, metrics.buckets)
+    histogram_samples(out, 'http_request_duration_seconds',
+                      'Request latency, by route.', metrics.buckets,
+                      series, sums, ('route',))
+
+
+def cache_samples(out: Exposition, stats: Dict[str, int]):
+    for name in ('hits', 'misses', 'evictions'):
+        out.family('user_cache_%s_total' % name, 'counter',
+                   'User cache %s of the worker.' % name)
+        out.sample('user_cache_%s_total' % name, stats[name])
+    lookups = stats['hits'] + stats['misses']
+    out.family('user_cache_hit_ratio', 'gauge',
+               'User cache hits per lookup of the worker.')
+    out.sample('user_cache_hit_ratio',
+               stats['hits'] / lookups if lookups else 0.0)
+    for name in ('entries', 'bytes'):
+        if name in stats:
+            out.family('user_cache_%s' % name, 'gauge',
+                       'User cache %s held.' % name)
+            out.sample('user_cache_%s' % name, stats[name])
+
+
+def pool_samples(out: Exposition, listener: PoolMetricsListener):
+    totals = listener.counters.totals()
+    addresses = sorted({key[1] for key in totals})
+
+    def total(name: str, address: str) -> float:
+        return totals.get((name, address), 0)
+
+    out.family('mongodb_pool_max_size', 'gauge',
+               'Configured connections per pool.')
+    out.sample('mongodb_pool_max_size', DATABASE['MAX_POOL_SIZE'])
+    gauges = (
+        ('mongodb_pool_connections', 'Open connections.',
+         lambda a: total('created', a) - total('closed', a)),
+        ('mongodb_pool_connections_in_use', 'Checked out connections.',
+         lambda a: total('checked_out', a) - total('checked_in', a)),
+        ('mongodb_pool_waiting', 'Threads waiting for a connection.',
+         lambda a: total('check_out_started', a)
+         - total('checked_out', a) - total('check_out_failed', a)),
+    )
+    for name, help_text, value in gauges:
+        out.family(name, 'gauge', help_text)
+        for address in addresses:
+            out.sample(name, value(address), address=address)
+    for name, help_text in (
+            ('check_out_failed', 'Failed connection check outs.'),
+            ('cleared', 'Pool clears.')):
+        metric = 'mongodb_pool_%s_total' % name
+        out.family(metric, 'counter', help_text)
+        for address in addresses:
+            out.sample(metric, total(name, address), address=address)
+
+
+def render_metrics() -> bytes:
+    """All metrics of the worker in Prometheus text format."""
+    out = Exposition()
+    request_samples(out, request_metrics)
+    cache_samples(out, user_cache.stats())
+    pool_samples(out, pool_listener)
+    for collector in collectors:
+        collector(out)
+    return out.render()
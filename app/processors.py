@@ -6,31 +6,200 @@ by caller. All exceptions goes to outer scope.
 """
 import json
 
+from urllib.parse import urlencode
 from typing import (
     Tuple, List, Dict,
     Union, Any, Optional,
-    Iterable, MutableMapping
+    Iterable, Iterator, MutableMapping, Set
 )
 from uuid import uuid4
 
-from scripts import get_digest
+from scripts import get_digest, dumps_json, JSONBytes
+from transcoder import transcode_batch, transcode_document
 from db_adaptor import (
-    update_user, find_one_by_filter,
-    find_one_by_email, insert_user,
-    insert_users, count_tot_users, get_users
+    update_user,
+    find_existing_emails, insert_user,
+    insert_users, count_tot_users, get_users_page,
+    iter_users, INSERTED, DUPLICATE, FAILED, UNKNOWN,
+    find_raw_user, get_raw_users_page, iter_raw_user_batches
 )
 
+# Fields of a user its ETag is made of
+ETAG_FIELDS = ('uuid', 'digest')
+
+
+def page_link(href: str, rel: str, limit: int,
+              after: Optional[str] = None) -> Dict[str, str]:
+    """Returns Link_description object of a users page."""
+    query: Dict[str, Any] = {'limit': limit}
+    if after:
+        query['after'] = after
+    return {
+        'href': href + '?' + urlencode(query),
+        'rel': rel,
+        'method': 'GET',
+        'mediaType': 'application/json',
+    }
 
-def process_list_users() -> Dict[str, Any]:
-    """Returns total users from Users collection. Counts result."""
-    count_users = count_tot_users()
-    users_list = get_users()
 
-    users_collection = {
+def make_user_record(user: Dict[Union[str, int], Any],
+                     fields_to_digest: List[str],
+                     user_uuid: Optional[str] = None) \
+        -> Dict[Union[str, int], Any]:
+    """
+    Returns user record to store: required fields, uuid and their digest.
+    New uuid is generated if user_uuid is not given.
+    """
+    record: Dict[Union[str, int], Any] = {key: value
+                                          for key, value in user.items()
+                                          if key in fields_to_digest}
+    digest: str = get_digest(json.dumps(record))
+    record['uuid'] = user_uuid or 'USER-' + uuid4().hex.upper()
+    record['digest'] = digest
+    return record
+
+
+def make_page_links(href: str, limit: int, after: Optional[str],
+                    next_after: Optional[str]) -> List[Dict[str, str]]:
+    """Returns 'self' link of a users page, and 'next' one if next_after."""
+    links = [page_link(href, 'self', limit, after)]
+    if next_after:
+        links.append(page_link(href, 'next', limit, next_after))
+    return links
+
+
+def make_users_page(count_users: Optional[int],
+                    users_list: List[Dict[Union[str, int], Any]],
+                    href: str, limit: int,
+                    after: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Returns users page object. users_list holds up to limit + 1 users,
+    the extra one tells whether there is a next page.
+    """
+    has_next = len(users_list) > limit
+    users_list = users_list[:limit]
+    links = make_page_links(href, limit, after,
+                            users_list[-1]['uuid'] if has_next else None)
+    return {
         'usersCount': count_users,
         'totalUsers': users_list,
+        'links': links,
+    }
+
+
+def collect_new_users(users_to_add: List[Dict[Union[str, int], Any]],
+                      known_emails: Set[str],
+                      fields_to_digest: List[str]) \
+        -> Tuple[List[Dict[str, Any]], List[MutableMapping[Any, Any]]]:
+    """
+    Returns per-user results in input order and records to insert.
+    Users with known emails are duplicates, first one wins per email.
+    Emails are compared as stored, case-sensitively, the way the unique
+    email index and get_user_by_email compare them.
+    """
+    known_emails = set(known_emails)
+    users_to_insert: List[MutableMapping[Any, Any]] = []
+    results: List[Dict[str, Any]] = []
+    for user in users_to_add:
+        results.append({'email': user['email'], 'status': DUPLICATE})
+        if user['email'] not in known_emails:
+            known_emails.add(user['email'])
+            record = make_user_record(user, fields_to_digest)
+            users_to_insert.append(record)
+            results[-1]['uuid'] = record['uuid']
+    return results, users_to_insert
+
+
+def summarize_post_users(results: List[Dict[str, Any]],
+                         statuses: List[str]) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Merges insert statuses into results of collect_new_users.
+    Returns whether anything was inserted and the summary.
+    Users of UNKNOWN status keep their uuid, to be looked up later.
+    """
+    statuses_iter = iter(statuses)
+    for result in results:
+        if 'uuid' in result:
+            result['status'] = next(statuses_iter)
+            if result['status'] not in (INSERTED, UNKNOWN):
+                del result['uuid']
+
+    summary: Dict[str, Any] = {
+        status: sum(1 for result in results if result['status'] == status)
+        for status in (INSERTED, DUPLICATE, FAILED, UNKNOWN)
+    }
+    summary['results'] = results
+    new = summary[INSERTED] > 0
+    return new, summary
+
+
+def process_list_users(href: str, limit: int,
+                       after: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Returns one page of users from Users collection. Counts result.
+    Pages are ordered by uuid, 'next' link points to the following page.
+    """
+    count_users = count_tot_users()
+    # One extra record tells whether there is a next page
+    users_list = get_users_page(limit + 1, after)
+    return make_users_page(count_users, users_list, href, limit, after)
+
+
+def process_list_users_json(href: str, limit: int,
+                            after: Optional[str] = None) \
+        -> Tuple[JSONBytes, Dict[str, Any]]:
+    """
+    Returns one page of users as json transcoded from raw BSON, and the
+    page object with only uuid and digest of users, to make its ETag.
+    """
+    count_users = count_tot_users()
+    # One extra record tells whether there is a next page
+    users_json, users, count = transcode_batch(
+        get_raw_users_page(limit + 1, after), limit=limit,
+        capture=ETAG_FIELDS
+    )
+    links = make_page_links(href, limit, after,
+                            users[-1]['uuid'] if count > limit else None)
+    page_json = JSONBytes(
+        b'{"usersCount":%s,"totalUsers":[%s],"links":%s}' % (
+            dumps_json(count_users, pretty=False), users_json,
+            dumps_json(links, pretty=False)
+        )
+    )
+    return page_json, {
+        'usersCount': count_users,
+        'totalUsers': users,
+        'links': links,
     }
-    return users_collection
+
+
+def process_stream_users(batch_size: int) \
+        -> Iterator[Dict[Union[str, int], Any]]:
+    """Returns lazy iterator over all users of Users collection."""
+    return iter_users(batch_size)
+
+
+def process_stream_users_json(batch_size: int, ndjson: bool = False) \
+        -> Iterator[bytes]:
+    """
+    Returns lazy iterator over all users of Users collection, as batches
+    of json array items (or NDJSON lines) transcoded from raw BSON.
+    """
+    batches = iter_raw_user_batches(batch_size)
+    return (transcode_batch(batch, ndjson=ndjson)[0] for batch in batches)
+
+
+def process_read_user_json(search_filter: Dict[Union[str, int], Any]) \
+        -> Tuple[Optional[JSONBytes], Dict[str, Any]]:
+    """
+    Returns user as json transcoded from raw BSON, and its uuid
+    and digest, to make its ETag.
+    """
+    user = find_raw_user(search_filter)
+    if user is None:
+        return None, {}
+    user_json, fields = transcode_document(user.raw, capture=ETAG_FIELDS)
+    return JSONBytes(user_json), fields
 
 
 def process_update_user(user_uuid: str,
@@ -38,17 +207,7 @@ def process_update_user(user_uuid: str,
                         keys_to_digest: List[str]) \
                         -> Optional[Dict[Union[str, int], Any]]:
     """Updates user by given fields. Searches by uuid."""
-    obj_to_digest = {key: value
-                     for key, value in new_user.items()
-                     if key in keys_to_digest}
-    new_digest: str = get_digest(json.dumps(obj_to_digest))
-
-    # Update a user and return
-    user_to_db = {key: value
-                  for key, value in new_user.items()
-                  if key in keys_to_digest}
-    user_to_db['uuid'] = user_uuid
-    user_to_db['digest'] = new_digest
+    user_to_db = make_user_record(new_user, keys_to_digest, user_uuid)
     updated_user = update_user(user_uuid, user_to_db)
     return updated_user
 
@@ -56,56 +215,37 @@ def process_update_user(user_uuid: str,
 def process_post_user(user_to_create: Dict[Union[str, int], Any],
                       fields_to_digest: List[str]) \
         -> Tuple[bool, Union[str, Optional[Dict[Union[str, int], Any]]]]:
-    """Adds only one user to collection"""
+    """
+    Adds only one user to collection, in one round trip.
+    Existing email is detected by the unique email index.
+    """
     user_email = user_to_create.get('email')
-    exists = find_one_by_filter({'email': user_email})
-    if exists:
+    # Insert a record in DB then return user
+    record = make_user_record(user_to_create, fields_to_digest)
+    user_id = insert_user(record)
+    if user_id is None:
         new: bool = False
         return new, f"User with email: {user_email}, is in the DB."
 
-    # If same digest in the DB, then return this record.
-    required_fields_digest = {key: value
-                              for key, value in
-                              user_to_create.items()
-                              if key in fields_to_digest}
-    digest: str = get_digest(json.dumps(required_fields_digest))
-
-    # Insert a record in DB then return user
-    required_fields_digest['uuid'] = 'USER-' + uuid4().hex.upper()
-    required_fields_digest['digest'] = digest
-    user_id: str = insert_user(required_fields_digest)
-    created_user = find_one_by_filter({'_id': user_id})
+    # insert_one has added _id to the document, it is never returned
+    record.pop('_id', None)
     new = True
-    return new, created_user
+    return new, record
 
 
 def process_post_users(users_to_add: Iterable[Dict[Union[str, int], Any]],
                        fields_to_digest: List[str]) \
-                       -> Tuple[bool, Union[str, List[str]]]:
-    """ Adds new users to Users collection."""
-    new_users_emails = [user['email'].lower() for user in users_to_add]
-    known_emails = [find_one_by_email({'email': user_email})
-                    for user_email in new_users_emails]
-    unknown_emails = set(new_users_emails) ^ set(known_emails)
-
-    if not unknown_emails:
-        new = False
-        return new, "No new users, nothing to add."
-
-    # if we have new emails, - collect users
-    users_to_insert: List[MutableMapping[Any, Any]] = []
-    for user in users_to_add:
-        if user['email'] in unknown_emails:
-            # If same digest in the DB then return this record
-            required_fields_digest = {key: value
-                                      for key, value in user.items()
-                                      if key in fields_to_digest}
-            digest: str = get_digest(json.dumps(required_fields_digest))
-            # Insert a record in DB then return this record
-            required_fields_digest['uuid'] = 'USER-' + uuid4().hex.upper()
-            required_fields_digest['digest'] = digest
-            users_to_insert.append(required_fields_digest)
-    # if we have new users, - insert
-    result = insert_users(users_to_insert)
-    new = True
-    return new, result
+                       -> Tuple[bool, Dict[str, Any]]:
+    """
+    Adds new users to Users collection.
+    Returns per-user results in input order and their summary.
+    """
+    users_to_add = list(users_to_add)
+    known_emails = find_existing_emails(
+        {user['email'] for user in users_to_add}
+    )
+    results, users_to_insert = collect_new_users(
+        users_to_add, known_emails, fields_to_digest
+    )
+    statuses = insert_users(users_to_insert)
+    return summarize_post_users(results, statuses)
@@ -0,0 +1,266 @@
+"""
+This module is a statistical profiler of the worker. A daemon thread
+takes stacks of all other threads every PROFILER['INTERVAL'] seconds
+and counts them per second for the last PROFILER['WINDOW'] seconds.
+Counts are rendered as collapsed stacks or as a flamegraph SVG.
+"""
+import collections
+import hashlib
+import hmac
+import html
+import os
+import sys
+import sysconfig
+import threading
+import time
+from typing import Any, Counter, Deque, Dict, List, Optional, Tuple
+
+import errors
+from config import PROFILER
+
+# (file name, function) of frames, where a thread waits doing nothing
+IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'),
+    ('selectors.py', 'poll'), ('socket.py', 'accept'),
+    ('queue.py', 'get'), ('base_events.py', '_run_once'),
+    ('handlers.py', 'dequeue'), ('thread.py', '_worker'),
+}
+STDLIB = sysconfig.get_paths()['stdlib'] + os.sep
+FLAMEGRAPH_WIDTH = 1200
+FRAME_HEIGHT = 16
+# Admin route actions and their methods
+ADMIN_ACTIONS = {
+    'start': 'POST', 'stop': 'POST', 'status': 'GET',
+    'collapsed': 'GET', 'flamegraph': 'GET',
+}
+
+
+def frame_label(code: Any) -> str:
+    """module:function of a code object, packages kept for libraries."""
+    path = code.co_filename
+    if 'site-packages' in path:
+        path = path.split('site-packages', 1)[1].lstrip(os.sep)
+    elif path.startswith(STDLIB):
+        path = path[len(STDLIB):]
+    else:
+        path = os.path.basename(path)
+    if path.endswith('.py'):
+        path = path[:-3]
+    return '%s:%s' % (path.replace(os.sep, '.'), code.co_name)
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads but its own."""
+    def __init__(self, interval: float, window: int):
+        self.interval = interval
+        self.window = window
+        self._lock = threading.Lock()
+        # (second, stack counts of that second), oldest first
+        self._seconds: Deque[Tuple[int, Counter[str]]] = \
+            collections.deque(maxlen=window)
+        self._labels: Dict[Any, str] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Counts current stacks of other threads."""
+        own = threading.get_ident()
+        stacks = [self._collapse(frame)
+                  for thread_id, frame in sys._current_frames().items()
+                  if thread_id != own]
+        second = int(time.time())
+        with self._lock:
+            if not self._seconds or self._seconds[-1][0] != second:
+                self._seconds.append((second, collections.Counter()))
+            counts = self._seconds[-1][1]
+            for stack in stacks:
+                if stack:
+                    counts[stack] += 1
+            self.samples += 1
+
+    def _collapse(self, frame: Any) -> Optional[str]:
+        """Stack of frame, root first, joined by ';'. None if idle."""
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+            return None
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = frame_label(code)
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def collapsed(self, seconds: int) -> Counter[str]:
+        """Stack counts of the last seconds."""
+        since = int(time.time()) - seconds
+        total: Counter[str] = collections.Counter()
+        with self._lock:
+            recent = [counts.copy() for second, counts in self._seconds
+                      if second > since]
+        for counts in recent:
+            total.update(counts)
+        return total
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'window': self.window,
+            'samples': self.samples,
+        }
+
+    def after_fork(self):
+        """Threads do not survive fork, the sampler is restarted."""
+        was_running = self._thread is not None
+        self._lock = threading.Lock()
+        self._seconds.clear()
+        self._thread = None
+        self.samples = 0
+        if was_running:
+            self.start()
+
+
+def render_collapsed(counts: Counter[str]) -> bytes:
+    """Collapsed stacks, as flamegraph.pl and speedscope read them."""
+    return ''.join('%s %d\n' % (stack, count)
+                   for stack, count in sorted(counts.items())).encode()
+
+
+def frame_color(label: str) -> str:
+    digest = hashlib.md5(label.encode()).digest()
+    return 'rgb(%d,%d,%d)' % (205 + digest[0] % 50, 80 + digest[1] % 150,
+                              digest[2] % 60)
+
+
+def render_flamegraph(counts: Counter[str], title: str) -> bytes:
+    """Flamegraph SVG of stack counts, root at the bottom."""
+    root: Dict[str, Any] = {}
+    for stack, count in counts.items():
+        node = root
+        for label in stack.split(';'):
+            entry = node.setdefault(label, [0, {}])
+            entry[0] += count
+            node = entry[1]
+    total = sum(counts.values()) or 1
+    scale = FLAMEGRAPH_WIDTH / total
+    rects: List[str] = []
+
+    def depth_of(node: Dict[str, Any]) -> int:
+        return 1 + max((depth_of(entry[1]) for entry in node.values()),
+                       default=0)
+
+    depth = depth_of(root)
+    height = (depth + 2) * FRAME_HEIGHT
+
+    def draw(node: Dict[str, Any], x: float, level: int):
+        for label, (count, children) in sorted(node.items()):
+            width = count * scale
+            if width >= 0.5:
+                y = height - (level + 1) * FRAME_HEIGHT
+                name = html.escape(label)
+                text = name if len(label) * 7 < width - 4 \
+                    else html.escape(label[:max(int(width - 4) // 7 - 2,
+                                                0)]) + '..'
+                rects.append(
+                    '<g><title>%s (%d samples, %.2f%%)</title>'
+                    '<rect x="%.1f" y="%d" width="%.1f" height="%d" '
+                    'fill="%s"/>%s</g>' % (
+                        name, count, 100.0 * count / total, x, y, width,
+                        FRAME_HEIGHT - 1, frame_color(label),
+                        '<text x="%.1f" y="%d">%s</text>' % (
+                            x + 2, y + FRAME_HEIGHT - 4, text)
+                        if width > 20 else ''))
+                draw(children, x, level + 1)
+            x += width
+
+    draw(root, 0.0, 0)
+    return (
+        '<?xml version="1.0" standalone="no"?>\n'
+        '<svg version="1.1" xmlns="http://www.w3.org/2000/svg" '
+        'width="%d" height="%d" font-family="Verdana" font-size="12">'
+        '<text x="%d" y="%d" text-anchor="middle" font-size="14">%s'
+        '</text>%s</svg>\n' % (
+            FLAMEGRAPH_WIDTH, height, FLAMEGRAPH_WIDTH // 2, FRAME_HEIGHT,
+            html.escape(title), ''.join(rects))
+    ).encode('utf-8')
+
+
+def check_admin_token(token: Optional[str]):
+    """Raises errors.Forbidden unless token is the configured one."""
+    expected = PROFILER['ADMIN_TOKEN']
+    if not expected or token is None \
+            or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise errors.Forbidden()
+
+
+def window_seconds(seconds: Optional[str]) -> int:
+    """?seconds of a download, the whole window by default."""
+    if seconds is None:
+        return profiler.window
+    if not seconds.isdigit() or not 0 < int(seconds) <= profiler.window:
+        e = errors.BadRequestQuery()
+        e.message_json = 'Wrong seconds parameter, it should be ' \
+                         '1..%d.' % profiler.window
+        raise e
+    return int(seconds)
+
+
+def admin_action(action: str, method: str, token: Optional[str],
+                 seconds: Optional[str]) -> Tuple[Any, Optional[str]]:
+    """
+    Runs profiler admin action. Returns body and its content type,
+    None content type for a status object sent as json.
+    """
+    check_admin_token(token)
+    if ADMIN_ACTIONS[action] != method:
+        raise errors.WrongMethod()
+    if action == 'start':
+        profiler.start()
+    elif action == 'stop':
+        profiler.stop()
+    elif action == 'collapsed':
+        counts = profiler.collapsed(window_seconds(seconds))
+        return render_collapsed(counts), 'text/plain; charset=utf-8'
+    elif action == 'flamegraph':
+        window = window_seconds(seconds)
+        counts = profiler.collapsed(window)
+        return render_flamegraph(
+            counts, 'Worker %d, last %d s, %d samples' % (
+                os.getpid(), window, sum(counts.values()))
+        ), 'image/svg+xml'
+    return profiler.status(), None
+
+
+profiler = SamplingProfiler(PROFILER['INTERVAL'], PROFILER['WINDOW'])
+if PROFILER['ENABLED']:
+    profiler.start()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=profiler.after_fork)
@@ -1,14 +1,59 @@
 import yaml
 import json
 import hashlib
+import re
+import contextvars
+import calendar
+import datetime
+import functools
+import threading
+import time
 
-from bottle import Response, BaseResponse
-from bson import json_util
-from typing import Union, Dict, Any, Optional
+import bson
+from bottle import HTTPResponse, BaseResponse, request, response
+from bson import json_util, ObjectId
+from bson.raw_bson import RawBSONDocument
+from typing import (
+    Union, Dict, Any, Optional,
+    Iterable, Iterator, List, Mapping, Tuple
+)
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, stdlib json is the fallback
+    orjson = None  # type: ignore
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, not negotiated without it
+    msgpack = None
 
 import errors
 import config
-from logger_setup import logger
+from logger_setup import logger, request_id
+from timing import timed, SERIALIZE, PARSE
+
+# Set per request from ?pretty=1, see set_pretty_output()
+pretty_output: contextvars.ContextVar = contextvars.ContextVar(
+    'pretty_output', default=False
+)
+
+# Set per request from Accept header, see set_response_content_type()
+response_content_type: contextvars.ContextVar = contextvars.ContextVar(
+    'response_content_type', default=config.SUPPORTED_CONTENT_TYPE
+)
+
+# Request ids taken from clients, others are made by request_ids
+REQUEST_ID_PATTERN = re.compile(r'[\w.:-]{1,128}', re.ASCII)
+request_ids = errors.DebugIds()
+
+# Places of debug_id and message in prebuilt error bodies,
+# see error_body_parts()
+DEBUG_ID_MARK = '<debug_id>'
+MESSAGE_MARK = '<message>'
+
+# BSON bodies are documents, other values travel as {'data': value}
+BSON_DATA_KEY = 'data'
 
 AnyExcCls = Union[
     Exception, errors.InternalServerError, errors.BadRequestBody,
@@ -44,30 +89,426 @@ def load_definitions_yaml():
         return yaml.load(f, Loader=yaml.FullLoader)
 
 
+class LogRateLimiter:
+    """
+    Lets through up to rate records of each key per interval seconds
+    and counts the suppressed ones.
+    """
+    def __init__(self, rate: int, interval: float):
+        self.rate = rate
+        self.interval = interval
+        self._lock = threading.Lock()
+        # key -> [window start, records let through, records suppressed]
+        self._windows: Dict[Any, List[Any]] = {}
+
+    def allow(self, key: Any) -> Tuple[bool, int]:
+        """
+        Returns whether a record of key is let through, and how many
+        were suppressed in the previous window of key.
+        """
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                self._windows[key] = [now, 1, 0]
+                return True, window[2] if window else 0
+            if window[1] < self.rate:
+                window[1] += 1
+                return True, 0
+            window[2] += 1
+            return False, 0
+
+
+exception_log_limiter = LogRateLimiter(config.LOG['ERRORS_PER_INTERVAL'],
+                                       config.LOG['ERROR_INTERVAL'])
+
+
 def log_exception(e: AnyExcCls) -> Any:
-    # Log_exception by Logging module.
-    return logger.exception(e)
+    """
+    Logs e, rate limited per exception type. Errors caused by the client
+    are logged at INFO without traceback, others with it. Records carry
+    the debug_id of e.
+    """
+    allowed, suppressed = exception_log_limiter.allow(type(e))
+    if not allowed:
+        return None
+    note = ' (%d more suppressed)' % suppressed if suppressed else ''
+    extra = {'debug_id': getattr(e, 'debug_id_json', None)}
+    if isinstance(e, errors.CLIENT_ERRORS):
+        return logger.info('%s %s: %s%s', e.status_code, e.name_json,
+                           e.message_json, note, extra=extra)
+    return logger.exception('%s%s', e, note, extra=extra)
+
+
+def bson_default(obj: Any) -> Any:
+    """
+    Encodes BSON types the way json_util does. ObjectId and datetime are
+    handled here, json_util.default is only a fallback for rare types.
+    """
+    if isinstance(obj, ObjectId):
+        return {'$oid': str(obj)}
+    if isinstance(obj, datetime.datetime):
+        # Integer math of json_util, floats would be off before 1970
+        offset = obj.utcoffset()
+        if offset is not None:
+            obj = obj - offset
+        return {'$date': calendar.timegm(obj.timetuple()) * 1000
+                + obj.microsecond // 1000}
+    return json_util.default(obj)
+
+
+def set_pretty_output(pretty: Optional[str]):
+    """Pretty-prints responses of current request, if ?pretty is given."""
+    pretty_output.set(pretty is not None
+                      and (pretty == '' or config.to_boolean(pretty)))
+
+
+def set_request_id(header: Optional[str]) -> str:
+    """
+    Sets id of current request, which log records carry: the one from
+    X-Request-ID header if it is sane, a new one otherwise.
+    """
+    if header is None or not REQUEST_ID_PATTERN.fullmatch(header):
+        header = request_ids.next()
+    request_id.set(header)
+    return header
+
+
+class RequestIdPlugin:
+    """Bottle plugin giving every request an id, echoed in X-Request-ID."""
+    name = 'request_id'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            rid = set_request_id(request.get_header(config.REQUEST_ID_HEADER))
+            out = callback(*args, **kwargs)
+            resp = out if isinstance(out, HTTPResponse) else response
+            resp.set_header(config.REQUEST_ID_HEADER, rid)
+            return out
+        return wrapper
+
+
+class JSONBytes(bytes):
+    """Compact json, encoded already. Sent as is unless pretty is asked."""
+
+
+def wants_compact_json() -> bool:
+    """Tells whether current request is answered with compact json."""
+    return response_content_type.get() == config.SUPPORTED_CONTENT_TYPE \
+        and not pretty_output.get()
+
+
+def raw_reads(single_user: bool = False) -> bool:
+    """
+    Tells whether users of current request are read as raw BSON and
+    transcoded to json. Single users are, only if the cache is disabled.
+    """
+    return config.DATABASE['RAW_READS'] and wants_compact_json() \
+        and not (single_user and config.CACHE['ENABLED'])
+
+
+@timed(SERIALIZE)
+def dumps_json(obj: Any, pretty: Optional[bool] = None) -> bytes:
+    """
+    Serializes obj (BSON types included) as compact json bytes,
+    indented with sorted keys if pretty (by default of current request).
+    """
+    if pretty is None:
+        pretty = pretty_output.get()
+    if isinstance(obj, JSONBytes):
+        if not pretty:
+            return obj
+        obj = json.loads(obj)
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0
+        # datetimes go through bson_default, as json_util encodes them
+        return orjson.dumps(obj, default=bson_default,
+                            option=option | orjson.OPT_PASSTHROUGH_DATETIME)
+    if pretty:
+        return json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False,
+                          default=bson_default).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                      default=bson_default).encode('utf-8')
+
+
+def body_content_types() -> List[str]:
+    """Returns content types of bodies this process can encode."""
+    return [content_type for content_type in config.BODY_CONTENT_TYPES
+            if content_type != config.MSGPACK_CONTENT_TYPE
+            or msgpack is not None]
+
+
+def negotiate_content_type(accept: Optional[str]) -> Optional[str]:
+    """
+    Returns the body content type Accept header prefers, json if there
+    is no header. Returns None if Accept allows none of them.
+    """
+    if not accept:
+        return config.SUPPORTED_CONTENT_TYPE
+    weights = {}
+    for item in accept.split(','):
+        media_range, *params = item.split(';')
+        weight = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[media_range.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for content_type in body_content_types():
+        # The most specific media range decides, ties keep json first
+        for media_range in (content_type,
+                            content_type.split('/')[0] + '/*', '*/*'):
+            if media_range in weights:
+                if weights[media_range] > best_weight:
+                    best, best_weight = content_type, weights[media_range]
+                break
+    return best
+
+
+def set_response_content_type(accept: Optional[str]):
+    """Encodes responses of current request as Accept header prefers."""
+    response_content_type.set(negotiate_content_type(accept)
+                              or config.SUPPORTED_CONTENT_TYPE)
+
+
+def wants_bson() -> bool:
+    """Tells whether current request is answered with BSON."""
+    return response_content_type.get() == config.BSON_CONTENT_TYPE
+
+
+def dumps_bson(obj: Any) -> bytes:
+    """
+    Encodes obj as a BSON document. Raw documents from the driver are
+    passed as they are, without decoding.
+    """
+    if isinstance(obj, RawBSONDocument):
+        return bytes(obj.raw)
+    if not isinstance(obj, Mapping):
+        obj = {BSON_DATA_KEY: obj}
+    return bson.encode(obj)
+
+
+@timed(SERIALIZE)
+def dumps_body(obj: Any) -> bytes:
+    """Encodes obj in the negotiated content type of current request."""
+    if isinstance(obj, JSONBytes) \
+            and response_content_type.get() != config.SUPPORTED_CONTENT_TYPE:
+        obj = json.loads(obj)
+    if wants_bson():
+        return dumps_bson(obj)
+    if response_content_type.get() == config.MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(obj, default=bson_default, use_bin_type=True)
+    return dumps_json(obj)
+
+
+@timed(PARSE)
+def loads_body(data: bytes, content_type: Optional[str]) -> Any:
+    """Decodes request body of json, msgpack or bson content type."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == config.BSON_CONTENT_TYPE:
+        obj = bson.decode(data)
+        if list(obj) == [BSON_DATA_KEY]:
+            return obj[BSON_DATA_KEY]
+        return obj
+    if content_type == config.MSGPACK_CONTENT_TYPE and msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
 
 
 def json_response(obj: Any, status: int = 200,
                   headers: Optional[dict] = None) -> BaseResponse:
-    """Makes right json response message."""
-    json_text = json_util.dumps(obj, indent=2,
-                                sort_keys=True,
-                                ensure_ascii=False)
-    return Response(body=json_text, content_type='application/json',
-                    status=status, headers=headers)
+    """
+    Makes right json response message. The body is msgpack or bson
+    instead, if the client asked for them.
+    """
+    headers = dict(headers or {}, Vary='Accept')
+    return HTTPResponse(body=dumps_body(obj),
+                        content_type=response_content_type.get(),
+                        status=status, headers=headers)
+
+
+def representation_etag(etag: str) -> str:
+    """
+    Tells apart ETags of compact json, pretty json, msgpack and bson
+    bodies of one object.
+    """
+    content_type = response_content_type.get()
+    if content_type != config.SUPPORTED_CONTENT_TYPE:
+        return '%s-%s"' % (etag[:-1], content_type.split('/')[1])
+    if pretty_output.get():
+        return '%s-pretty"' % etag[:-1]
+    return etag
+
+
+def user_etag(user: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    Returns strong ETag of a user record, from its uuid and stored digest.
+    Records without digest get no ETag.
+    """
+    if not user or 'digest' not in user:
+        return None
+    return '"%s"' % get_digest(user['uuid'] + user['digest'])
+
+
+def page_etag(page: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns strong ETag of a users page, from users count, page links
+    and the uuids and digests of page users.
+    """
+    parts = [str(page['usersCount'])]
+    parts.extend(link['href'] for link in page['links'])
+    for user in page['totalUsers']:
+        if 'digest' not in user:
+            return None
+        parts.append(user['uuid'] + user['digest'])
+    return '"%s"' % get_digest('\n'.join(parts))
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Tells whether If-None-Match header value matches etag."""
+    if not if_none_match or not etag:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in ('*', etag):
+            return True
+    return False
+
+
+def conditional_json_response(obj: Any, etag: Optional[str],
+                              if_none_match: Optional[str]) \
+        -> BaseResponse:
+    """
+    Makes json response with ETag header, or empty 304 response
+    if the client already has this etag.
+    """
+    if etag is None:
+        return json_response(obj)
+    etag = representation_etag(etag)
+    headers = {'ETag': etag, 'Vary': 'Accept'}
+    if etag_matches(if_none_match, etag):
+        return HTTPResponse(status=304, headers=headers)
+    return json_response(obj, headers=headers)
 
 
-def json_error_response(e: AnyExcCls) -> BaseResponse:
+def encode_json_batch(objs: List[Any], first: bool,
+                      ndjson: bool = False) -> bytes:
+    """
+    Encodes a batch of JSON array items (first one has no leading comma)
+    or of NDJSON lines.
+    """
+    encoded = [dumps_json(obj, pretty=False) for obj in objs]
+    if not encoded:
+        return b''
+    if ndjson:
+        return b''.join(item + b'\n' for item in encoded)
+    return (b'' if first else b',') + b','.join(encoded)
+
+
+def iter_json_chunks(objs: Iterable[Any], chunk_size: int,
+                     ndjson: bool = False) -> Iterator[bytes]:
+    """
+    Encodes objs as a JSON array (or NDJSON lines), chunk_size objects
+    per yielded chunk. Only one chunk is held in memory at a time.
+    """
+    prefix = b'' if ndjson else b'['
+    batch: List[Any] = []
+    first = True
+    for obj in objs:
+        batch.append(obj)
+        if len(batch) == chunk_size:
+            yield prefix + encode_json_batch(batch, first, ndjson)
+            prefix, first, batch = b'', False, []
+    chunk = prefix + encode_json_batch(batch, first, ndjson) \
+        + (b'' if ndjson else b']')
+    if chunk:
+        yield chunk
+
+
+def iter_encoded_chunks(batches: Iterable[bytes],
+                        ndjson: bool = False) -> Iterator[bytes]:
+    """
+    Frames batches of encoded JSON array items (joined by commas)
+    or of NDJSON lines, as the transcoder makes them.
+    """
+    prefix = b'' if ndjson else b'['
+    for batch in batches:
+        if batch:
+            yield prefix + batch
+            prefix = b'' if ndjson else b','
+    if not ndjson:
+        yield b'[]' if prefix == b'[' else b']'
+
+
+def json_stream_response(objs: Iterable[Any], chunk_size: int,
+                         ndjson: bool = False,
+                         encoded: bool = False) -> BaseResponse:
+    """
+    Makes a streamed json response. Body is sent chunked as it is encoded.
+    If encoded, objs are batches of encoded items, see iter_encoded_chunks.
+    """
+    content_type = config.NDJSON_CONTENT_TYPE if ndjson \
+        else config.SUPPORTED_CONTENT_TYPE
+    if encoded:
+        body = iter_encoded_chunks(objs, ndjson)
+    else:
+        body = iter_json_chunks(objs, chunk_size, ndjson)
+    return HTTPResponse(body=body, content_type=content_type)
+
+
+def error_object(e: AnyExcCls) -> Dict[str, str]:
+    """Returns Error object of a ServerError."""
     if not isinstance(e, errors.ServerError):
         raise RuntimeError('Only ServerError type is accepted!')
-    error_object = construct_error_object(e.name_json,
-                                          e.debug_id_json,
-                                          e.message_json,
-                                          e.information_link_json,
-                                          e.links_json)
-    return json_response(error_object, status=e.status_code)
+    return construct_error_object(e.name_json,
+                                  e.debug_id_json,
+                                  e.message_json,
+                                  e.information_link_json,
+                                  e.links_json)
+
+
+@functools.lru_cache(maxsize=256)
+def error_body_parts(name: str, information_link: Optional[str] = None) \
+        -> Tuple[bytes, bytes, bytes]:
+    """
+    Returns compact json of an Error object split where its debug_id
+    and its message go. Made once per error class.
+    """
+    body = dumps_json(construct_error_object(name, DEBUG_ID_MARK,
+                                             MESSAGE_MARK, information_link),
+                      pretty=False)
+    head, _, rest = body.partition(DEBUG_ID_MARK.encode())
+    middle, _, tail = rest.partition(b'"%s"' % MESSAGE_MARK.encode())
+    return head, middle, tail
+
+
+def error_body(e: errors.ServerError) -> bytes:
+    """
+    Returns compact json Error object of e: the prebuilt body of its
+    class, debug_id and encoded message spliced in. Errors with links
+    are encoded whole.
+    """
+    if e.links_json:
+        return dumps_json(error_object(e), pretty=False)
+    head, middle, tail = error_body_parts(e.name_json,
+                                          e.information_link_json)
+    return b''.join((head, e.debug_id_json.encode(), middle,
+                     dumps_json(e.message_json, pretty=False), tail))
+
+
+def json_error_response(e: errors.ServerError) -> BaseResponse:
+    if wants_compact_json():
+        return HTTPResponse(body=error_body(e),
+                            content_type=config.SUPPORTED_CONTENT_TYPE,
+                            status=e.status_code, headers={'Vary': 'Accept'})
+    return json_response(error_object(e), status=e.status_code)
 
 
 def construct_error_object(name: str, debug_id: str, message: str,
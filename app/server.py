@@ -0,0 +1,80 @@
+"""
+This module runs the API in production: a Gunicorn master pre-forks
+workers, which serve the WSGI app (or the asyncio app in asyncio mode).
+"""
+import multiprocessing
+from typing import Any, Dict
+
+from gunicorn.app.base import BaseApplication
+
+from config import SERVER_SETTINGS, CACHE
+from db_adaptor import reset_clients
+from logger_setup import logger
+
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'thread': 'gthread',
+    'green': 'gevent',
+}
+
+
+def post_fork(server, worker):
+    """Worker must not use MongoDB clients inherited from the master."""
+    reset_clients()
+    logger.info("Worker %s started.", worker.pid)
+
+
+def prefork_options() -> Dict[str, Any]:
+    """Gunicorn settings from SERVER_SETTINGS."""
+    workers = SERVER_SETTINGS['WORKERS'] or multiprocessing.cpu_count()
+    if SERVER_SETTINGS['MODE'] == 'asyncio':
+        worker_class = 'aiohttp.GunicornWebWorker'
+    else:
+        worker_class = WORKER_CLASSES[SERVER_SETTINGS['WORKER_CLASS']]
+    return {
+        'bind': '%s:%s' % (SERVER_SETTINGS['SERVER_IP'],
+                           SERVER_SETTINGS['SERVER_PORT']),
+        'workers': workers,
+        'worker_class': worker_class,
+        'threads': SERVER_SETTINGS['THREADS'],
+        'worker_connections': SERVER_SETTINGS['WORKER_CONNECTIONS'],
+        'reuse_port': SERVER_SETTINGS['REUSE_PORT'],
+        'max_requests': SERVER_SETTINGS['MAX_REQUESTS'],
+        'max_requests_jitter': SERVER_SETTINGS['MAX_REQUESTS_JITTER'],
+        'post_fork': post_fork,
+    }
+
+
+class PreforkServer(BaseApplication):
+    """Gunicorn application serving an already built app."""
+    def __init__(self, app, options: Dict[str, Any]):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def check_cache_backend(workers: int):
+    """
+    Raises RuntimeError if several workers would cache users locally:
+    a worker does not see invalidations of the others.
+    """
+    if CACHE['ENABLED'] and CACHE['BACKEND'] == 'local' and workers > 1:
+        raise RuntimeError(
+            'Local user cache with %d prefork workers, set CACHE BACKEND '
+            'to shared (or auto), or disable the cache.' % workers
+        )
+
+
+def run_prefork(app):
+    options = prefork_options()
+    check_cache_backend(options['workers'])
+    logger.info("Starting %s %s workers on %s.", options['workers'],
+                options['worker_class'], options['bind'])
+    PreforkServer(app, options).run()
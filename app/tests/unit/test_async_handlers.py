@@ -0,0 +1,224 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import bson
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from bson import ObjectId
+
+import async_db_adaptor
+import async_handlers
+import async_processors
+import config
+from config import SERVER_SETTINGS
+
+WEB_BASE = SERVER_SETTINGS['WEB_BASE']
+USER_UUID = 'USER-7C89635351F24483AD2DC89A154A42CD'
+
+
+def make_user(number):
+    return {'uuid': 'USER-%032X' % number, 'email': 'u%d@x.com' % number,
+            'digest': 'd%d' % number}
+
+
+def with_client(steps):
+    """Runs coroutine function steps with a client of the aiohttp app."""
+    async def run():
+        async with TestClient(TestServer(async_handlers.make_app())) \
+                as client:
+            return await steps(client)
+    return asyncio.run(run())
+
+
+def fetch(method, path, **kwargs):
+    """Runs one request against the aiohttp app: (response, body)."""
+    async def steps(client):
+        response = await client.request(method, WEB_BASE + path, **kwargs)
+        return response, await response.read()
+    return with_client(steps)
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """Users collection of a test, ordered by uuid."""
+    users = [make_user(number) for number in range(1, 6)]
+
+    async def read_by_uuid(user_uuid):
+        return next((user for user in users if user['uuid'] == user_uuid),
+                    None)
+
+    async def count_tot_users():
+        return len(users)
+
+    async def get_users_page(limit, after=None):
+        return [user for user in users
+                if after is None or user['uuid'] > after][:limit]
+
+    async def find_existing_emails(emails):
+        return {user['email'] for user in users} & set(emails)
+
+    async def insert_users(users_to_insert):
+        users.extend(users_to_insert)
+        return ['inserted'] * len(users_to_insert)
+
+    monkeypatch.setattr(async_handlers, 'read_by_uuid', read_by_uuid)
+    for name, function in (('count_tot_users', count_tot_users),
+                           ('get_users_page', get_users_page),
+                           ('find_existing_emails', find_existing_emails),
+                           ('insert_users', insert_users)):
+        monkeypatch.setattr(async_processors, name, function)
+    return users
+
+
+def test_by_uuid(users):
+    user = users[2]
+    response, body = fetch('GET', '/get_user_by_uuid/' + user['uuid'])
+    assert response.status == 200
+    assert json.loads(body) == user
+    assert response.headers['ETag']
+    response, body = fetch('GET', '/get_user_by_uuid/not-a-uuid')
+    assert response.status == 400
+
+
+def test_pagination_follows_next_links(users):
+    seen = []
+    path = '/get_total_users?limit=2'
+    while path:
+        response, body = fetch('GET', path)
+        assert response.status == 200
+        page = json.loads(body)
+        assert page['usersCount'] == 5
+        seen.extend(user['uuid'] for user in page['totalUsers'])
+        hrefs = [link['href'] for link in page['links']
+                 if link['rel'] == 'next']
+        path = hrefs[0][hrefs[0].index('/get_total_users'):] \
+            if hrefs else None
+    assert seen == [user['uuid'] for user in users]
+
+
+def test_pagination_rejects_wrong_limit(users):
+    response, _ = fetch('GET', '/get_total_users?limit=0')
+    assert response.status == 400
+
+
+def test_post_users_reports_per_user_status(users):
+    new_user = {'company': 'Google', 'firstname': 'Jim', 'lastname': 'Beam',
+                'status': 'confirmed'}
+    response, body = fetch('POST', '/post_users', json=[
+        dict(new_user, email='new@x.com'),
+        dict(new_user, email=users[0]['email']),
+        dict(new_user, email='new@x.com'),
+    ])
+    assert response.status == 201
+    summary = json.loads(body)
+    assert [result['status'] for result in summary['results']] == \
+        ['inserted', 'duplicate', 'duplicate']
+    assert summary['inserted'] == 1
+    assert summary['duplicate'] == 2
+    assert users[-1]['email'] == 'new@x.com'
+
+
+def test_by_uuid_etag_and_304(users):
+    path = '/get_user_by_uuid/' + users[0]['uuid']
+    response, _ = fetch('GET', path)
+    etag = response.headers['ETag']
+    for if_none_match in (etag, 'W/' + etag, '*'):
+        response, body = fetch('GET', path,
+                               headers={'If-None-Match': if_none_match})
+        assert response.status == 304
+        assert response.headers['ETag'] == etag
+        assert body == b''
+    response, _ = fetch('GET', path + '?pretty=1',
+                        headers={'If-None-Match': etag})
+    assert response.status == 200
+    assert response.headers['ETag'] not in (etag, 'W/' + etag)
+    users[0]['digest'] = 'changed'
+    response, _ = fetch('GET', path, headers={'If-None-Match': etag})
+    assert response.status == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_users_page_etag_and_304(users):
+    # Page links hold the host, one server serves all requests
+    async def steps(client):
+        path = WEB_BASE + '/get_total_users?limit=2'
+        response = await client.get(path)
+        etag = response.headers['ETag']
+        response = await client.get(path, headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert await response.read() == b''
+        users[0]['digest'] = 'changed'
+        response = await client.get(path, headers={'If-None-Match': etag})
+        assert response.status == 200
+    with_client(steps)
+
+
+def test_unacceptable_accept_is_406(users):
+    path = '/get_user_by_uuid/' + users[0]['uuid']
+    response, body = fetch('GET', path,
+                           headers={'Accept': 'application/json;q=0'})
+    assert response.status == 406
+    assert json.loads(body)['name'] == 'ERR_TYPE_NOT_SUPPORTED'
+    response, _ = fetch('GET', path, headers={'Accept': '*/*'})
+    assert response.status == 200
+    assert response.content_type == 'application/json'
+
+
+class Cursor:
+    """Motor cursor over items, raising once fail_after are read."""
+    def __init__(self, users, fail_after=None):
+        self.users = iter(users[:fail_after])
+        self.fail = fail_after is not None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        for user in self.users:
+            return user
+        if self.fail:
+            raise TimeoutError('cursor timed out')
+        raise StopAsyncIteration
+
+
+@pytest.mark.parametrize('raw_reads', [False, True])
+@pytest.mark.parametrize('fail_after', [None, 0])
+def test_stream_users_fails_before_response(monkeypatch, fail_after,
+                                            raw_reads):
+    users = [make_user(number) for number in range(1, 4)]
+    batches = [b''.join(bson.encode({'_id': ObjectId(), **user})
+                        for user in batch) for batch in (users[:2], users[2:])]
+    monkeypatch.setitem(config.DATABASE, 'RAW_READS', raw_reads)
+    collection = SimpleNamespace(
+        find=lambda **kwargs: Cursor(users, fail_after),
+        find_raw_batches=lambda **kwargs: Cursor(batches, fail_after))
+    monkeypatch.setattr(async_db_adaptor, 'get_collection',
+                        lambda: collection)
+    response, body = fetch('GET', '/get_total_users?stream=ndjson')
+    if fail_after is None:
+        assert response.status == 200
+        assert [json.loads(line) for line in body.splitlines()] == users
+    else:
+        assert response.status == 500
+        assert json.loads(body)['message'] == 'Error while reading users'
+
+
+def test_compressed_response_gets_weak_etag(users, monkeypatch):
+    monkeypatch.setitem(async_handlers.COMPRESSION, 'MIN_SIZE', 1)
+    path = '/get_user_by_uuid/' + users[0]['uuid']
+    response, _ = fetch('GET', path, headers={'Accept-Encoding': 'identity'})
+    etag = response.headers['ETag']
+    assert 'Content-Encoding' not in response.headers
+    for accept_encoding, encoding in (('deflate', 'deflate'),
+                                      ('gzip;q=0, deflate', 'deflate'),
+                                      ('gzip', 'gzip'),
+                                      ('gzip;q=0', None)):
+        response, body = fetch('GET', path,
+                               headers={'Accept-Encoding': accept_encoding})
+        assert response.headers.get('Content-Encoding') == encoding
+        assert response.headers['ETag'] == \
+            (etag if encoding is None else 'W/' + etag)
+        assert response.headers.getall('Vary') == \
+            ['Accept', 'Accept-Encoding']
+        assert json.loads(body) == users[0]
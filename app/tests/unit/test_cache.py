@@ -0,0 +1,125 @@
+import time
+
+import cache
+from cache import UserCache, SharedUserCache, key_hash
+
+
+def make_user(uuid, email):
+    return {'uuid': uuid, 'email': email, 'firstname': 'Jim'}
+
+
+def test_get_put():
+    cache = UserCache(max_entries=10, max_bytes=10000, ttl=60)
+    assert cache.get(('uuid', 'USER-1')) is None
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'jim@a.com'))
+    assert cache.get(('uuid', 'USER-1'))['email'] == 'jim@a.com'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_lru_eviction():
+    cache = UserCache(max_entries=2, max_bytes=10000, ttl=60)
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'a@a.com'))
+    cache.put(('uuid', 'USER-2'), make_user('USER-2', 'b@a.com'))
+    cache.get(('uuid', 'USER-1'))
+    cache.put(('uuid', 'USER-3'), make_user('USER-3', 'c@a.com'))
+    assert cache.get(('uuid', 'USER-2')) is None
+    assert cache.get(('uuid', 'USER-1')) is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_bytes_bound():
+    user = make_user('USER-1', 'a@a.com')
+    cache = UserCache(max_entries=10, max_bytes=100, ttl=60)
+    cache.put(('uuid', 'USER-1'), user)
+    cache.put(('uuid', 'USER-2'), make_user('USER-2', 'b' * 200))
+    assert cache.get(('uuid', 'USER-2')) is None
+    assert cache.stats()['bytes'] <= 100
+
+
+def test_ttl():
+    cache = UserCache(max_entries=10, max_bytes=10000, ttl=0.01)
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'a@a.com'))
+    time.sleep(0.02)
+    assert cache.get(('uuid', 'USER-1')) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_invalidate_drops_all_keys_of_user():
+    cache = UserCache(max_entries=10, max_bytes=10000, ttl=60)
+    user = make_user('USER-1', 'a@a.com')
+    cache.put(('uuid', 'USER-1'), user)
+    cache.put(('email', 'a@a.com'), user)
+    cache.invalidate('USER-1')
+    assert cache.get(('uuid', 'USER-1')) is None
+    assert cache.get(('email', 'a@a.com')) is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_shared_cache_invalidate_from_other_instance(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = SharedUserCache(path, slots=64, slot_size=512, ttl=60)
+    other = SharedUserCache(path, slots=64, slot_size=512, ttl=60)
+    user = make_user('USER-1', 'a@a.com')
+    cache.put(('uuid', 'USER-1'), user)
+    cache.put(('email', 'a@a.com'), user)
+    assert other.get(('email', 'a@a.com')) == user
+    other.invalidate('USER-1')
+    assert cache.get(('uuid', 'USER-1')) is None
+    assert cache.get(('email', 'a@a.com')) is None
+
+
+def test_shared_cache_clear(tmp_path):
+    cache = SharedUserCache(str(tmp_path / 'cache'), slots=64,
+                            slot_size=512, ttl=60)
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'a@a.com'))
+    cache.clear()
+    assert cache.get(('uuid', 'USER-1')) is None
+
+
+def test_put_after_racing_invalidate_is_dropped():
+    cache = UserCache(max_entries=10, max_bytes=10000, ttl=60)
+    token = cache.token()
+    # An update commits and invalidates while the old user is read
+    cache.invalidate('USER-1')
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'old@a.com'), token)
+    assert cache.get(('uuid', 'USER-1')) is None
+    token = cache.token()
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'new@a.com'), token)
+    assert cache.get(('uuid', 'USER-1'))['email'] == 'new@a.com'
+
+
+def test_shared_cache_put_after_racing_invalidate_is_dropped(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = SharedUserCache(path, slots=64, slot_size=512, ttl=60)
+    other = SharedUserCache(path, slots=64, slot_size=512, ttl=60)
+    token = cache.token()
+    other.invalidate('USER-1')
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'old@a.com'), token)
+    assert cache.get(('uuid', 'USER-1')) is None
+    token = cache.token()
+    other.clear()
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'old@a.com'), token)
+    assert other.get(('uuid', 'USER-1')) is None
+    cache.put(('uuid', 'USER-1'), make_user('USER-1', 'new@a.com'),
+              cache.token())
+    assert other.get(('uuid', 'USER-1'))['email'] == 'new@a.com'
+
+
+def test_shared_cache_path_is_per_database_and_collection(monkeypatch):
+    monkeypatch.setitem(cache.CACHE, 'SHARED_PATH', '/dev/shm/users')
+    monkeypatch.setitem(cache.DATABASE, 'DB_NAME', 'staging')
+    monkeypatch.setitem(cache.DATABASE, 'COL_NAME', 'people')
+    assert cache.shared_cache_path() == '/dev/shm/users.staging.people'
+
+
+def test_shared_cache_undecodable_slot_is_a_miss(tmp_path):
+    cache = SharedUserCache(str(tmp_path / 'cache'), slots=64,
+                            slot_size=512, ttl=60)
+    key = ('uuid', 'USER-1')
+    cache.put(key, make_user('USER-1', 'a@a.com'))
+    offset = cache._slot_offset(key_hash('uuid:USER-1'))
+    payload_offset = offset + SharedUserCache.SLOT.size
+    cache._map[payload_offset:payload_offset + 2] = b'\xff{'
+    assert cache.get(key) is None
+    assert cache.stats()['misses'] == 1
@@ -0,0 +1,111 @@
+import gzip
+import json
+import mimetypes
+
+import pytest
+from bottle import Bottle, HTTPResponse, request
+
+import compression
+from compression import (
+    CompressionPlugin, accepted_encodings, compress_chunks,
+    precompressed_static_file
+)
+from tests.unit.test_handlers import call
+
+BODY = json.dumps([{'uuid': 'USER-%d' % number} for number in range(100)])
+
+
+def test_accepted_encodings():
+    assert accepted_encodings(None, ['br', 'gzip']) == []
+    assert accepted_encodings('gzip, deflate', ['br', 'gzip']) == ['gzip']
+    assert accepted_encodings('gzip, br', ['br', 'gzip']) == ['br', 'gzip']
+    assert accepted_encodings('br;q=0.5, gzip', ['br', 'gzip']) == \
+        ['gzip', 'br']
+    assert accepted_encodings('*, gzip;q=0', ['br', 'gzip']) == ['br']
+
+
+def test_compress_chunks():
+    chunks = [b'[', b'{"a":1}', b',{"a":2}', b']']
+    body = b''.join(compress_chunks(iter(chunks), 'gzip'))
+    assert gzip.decompress(body) == b''.join(chunks)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setitem(compression.COMPRESSION, 'ENABLED', True)
+    monkeypatch.setitem(compression.COMPRESSION, 'MIN_SIZE', 1024)
+    monkeypatch.setattr(compression, 'brotli', None)
+    app = Bottle()
+    app.catchall = False
+    app.install(CompressionPlugin())
+
+    def respond(body, status=200, content_type='application/json'):
+        return HTTPResponse(body=body, status=status,
+                            content_type=content_type,
+                            headers={'ETag': '"abc"'})
+
+    app.route('/big', 'GET', lambda: respond(BODY))
+    app.route('/small', 'GET', lambda: respond(BODY[:100]))
+    app.route('/binary', 'GET',
+              lambda: respond(BODY, content_type='application/msgpack'))
+    app.route('/not_modified', 'GET', lambda: respond('', status=304))
+    return app
+
+
+def test_plugin_compresses_and_weakens_etag(app):
+    status, headers, body = call(app, 'GET', '/big',
+                                 {'Accept-Encoding': 'gzip, deflate'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['ETag'] == 'W/"abc"'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == BODY.encode()
+
+
+def test_plugin_keeps_identity_body(app):
+    for accept_encoding in ('gzip;q=0', 'identity'):
+        status, headers, body = call(app, 'GET', '/big',
+                                     {'Accept-Encoding': accept_encoding})
+        assert 'Content-Encoding' not in headers
+        assert headers['ETag'] == '"abc"'
+        assert headers['Vary'] == 'Accept-Encoding'
+        assert body == BODY.encode()
+
+
+def test_plugin_skips_304_small_and_binary_bodies(app):
+    for path in ('/not_modified', '/small', '/binary'):
+        status, headers, _ = call(app, 'GET', path,
+                                  {'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in headers
+        assert headers['ETag'] == '"abc"'
+    status, headers, body = call(app, 'GET', '/not_modified',
+                                 {'Accept-Encoding': 'gzip'})
+    assert status == 304
+    assert body == b''
+
+
+def test_precompressed_static_file(tmp_path):
+    (tmp_path / 'app.js').write_bytes(b'plain')
+    (tmp_path / 'app.js.gz').write_bytes(b'gzipped')
+    (tmp_path / 'app.js.br').write_bytes(b'brotli')
+    app = Bottle()
+    app.route('/<filename>', 'GET',
+              lambda filename: precompressed_static_file(
+                  filename, str(tmp_path),
+                  request.get_header('Accept-Encoding')))
+    for accept_encoding, encoding, body in (
+            ('gzip, br', 'br', b'brotli'),
+            ('gzip', 'gzip', b'gzipped'),
+            ('br;q=0, *', 'gzip', b'gzipped'),
+            (None, None, b'plain')):
+        headers = {'Accept-Encoding': accept_encoding} \
+            if accept_encoding else {}
+        status, response_headers, response_body = \
+            call(app, 'GET', '/app.js', headers)
+        assert status == 200
+        assert response_headers.get('Content-Encoding') == encoding
+        # Type of the original file, not of its .gz or .br sibling
+        assert response_headers['Content-Type'].startswith(
+            mimetypes.guess_type('app.js')[0])
+        assert response_headers['Vary'] == 'Accept-Encoding'
+        assert response_body == body
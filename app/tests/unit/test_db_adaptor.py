@@ -0,0 +1,186 @@
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError
+
+import db_adaptor
+import errors
+from db_adaptor import (
+    INSERTED, DUPLICATE, FAILED, UNKNOWN, DUPLICATE_KEY_ERROR,
+    delete_by_uuid, duplicate_key_field, insert_user, insert_users,
+    read_by_uuid, user_cache, users_counter, UsersCounter
+)
+
+
+class FakeAdaptor:
+    """Users collection of a test, in a dict by uuid."""
+    def __init__(self):
+        self.users = {}
+        self.lookup_fails = False
+
+    def insert_many(self, users, ordered=True):
+        write_errors = []
+        for index, user in enumerate(users):
+            if user['email'] == 'lost@x.com':
+                raise AutoReconnect('connection closed')
+            if any(other['email'] == user['email']
+                   for other in self.users.values()):
+                write_errors.append({'index': index,
+                                     'code': DUPLICATE_KEY_ERROR,
+                                     'keyPattern': {'email': 1}})
+            else:
+                self.users[user['uuid']] = user
+        if write_errors:
+            raise BulkWriteError({'writeErrors': write_errors})
+
+    def insert_one(self, user):
+        for other in self.users.values():
+            for field in ('uuid', 'email'):
+                if other[field] == user[field]:
+                    raise DuplicateKeyError(
+                        'E11000 duplicate key error collection: userAPI.users'
+                        ' index: %s_1 dup key: { %s: "%s" }' % (
+                            field, field, user[field]),
+                        DUPLICATE_KEY_ERROR, {'code': DUPLICATE_KEY_ERROR,
+                                              'keyPattern': {field: 1}})
+        self.users[user['uuid']] = user
+        return type('InsertOneResult', (), {'inserted_id': user['uuid']})
+
+    def find_one(self, filter, projection):
+        user = self.users.get(filter['uuid'])
+        # A delete commits, and invalidates, right after the read
+        self.users.pop(filter['uuid'], None)
+        user_cache.invalidate(filter['uuid'])
+        return user
+
+    def find_cursor(self, filter, projection):
+        if self.lookup_fails:
+            raise AutoReconnect('no primary')
+        uuids = filter['uuid']['$in']
+        return [{'uuid': uuid} for uuid in uuids if uuid in self.users]
+
+
+@pytest.fixture
+def adaptor(monkeypatch):
+    fake = FakeAdaptor()
+    monkeypatch.setattr(db_adaptor, 'get_db_adaptor', lambda: fake)
+    monkeypatch.setitem(db_adaptor.BULK, 'INSERT_BATCH_SIZE', 2)
+    monkeypatch.setitem(db_adaptor.BULK, 'INSERT_CONCURRENCY', 3)
+    users_counter.reset(10)
+    yield fake
+    users_counter.reset()
+
+
+def make_users(*emails):
+    return [{'uuid': 'USER-%d' % i, 'email': email}
+            for i, email in enumerate(emails)]
+
+
+def test_concurrent_batches_report_per_user_statuses(adaptor):
+    adaptor.users['USER-X'] = {'uuid': 'USER-X', 'email': 'b@x.com'}
+    statuses = insert_users(make_users('a@x.com', 'b@x.com', 'c@x.com',
+                                       'd@x.com', 'e@x.com'))
+    assert statuses == [INSERTED, DUPLICATE, INSERTED, INSERTED, INSERTED]
+    assert users_counter.peek() == 14
+
+
+def test_batch_failing_midway_is_looked_up(adaptor):
+    statuses = insert_users(make_users('a@x.com', 'b@x.com',
+                                       'c@x.com', 'lost@x.com'))
+    assert statuses == [INSERTED, INSERTED, INSERTED, FAILED]
+    assert users_counter.peek() == 13
+
+
+def test_batch_is_unknown_if_lookup_fails(adaptor):
+    adaptor.lookup_fails = True
+    statuses = insert_users(make_users('a@x.com', 'b@x.com',
+                                       'c@x.com', 'lost@x.com'))
+    assert statuses == [INSERTED, INSERTED, UNKNOWN, UNKNOWN]
+    # Counter is re-read from the collection on next use
+    assert users_counter.peek() is None
+
+
+def test_read_racing_delete_is_not_cached(adaptor, monkeypatch):
+    monkeypatch.setitem(db_adaptor.CACHE, 'ENABLED', True)
+    user_cache.clear()
+    adaptor.users['USER-1'] = {'uuid': 'USER-1', 'email': 'a@x.com'}
+    assert read_by_uuid('USER-1')['email'] == 'a@x.com'
+    assert user_cache.get(('uuid', 'USER-1')) is None
+    assert read_by_uuid('USER-1') is None
+
+
+def test_duplicate_key_field():
+    assert duplicate_key_field({'keyPattern': {'uuid': 1}}) == 'uuid'
+    assert duplicate_key_field({
+        'errmsg': 'E11000 duplicate key error collection: userAPI.users '
+                  'index: email_1 dup key: { email: "a@x.com" }'
+    }) == 'email'
+    assert duplicate_key_field(None) is None
+
+
+def test_insert_user_duplicate_email_and_uuid(adaptor):
+    adaptor.users['USER-1'] = {'uuid': 'USER-1', 'email': 'a@x.com'}
+    assert insert_user({'uuid': 'USER-2', 'email': 'b@x.com'}) == 'USER-2'
+    assert insert_user({'uuid': 'USER-3', 'email': 'a@x.com'}) is None
+    with pytest.raises(errors.InternalServerError):
+        insert_user({'uuid': 'USER-1', 'email': 'c@x.com'})
+
+
+class DeleteAdaptor:
+    def __init__(self, users):
+        self.users = users
+
+    def find_one_and_delete(self, filter, projection):
+        return self.users.pop(filter['uuid'], None)
+
+
+def test_delete_by_uuid_runs_hooks_once(monkeypatch):
+    fake = DeleteAdaptor({'USER-1': {'uuid': 'USER-1', 'email': 'a@x.com'}})
+    monkeypatch.setattr(db_adaptor, 'get_db_adaptor', lambda: fake)
+    deleted = []
+
+    def failing_hook(user):
+        raise ValueError('hook failed')
+
+    monkeypatch.setattr(db_adaptor, 'delete_hooks',
+                        [failing_hook, deleted.append])
+    users_counter.reset(5)
+    user_cache.put(('uuid', 'USER-1'), {'uuid': 'USER-1'})
+    assert delete_by_uuid('USER-1')['email'] == 'a@x.com'
+    assert deleted == [{'uuid': 'USER-1', 'email': 'a@x.com'}]
+    assert users_counter.peek() == 4
+    assert user_cache.get(('uuid', 'USER-1')) is None
+    with pytest.raises(errors.UserNotFound):
+        delete_by_uuid('USER-1')
+    assert len(deleted) == 1
+    users_counter.reset()
+
+
+def test_users_counter_add_and_reconcile():
+    counter = UsersCounter(interval=60)
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return 5
+    assert counter.get(fetch) == 5
+    counter.add(2)
+    counter.add(-10)
+    assert counter.get(fetch) == 0
+    assert len(fetches) == 1
+    counter.reset()
+    assert counter.get(fetch) == 5
+    assert len(fetches) == 2
+
+
+def test_users_counter_is_reconciled_after_interval():
+    counter = UsersCounter(interval=0)
+    counter.get(lambda: 5)
+    counter.add(1)
+    assert counter.peek() is None
+    assert counter.get(lambda: 7) == 7
+
+
+def test_users_counter_add_before_first_fetch_is_ignored():
+    counter = UsersCounter(interval=60)
+    counter.add(3)
+    assert counter.peek() is None
+    assert counter.get(lambda: 5) == 5
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import metrics
+from db_monitoring import (
+    ClientCommands, CommandMonitor, filter_shape, command_filter,
+    command_samples
+)
+
+
+def started(request_id, command, name='find'):
+    return SimpleNamespace(command_name=name, command=command,
+                           request_id=request_id, connection_id=('db', 1),
+                           database_name='users_db')
+
+
+def finished(request_id, micros, reply=None, name='find'):
+    return SimpleNamespace(command_name=name, request_id=request_id,
+                           connection_id=('db', 1), duration_micros=micros,
+                           reply=reply or {}, failure={'errmsg': 'boom'})
+
+
+def test_filter_shape_hides_values():
+    command = {'find': 'users', 'filter': {'email': 'a@b.com',
+                                           'uuid': {'$in': ['A', 'B']}}}
+    assert filter_shape(command_filter('find', command)) == \
+        {'email': '?', 'uuid': {'$in': ['?']}}
+    assert command_filter('delete', {'deletes': [{'q': {'uuid': 'A'}}]}) \
+        == {'uuid': 'A'}
+
+
+def test_commands_are_counted_and_slow_ones_logged(caplog):
+    monitor = CommandMonitor(slow_query_ms=10, explain_sample_rate=0,
+                             explain_max_shapes=10)
+    command = {'find': 'users', 'filter': {'uuid': 'USER-1'}}
+    monitor.started(started(1, command))
+    monitor.succeeded(finished(1, 20000, {'cursor': {'firstBatch': [{}]}}))
+    monitor.started(started(2, command))
+    monitor.failed(finished(2, 100))
+    totals = monitor.counters.totals()
+    assert totals[('commands', 'find', 'users')] == 2
+    assert totals[('documents', 'find', 'users')] == 1
+    assert totals[('errors', 'find', 'users')] == 1
+    assert 'Slow query find on users: 20.0ms filter {"uuid": "?"}' \
+        in caplog.text
+
+
+def test_sampled_explain_flags_collection_scan(caplog):
+    plan = {'queryPlanner': {'winningPlan': {
+        'stage': 'PROJECTION', 'inputStage': {'stage': 'COLLSCAN'}}}}
+    client = {'users_db': SimpleNamespace(
+        command=lambda *args, **kwargs: plan)}
+    monitor = CommandMonitor(slow_query_ms=1000, explain_sample_rate=1,
+                             explain_max_shapes=10)
+    listener = ClientCommands(monitor, lambda: client)
+    for request_id in (1, 2):
+        listener.started(started(request_id, {'find': 'users',
+                                              'filter': {'email': 'x'}}))
+        listener.succeeded(finished(request_id, 10))
+    monitor._explainer.shutdown(wait=True)
+    assert monitor.counters.totals()[('collscans', 'users')] == 1
+    assert 'Collection scan: find users {"email": "?"}' in caplog.text
+
+
+def test_samples_render():
+    out = metrics.Exposition()
+    command_samples(out)
+    assert '# TYPE mongodb_command_duration_seconds histogram' \
+        in out.render().decode()
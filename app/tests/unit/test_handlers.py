@@ -0,0 +1,184 @@
+import io
+import json
+from wsgiref.headers import Headers
+from wsgiref.util import setup_testing_defaults
+
+import bson
+import pytest
+from bottle import Bottle, request
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+import config
+import db_adaptor
+import errors
+import handlers
+import processors
+from scripts import set_pretty_output, set_response_content_type
+
+
+def call(app, method, path, headers=None, body=b''):
+    """Runs one request through the WSGI app: (status, headers, body)."""
+    path, _, query = path.partition('?')
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'QUERY_STRING': query, 'wsgi.input': io.BytesIO(body),
+               'CONTENT_LENGTH': str(len(body))}
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    setup_testing_defaults(environ)
+    started = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        started['status'] = int(status.split()[0])
+        started['headers'] = Headers(response_headers)
+
+    chunks = app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:  # As WSGI servers do
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return started['status'], started['headers'], body
+
+
+@pytest.fixture
+def app():
+    app = Bottle()
+    app.catchall = False
+    app.route('/delete_user/<user_uuid>', ['DELETE'], handlers.delete_user)
+    app.route('/get_user_by_uuid/<user_uuid>', ['GET'], handlers.by_uuid)
+    app.route('/get_total_users', ['GET'], handlers.get_total_users)
+    app.add_hook('before_request', lambda: set_response_content_type(
+        request.get_header('Accept')))
+    app.add_hook('before_request',
+                 lambda: set_pretty_output(request.query.get('pretty')))
+    return app
+
+
+@pytest.fixture
+def users(monkeypatch):
+    users = [{'uuid': 'USER-%032X' % number, 'email': 'u%d@x.com' % number,
+              'digest': 'd%d' % number} for number in range(1, 4)]
+    monkeypatch.setattr(handlers, 'read_by_uuid', lambda user_uuid: next(
+        user for user in users if user['uuid'] == user_uuid))
+    monkeypatch.setattr(processors, 'count_tot_users', lambda: len(users))
+    monkeypatch.setattr(processors, 'get_users_page',
+                        lambda limit, after=None: users[:limit])
+    return users
+
+
+def test_delete_user_204_then_404(app, monkeypatch):
+    users = {'USER-1': {'uuid': 'USER-1'}}
+
+    def delete_by_uuid(user_uuid):
+        if user_uuid not in users:
+            raise errors.UserNotFound()
+        return users.pop(user_uuid)
+
+    monkeypatch.setattr(handlers, 'delete_by_uuid', delete_by_uuid)
+    status, _, body = call(app, 'DELETE', '/delete_user/USER-1')
+    assert status == 204
+    assert body == b''
+    status, _, body = call(app, 'DELETE', '/delete_user/USER-1')
+    assert status == 404
+    assert json.loads(body)['message'] == 'User USER-1 not found'
+
+
+def test_by_uuid_etag_and_304(app, users):
+    path = '/get_user_by_uuid/' + users[0]['uuid']
+    status, headers, _ = call(app, 'GET', path)
+    assert status == 200
+    etag = headers['ETag']
+    for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+        status, headers, body = call(app, 'GET', path,
+                                     {'If-None-Match': if_none_match})
+        assert status == 304
+        assert headers['ETag'] == etag
+        assert body == b''
+    status, headers, _ = call(app, 'GET', path,
+                              {'Accept': 'application/msgpack',
+                               'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+    status, headers, _ = call(app, 'GET', path + '?pretty=1',
+                              {'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] not in (etag, 'W/' + etag)
+    users[0]['digest'] = 'changed'
+    status, headers, _ = call(app, 'GET', path, {'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+
+
+def test_users_page_etag_and_304(app, users):
+    status, headers, _ = call(app, 'GET', '/get_total_users?limit=2')
+    assert status == 200
+    etag = headers['ETag']
+    status, _, body = call(app, 'GET', '/get_total_users?limit=2',
+                           {'If-None-Match': etag})
+    assert status == 304
+    assert body == b''
+    users.append({'uuid': 'USER-%032X' % 9, 'digest': 'd9'})
+    status, headers, _ = call(app, 'GET', '/get_total_users?limit=2',
+                              {'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+
+
+def test_unacceptable_accept_is_406(app, users):
+    path = '/get_user_by_uuid/' + users[0]['uuid']
+    for accept in ('text/html', 'application/json;q=0'):
+        status, _, body = call(app, 'GET', path, {'Accept': accept})
+        assert status == 406
+        assert json.loads(body)['name'] == 'ERR_TYPE_NOT_SUPPORTED'
+    status, headers, _ = call(app, 'GET', path, {'Accept': 'text/*, */*'})
+    assert status == 200
+    assert headers['Content-Type'] == 'application/json'
+
+
+def failing_cursor(users, fail_after):
+    yield from users[:fail_after]
+    raise TimeoutError('cursor timed out')
+
+
+@pytest.mark.parametrize('fail_after', [None, 0])
+def test_stream_users_fails_before_response(app, monkeypatch, fail_after):
+    users = [{'uuid': 'USER-1'}, {'uuid': 'USER-2'}]
+    cursor = iter(users) if fail_after is None \
+        else failing_cursor(users, fail_after)
+    monkeypatch.setattr(db_adaptor.DBAdapter, 'find_cursor',
+                        lambda self, **kwargs: cursor)
+    status, _, body = call(app, 'GET', '/get_total_users?stream=json')
+    if fail_after is None:
+        assert status == 200
+        assert json.loads(body) == users
+    else:
+        assert status == 500
+        assert json.loads(body)['message'] == 'Error while reading users'
+
+
+def test_raw_reads_send_the_decoded_bytes(app, users, monkeypatch):
+    def raw(users):
+        return b''.join(bson.encode({'_id': ObjectId(), **user})
+                        for user in users)
+    monkeypatch.setitem(config.CACHE, 'ENABLED', False)
+    monkeypatch.setattr(processors, 'get_raw_users_page',
+                        lambda limit, after=None: raw(users[:limit]))
+    monkeypatch.setattr(processors, 'find_raw_user', lambda search_filter:
+                        RawBSONDocument(raw(users[:1])))
+    monkeypatch.setattr(db_adaptor.DBAdapter, 'find_cursor',
+                        lambda self, **kwargs: iter(users))
+    monkeypatch.setattr(db_adaptor.DBAdapter, 'find_raw_batches',
+                        lambda self, **kwargs: iter([raw(users[:2]),
+                                                     raw(users[2:])]))
+    for path in ('/get_total_users?limit=2', '/get_total_users?limit=5',
+                 '/get_total_users?stream=json',
+                 '/get_total_users?stream=ndjson',
+                 '/get_user_by_uuid/' + users[0]['uuid']):
+        monkeypatch.setitem(config.DATABASE, 'RAW_READS', False)
+        decoded = call(app, 'GET', path)
+        monkeypatch.setitem(config.DATABASE, 'RAW_READS', True)
+        transcoded = call(app, 'GET', path)
+        assert transcoded[0] == decoded[0] == 200
+        assert transcoded[1].get('ETag') == decoded[1].get('ETag')
+        assert transcoded[2] == decoded[2]
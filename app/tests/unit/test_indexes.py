@@ -0,0 +1,42 @@
+import pytest
+
+import indexes
+
+
+class FakeAdaptor:
+    def __init__(self, existing, build_fails):
+        self.existing = existing
+        self.build_fails = build_fails
+
+    def index_information(self):
+        return {name: {} for name in self.existing}
+
+    def create_index(self, keys, name, **options):
+        if self.build_fails:
+            raise RuntimeError('E11000 duplicate key error')
+        self.existing.append(name)
+
+
+def use_adaptor(monkeypatch, existing, build_fails=False):
+    fake = FakeAdaptor(existing, build_fails)
+    monkeypatch.setattr(indexes, 'get_db_adaptor', lambda: fake)
+    return fake
+
+
+def test_missing_indexes_are_built(monkeypatch):
+    fake = use_adaptor(monkeypatch, ['_id_'])
+    assert indexes.ensure_indexes() == []
+    assert set(indexes.INDEXES) <= set(fake.existing)
+
+
+def test_missing_email_index_stops_startup_in_any_mode(monkeypatch):
+    use_adaptor(monkeypatch, ['uuid_1', 'digest_1'], build_fails=True)
+    with pytest.raises(RuntimeError, match='email_1'):
+        indexes.ensure_indexes(strict=False)
+
+
+def test_other_required_indexes_only_stop_strict_mode(monkeypatch):
+    use_adaptor(monkeypatch, ['email_1'], build_fails=True)
+    assert indexes.ensure_indexes(strict=False) == ['uuid_1', 'digest_1']
+    with pytest.raises(RuntimeError, match='uuid_1'):
+        indexes.ensure_indexes(strict=True)
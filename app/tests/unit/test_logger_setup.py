@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+
+import logger_setup
+from logger_setup import (
+    LazyJson, LazyQueueHandler, ContextFilter, file_handler, request_id
+)
+
+
+def make_record(msg, *args, exc_info=None):
+    record = logging.LogRecord('root', logging.ERROR, __file__, 1,
+                               msg, args, exc_info)
+    ContextFilter().filter(record)
+    return record
+
+
+def test_lazy_json_dumps_on_format():
+    assert str(LazyJson({'a': 1})) == '{"a": 1}'
+    assert make_record('%s', LazyJson([1])).getMessage() == '[1]'
+
+
+def test_prepare_merges_args_and_renders_traceback():
+    try:
+        raise ValueError('boom')
+    except ValueError as e:
+        record = make_record('failed %s', 'x', exc_info=(type(e), e, None))
+    prepared = LazyQueueHandler(None).prepare(record)
+    assert prepared.msg == 'failed x' and prepared.args is None
+    assert prepared.exc_info is None
+    assert 'ValueError: boom' in prepared.exc_text
+
+
+def test_json_records_carry_ids_and_rotate(tmp_path):
+    token = request_id.set('req-1')
+    try:
+        record = make_record('hello %s', 'world')
+    finally:
+        request_id.reset(token)
+    record.debug_id = 'dbg-1'
+    filename = str(tmp_path / 'log.txt')
+    handler = file_handler(filename, max_bytes=200, backup_count=1)
+    for _ in range(3):
+        handler.handle(record)
+    handler.close()
+    entry = json.loads(open(filename).readline())
+    assert entry['message'] == 'hello world'
+    assert entry['request_id'] == 'req-1'
+    assert entry['debug_id'] == 'dbg-1'
+    assert os.path.exists(filename + '.1')
+
+
+def test_listener_writes_queued_records(tmp_path):
+    filename = str(tmp_path / 'log.txt')
+    logger_setup.start_listener(file_handler(filename, 1 << 20, 1))
+    try:
+        logging.getLogger().warning('queued %d', 1)
+    finally:
+        logger_setup.stop_listener()
+        logger_setup.configure_logging()
+    messages = [json.loads(line)['message'] for line in open(filename)]
+    assert 'queued 1' in messages
+
+
+def test_forked_worker_records_are_written_by_the_parent(tmp_path):
+    filename = str(tmp_path / 'log.txt')
+    logger_setup.start_listener(file_handler(filename, 1 << 20, 1))
+    try:
+        pid = os.fork()
+        if pid == 0:  # Worker: its file handler must stay unused
+            status = 1
+            try:
+                assert isinstance(logger_setup.listener.handlers[0],
+                                  logger_setup.WorkerHandler)
+                logging.getLogger().warning('from worker %d', os.getpid())
+                logging.getLogger().warning('%s', 'x' * 100000)
+                logger_setup.stop_listener()
+                status = 0
+            finally:
+                os._exit(status)
+        assert os.waitpid(pid, 0)[1] == 0
+    finally:
+        logger_setup.stop_listener()
+        logger_setup.worker_records.close()
+        logger_setup.worker_records = None
+        logger_setup.configure_logging()
+    entries = [json.loads(line) for line in open(filename)]
+    assert [entry['message'] for entry in entries][0] == \
+        'from worker %d' % pid
+    assert entries[1]['message'].endswith(' [cut]')
@@ -0,0 +1,103 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from bottle import Bottle, HTTPResponse
+
+import metrics
+from metrics import (
+    ShardedCounters, RequestMetrics, PoolMetricsListener, Exposition,
+    MetricsPlugin, request_samples, pool_samples, cache_samples
+)
+from tests.unit.test_handlers import call
+
+
+def test_sharded_counters_sum_threads():
+    counters = ShardedCounters()
+
+    def work():
+        for _ in range(1000):
+            counters.add('n')
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counters.totals() == {'n': 4000}
+
+
+def test_sharded_counters_fold_ended_threads():
+    counters = ShardedCounters()
+    counters.add('n')
+    for _ in range(20):
+        thread = threading.Thread(target=counters.add, args=('n',))
+        thread.start()
+        thread.join()
+    for _ in range(100):  # Thread locals are cleared as threads end
+        if len(counters._shards) == 1:
+            break
+        time.sleep(0.01)
+    assert len(counters._shards) == 1
+    assert counters.totals() == {'n': 21}
+
+
+def test_request_histogram_is_cumulative():
+    metrics = RequestMetrics([0.01, 0.1])
+    for seconds in (0.005, 0.05, 0.5):
+        metrics.started()
+        metrics.finished('/r', 'GET', 200, seconds)
+    out = Exposition()
+    request_samples(out, metrics)
+    text = out.render().decode()
+    assert 'http_requests_total{route="/r",method="GET",status="200"} 3' \
+        in text
+    assert 'http_requests_in_flight 0' in text
+    assert 'bucket{route="/r",le="0.01"} 1' in text
+    assert 'bucket{route="/r",le="0.1"} 2' in text
+    assert 'bucket{route="/r",le="+Inf"} 3' in text
+    assert 'http_request_duration_seconds_count{route="/r"} 3' in text
+
+
+def test_pool_gauges_from_events():
+    listener = PoolMetricsListener()
+    event = SimpleNamespace(address=('db', 27017))
+    for _ in range(2):
+        listener.connection_created(event)
+        listener.connection_check_out_started(event)
+        listener.connection_checked_out(event)
+    listener.connection_checked_in(event)
+    out = Exposition()
+    pool_samples(out, listener)
+    text = out.render().decode()
+    assert 'mongodb_pool_connections{address="db:27017"} 2' in text
+    assert 'mongodb_pool_connections_in_use{address="db:27017"} 1' in text
+    assert 'mongodb_pool_waiting{address="db:27017"} 0' in text
+
+
+def test_cache_hit_ratio():
+    out = Exposition()
+    cache_samples(out, {'hits': 3, 'misses': 1, 'evictions': 0})
+    assert 'user_cache_hit_ratio 0.75' in out.render().decode()
+
+
+@pytest.mark.parametrize('chunks', [[b'[', b'1', b']'], []])
+def test_streamed_response_is_timed_to_its_end(monkeypatch, chunks):
+    monkeypatch.setitem(metrics.METRICS, 'ENABLED', True)
+    monkeypatch.setattr(metrics, 'request_metrics', RequestMetrics([0.01]))
+    app = Bottle()
+    app.install(MetricsPlugin())
+
+    def stream():
+        for chunk in chunks:
+            time.sleep(0.01)
+            yield chunk
+        time.sleep(0.02)
+    app.route('/stream', 'GET', lambda: HTTPResponse(body=stream()))
+    status, _, body = call(app, 'GET', '/stream')
+    assert status == 200
+    assert body == b''.join(chunks)
+    totals = metrics.request_metrics.counters.totals()
+    assert totals['in_flight'] == 0
+    assert totals[('requests', '/stream', 'GET', 200)] == 1
+    assert totals[('sum', '/stream')] >= 0.02
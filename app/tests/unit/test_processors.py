@@ -0,0 +1,60 @@
+import processors
+from db_adaptor import INSERTED, DUPLICATE, FAILED
+from processors import collect_new_users, summarize_post_users, page_link
+
+FIELDS = ['email', 'firstname']
+
+
+def make_user(email):
+    return {'email': email, 'firstname': 'Jim'}
+
+
+def test_collect_new_users_skips_known_and_repeated_emails():
+    users = [make_user('a@x.com'), make_user('b@x.com'),
+             make_user('a@x.com'), make_user('c@x.com')]
+    results, records = collect_new_users(users, {'b@x.com'}, FIELDS)
+    assert [record['email'] for record in records] == ['a@x.com', 'c@x.com']
+    assert [result['status'] for result in results] == \
+        [DUPLICATE, DUPLICATE, DUPLICATE, DUPLICATE]
+    assert ['uuid' in result for result in results] == \
+        [True, False, False, True]
+    assert results[0]['uuid'] == records[0]['uuid']
+
+
+def test_emails_are_compared_case_sensitively():
+    users = [make_user('A@x.com'), make_user('a@x.com')]
+    results, records = collect_new_users(users, {'B@x.com'}, FIELDS)
+    assert len(records) == 2
+
+
+def test_summary_merges_insert_statuses():
+    users = [make_user('a@x.com'), make_user('b@x.com'),
+             make_user('c@x.com')]
+    results, records = collect_new_users(users, {'b@x.com'}, FIELDS)
+    new, summary = summarize_post_users(results, [INSERTED, FAILED])
+    assert new
+    assert (summary[INSERTED], summary[DUPLICATE], summary[FAILED]) == \
+        (1, 1, 1)
+    assert 'uuid' in summary['results'][0]
+    assert 'uuid' not in summary['results'][2]
+
+
+def test_process_post_users_looks_up_emails_once(monkeypatch):
+    lookups = []
+
+    def find_existing_emails(emails):
+        lookups.append(set(emails))
+        return {'b@x.com'}
+    monkeypatch.setattr(processors, 'find_existing_emails',
+                        find_existing_emails)
+    monkeypatch.setattr(processors, 'insert_users',
+                        lambda records: [INSERTED] * len(records))
+    new, summary = processors.process_post_users(
+        [make_user('a@x.com'), make_user('b@x.com')], FIELDS)
+    assert lookups == [{'a@x.com', 'b@x.com'}]
+    assert new and summary[INSERTED] == 1 and summary[DUPLICATE] == 1
+
+
+def test_page_link_keeps_cursor():
+    link = page_link('http://h/users', 'next', 10, 'USER-1')
+    assert link['href'] == 'http://h/users?limit=10&after=USER-1'
@@ -0,0 +1,55 @@
+import threading
+import xml.dom.minidom
+
+import pytest
+
+import errors
+import profiler
+from profiler import SamplingProfiler, render_collapsed, render_flamegraph
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_samples_busy_thread_and_skips_idle():
+    stop = threading.Event()
+    idle = threading.Event()
+    threads = [threading.Thread(target=spin, args=(stop,)),
+               threading.Thread(target=idle.wait)]
+    for thread in threads:
+        thread.start()
+    sampler = SamplingProfiler(interval=0.01, window=10)
+    try:
+        for _ in range(20):
+            sampler.sample()
+    finally:
+        stop.set()
+        idle.set()
+        for thread in threads:
+            thread.join()
+    counts = sampler.collapsed(10)
+    # spin may be sampled inside stop.is_set()
+    assert any('test_profiler:spin' in stack for stack in counts)
+    assert not any('Event.wait' in stack or stack.endswith(':wait')
+                   for stack in counts)
+    assert sampler.samples == 20
+
+
+def test_renderers():
+    counts = {'a:main;b:work': 3, 'a:main;c:dump<>': 1}
+    assert render_collapsed(counts) == \
+        b'a:main;b:work 3\na:main;c:dump<> 1\n'
+    svg = xml.dom.minidom.parseString(render_flamegraph(counts, 'title'))
+    assert len(svg.getElementsByTagName('rect')) == 3
+
+
+def test_admin_token_is_required(monkeypatch):
+    monkeypatch.setitem(profiler.PROFILER, 'ADMIN_TOKEN', '')
+    with pytest.raises(errors.Forbidden):
+        profiler.check_admin_token('anything')
+    monkeypatch.setitem(profiler.PROFILER, 'ADMIN_TOKEN', 'secret')
+    with pytest.raises(errors.Forbidden):
+        profiler.check_admin_token('wrong')
+    profiler.check_admin_token('secret')
@@ -0,0 +1,76 @@
+import datetime
+import json
+
+from bson import ObjectId, json_util
+
+import errors
+import scripts
+from scripts import dumps_json
+
+
+def legacy_dumps(obj):
+    """json_util output of pymongo 3.x, what the API always sent."""
+    return json_util.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                           json_options=json_util.LEGACY_JSON_OPTIONS
+                           ).encode('utf-8')
+
+
+def test_dumps_json_matches_json_util_for_bson_types():
+    utc_plus_3 = datetime.timezone(datetime.timedelta(hours=3))
+    user = {
+        '_id': ObjectId('5f5e1a3c9d1e8a2b3c4d5e6f'),
+        'email': 'jürgen@x.com',
+        'created': datetime.datetime(2020, 9, 13, 12, 26, 40, 123456),
+        'born': datetime.datetime(1969, 12, 31, 23, 59, 59, 999500),
+        'seen': datetime.datetime(2020, 1, 1, 3, tzinfo=utc_plus_3),
+        'tags': [ObjectId('000000000000000000000001'), None, 1.5],
+    }
+    assert dumps_json(user, pretty=False) == legacy_dumps(user)
+
+
+def test_dumps_json_without_orjson_is_the_same(monkeypatch):
+    user = {'_id': ObjectId('5f5e1a3c9d1e8a2b3c4d5e6f'),
+            'created': datetime.datetime(2001, 2, 3, 4, 5, 6, 7000)}
+    fast = dumps_json(user, pretty=False)
+    monkeypatch.setattr(scripts, 'orjson', None)
+    assert dumps_json(user, pretty=False) == fast
+    assert json.loads(dumps_json(user, pretty=True)) == json.loads(fast)
+
+
+def test_negotiate_content_type():
+    negotiate = scripts.negotiate_content_type
+    assert negotiate(None) == 'application/json'
+    assert negotiate('*/*') == 'application/json'
+    assert negotiate('application/*') == 'application/json'
+    assert negotiate('application/msgpack') == 'application/msgpack'
+    assert negotiate('application/json;q=0.5, application/bson') == \
+        'application/bson'
+    # q=0 excludes a type, even if a wildcard allows the rest
+    assert negotiate('application/json;q=0, */*;q=0.1') == \
+        'application/msgpack'
+    assert negotiate('application/json; q=0') is None
+    assert negotiate('text/html, image/*') is None
+
+
+def test_error_body_is_byte_identical_to_encoding_the_error_object(
+        monkeypatch):
+    class LinkedError(errors.ServerError):
+        information_link_json = 'https://x.com/errors#"linked"'
+
+    messages = ('', 'User "jim@x.com" not found', 'Jürgen\'s 名前 ✓',
+                'tab\tnew line\n\x00\x1f back\\slash </script>')
+    for use_orjson in (True, False):
+        if not use_orjson:
+            monkeypatch.setattr(scripts, 'orjson', None)
+            scripts.error_body_parts.cache_clear()
+        for error_cls in (errors.UserNotFound, errors.InternalServerError,
+                          LinkedError):
+            e = error_cls()
+            assert scripts.error_body(e) == \
+                dumps_json(scripts.error_object(e), pretty=False)
+            for message in messages:
+                e = error_cls()
+                e.message_json = message
+                assert scripts.error_body(e) == \
+                    dumps_json(scripts.error_object(e), pretty=False)
+    scripts.error_body_parts.cache_clear()
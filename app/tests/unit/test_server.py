@@ -0,0 +1,16 @@
+import pytest
+
+import server
+
+
+def test_local_cache_is_refused_with_several_workers(monkeypatch):
+    monkeypatch.setitem(server.CACHE, 'ENABLED', True)
+    monkeypatch.setitem(server.CACHE, 'BACKEND', 'local')
+    server.check_cache_backend(1)
+    with pytest.raises(RuntimeError, match='Local user cache'):
+        server.check_cache_backend(4)
+    monkeypatch.setitem(server.CACHE, 'BACKEND', 'shared')
+    server.check_cache_backend(4)
+    monkeypatch.setitem(server.CACHE, 'BACKEND', 'local')
+    monkeypatch.setitem(server.CACHE, 'ENABLED', False)
+    server.check_cache_backend(4)
@@ -0,0 +1,38 @@
+import asyncio
+
+from timing import timed, start_timings, current_timings, DB, SERIALIZE
+
+
+@timed(SERIALIZE)
+def serialize():
+    return 'body'
+
+
+@timed(DB)
+def read():
+    return serialize()
+
+
+@timed(DB)
+async def read_async():
+    return serialize()
+
+
+def test_phases_are_summed_and_nested_ones_folded():
+    timings = start_timings()
+    try:
+        assert read() == 'body'
+        assert serialize() == 'body'
+        assert asyncio.run(read_async()) == 'body'
+    finally:
+        current_timings.set(None)
+    assert set(timings.phases) == {DB, SERIALIZE}
+    assert timings.active is None
+    header = timings.header(0.5)
+    assert header.startswith('db;dur=') and 'serialize;dur=' in header
+    assert header.endswith('total;dur=500.000')
+
+
+def test_untimed_outside_requests():
+    current_timings.set(None)
+    assert read() == 'body'
@@ -0,0 +1,105 @@
+import datetime
+
+import bson
+import pytest
+from bson import ObjectId
+from bson.errors import InvalidBSON
+
+import transcoder
+from scripts import encode_json_batch
+from transcoder import transcode_batch, transcode_document
+
+
+def make_users(count, **fields):
+    return [dict({'_id': ObjectId(), 'email': 'user%d@a.com' % number,
+                  'company': 'Zoë & Co', 'uuid': 'USER-%d' % number,
+                  'digest': 'digest-%d' % number}, **fields)
+            for number in range(count)]
+
+
+def decoded_json(users, ndjson=False):
+    return encode_json_batch([{name: value for name, value in user.items()
+                               if name != '_id'} for user in users],
+                             True, ndjson)
+
+
+def no_decoding(monkeypatch):
+    def transcode_decoded(*args):
+        raise AssertionError('batch was decoded')
+    monkeypatch.setattr(transcoder, 'transcode_decoded', transcode_decoded)
+
+
+@pytest.mark.parametrize('ndjson', [False, True])
+def test_transcode_batch_without_decoding(monkeypatch, ndjson):
+    no_decoding(monkeypatch)
+    users = make_users(3)
+    raw = b''.join(map(bson.encode, users))
+    body, captured, count = transcode_batch(raw, ndjson=ndjson)
+    assert body == decoded_json(users, ndjson)
+    assert count == 3
+    assert captured == []
+    assert transcode_batch(b'') == (b'', [], 0)
+
+
+def test_transcode_batch_limit_and_capture(monkeypatch):
+    no_decoding(monkeypatch)
+    users = make_users(3)
+    body, captured, count = transcode_batch(
+        b''.join(map(bson.encode, users)), limit=2,
+        capture=('uuid', 'digest'))
+    assert body == decoded_json(users[:2])
+    assert count == 3
+    assert captured == [{'uuid': 'USER-0', 'digest': 'digest-0'},
+                        {'uuid': 'USER-1', 'digest': 'digest-1'}]
+
+
+@pytest.mark.parametrize('fields', [
+    {'company': 'Q"uote\\'},
+    {'company': 'tab\there'},
+    {'created': datetime.datetime(2020, 1, 1)},
+    {'_id': 'string-id'},
+    # A NUL in a value must not let its tail pass for another field
+    {'company': 'x\x00\x02role\x00\x06\x00\x00\x00admin'},
+])
+def test_transcode_batch_falls_back_to_decoding(fields):
+    users = make_users(2, **fields)
+    body, captured, count = transcode_batch(
+        b''.join(map(bson.encode, users)), capture=('uuid',))
+    assert body == decoded_json(users)
+    assert count == 2
+    assert captured == [{'uuid': 'USER-0'}, {'uuid': 'USER-1'}]
+
+
+def test_transcode_batch_decodes_failing_chunks_only(monkeypatch):
+    monkeypatch.setattr(transcoder, 'CHUNK_SIZE', 2)
+    decoded = []
+    transcode_decoded = transcoder.transcode_decoded
+
+    def spy(data, *args):
+        decoded.append(len(bson.decode_all(data)))
+        return transcode_decoded(data, *args)
+    monkeypatch.setattr(transcoder, 'transcode_decoded', spy)
+    users = make_users(5)
+    users[3]['company'] = 'Q"uote'
+    body, captured, count = transcode_batch(
+        b''.join(map(bson.encode, users)), limit=4, capture=('uuid',))
+    assert body == decoded_json(users[:4])
+    assert count == 5
+    assert [fields['uuid'] for fields in captured] == \
+        ['USER-0', 'USER-1', 'USER-2', 'USER-3']
+    assert decoded == [2]
+
+
+def test_transcode_batch_refuses_invalid_utf8():
+    raw = bson.encode(make_users(1)[0]).replace('ë'.encode(), b'\xc3(')
+    with pytest.raises(InvalidBSON):
+        transcode_batch(raw)
+
+
+def test_transcode_document(monkeypatch):
+    no_decoding(monkeypatch)
+    user = make_users(1)[0]
+    del user['_id']
+    body, fields = transcode_document(bson.encode(user), capture=('uuid',))
+    assert body == decoded_json([user])
+    assert fields == {'uuid': 'USER-0'}
@@ -0,0 +1,30 @@
+import pytest
+
+import errors
+import validators
+from scripts import load_definitions_yaml, load_swagger_yaml
+from validators import (
+    compile_spec_validators, get_validator, validate_json_objects
+)
+
+
+def test_definitions_of_both_documents_are_precompiled():
+    swagger_spec = load_swagger_yaml()
+    definitions = load_definitions_yaml()
+    compile_spec_validators(swagger_spec, definitions)
+    for document in (swagger_spec, definitions):
+        for spec in document['definitions'].values():
+            compiled = validators._validators[id(spec)][1]
+            assert get_validator(spec) is compiled
+    # $ref to User resolves within definitions.yaml
+    users_validator = get_validator(definitions['definitions']['Users'])
+    assert users_validator.is_valid([])
+    assert not users_validator.is_valid([{'email': 'a@x.com'}])
+
+
+def test_uncompiled_spec_is_compiled_once():
+    spec = {'type': 'object', 'required': ['email']}
+    validator = get_validator(spec)
+    assert get_validator(spec) is validator
+    with pytest.raises(errors.BadRequestBody):
+        validate_json_objects([{}], spec)
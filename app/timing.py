@@ -0,0 +1,131 @@
+"""
+This module times phases of a request: validation, body parsing, DB and
+serialization. Functions of a phase are decorated with timed(phase),
+the durations are summed into Timings of current request, which are
+sent in Server-Timing header and written to the slow-request log.
+"""
+import asyncio
+import contextvars
+import functools
+import time
+from typing import Any, Callable, Dict, Optional
+
+from bottle import HTTPResponse, request, response
+
+from config import TIMING
+from logger_setup import logger
+
+VALIDATE = 'validate'
+PARSE = 'parse'
+DB = 'db'
+SERIALIZE = 'serialize'
+
+# Timings of the request being served, None if it is not timed
+current_timings: contextvars.ContextVar = contextvars.ContextVar(
+    'current_timings', default=None
+)
+
+
+class Timings:
+    """Durations of the phases of one request, in seconds."""
+    __slots__ = ('start', 'phases', 'active')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        # Phase being timed, phases nested in it are counted to it
+        self.active: Optional[str] = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self, total: float) -> str:
+        """Server-Timing header value, durations in milliseconds."""
+        metrics = ['%s;dur=%.3f' % (phase, seconds * 1000)
+                   for phase, seconds in self.phases.items()]
+        metrics.append('total;dur=%.3f' % (total * 1000))
+        return ', '.join(metrics)
+
+    def __str__(self) -> str:
+        return ' '.join('%s=%.2fms' % (phase, seconds * 1000)
+                        for phase, seconds in self.phases.items())
+
+
+def timing_enabled() -> bool:
+    return bool(TIMING['SERVER_TIMING'] or TIMING['SLOW_REQUEST_MS'] > 0)
+
+
+def start_timings() -> Timings:
+    timings = Timings()
+    current_timings.set(timings)
+    return timings
+
+
+def timed(phase: str) -> Callable:
+    """Counts the time of the decorated function (or coroutine) to phase."""
+    def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                timings = current_timings.get()
+                if timings is None or timings.active is not None:
+                    return await func(*args, **kwargs)
+                timings.active = phase
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    timings.add(phase, time.perf_counter() - start)
+                    timings.active = None
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = current_timings.get()
+            if timings is None or timings.active is not None:
+                return func(*args, **kwargs)
+            timings.active = phase
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add(phase, time.perf_counter() - start)
+                timings.active = None
+        return wrapper
+    return decorator
+
+
+def finish_timings(timings: Timings, headers: Any, method: str, path: str,
+                   status: int):
+    """
+    Puts Server-Timing header to headers, if enabled, and logs
+    the request if it took SLOW_REQUEST_MS or more.
+    """
+    total = timings.elapsed()
+    if TIMING['SERVER_TIMING']:
+        headers['Server-Timing'] = timings.header(total)
+    if 0 < TIMING['SLOW_REQUEST_MS'] <= total * 1000:
+        logger.warning('Slow request %s %s %s: %.1fms %s', method, path,
+                       status, total * 1000, timings)
+
+
+class TimingPlugin:
+    """Bottle plugin timing the phases of all routes."""
+    name = 'timing'
+    api = 2
+
+    def apply(self, callback, route):
+        if not timing_enabled():
+            return callback
+
+        def wrapper(*args, **kwargs):
+            timings = start_timings()
+            out = callback(*args, **kwargs)
+            resp = out if isinstance(out, HTTPResponse) else response
+            finish_timings(timings, resp.headers, request.method,
+                           request.path, resp.status_code)
+            return out
+        return wrapper
@@ -0,0 +1,148 @@
+"""
+This module transcodes raw BSON batches, as the driver got them off the
+wire, to compact json byte-equal to what scripts.dumps_json makes of the
+decoded users. No dict is built: a batch is cut at its string elements
+by one regular expression split, the cuts are checked against the
+lengths BSON stores, then json punctuation takes the place of the BSON
+framing and the pieces are joined. The ObjectId _id, that MongoDB puts
+first in stored documents, is dropped on the way. Batches are split
+CHUNK_SIZE documents at a time, a chunk holding anything else than plain
+strings (other types, quotes, backslashes, control characters) is
+decoded and encoded instead.
+"""
+import re
+import struct
+from itertools import repeat
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import bson
+from bson.errors import InvalidBSON
+
+from scripts import dumps_json
+from timing import timed, SERIALIZE
+
+# Top-level fields dropped while transcoding
+EXCLUDED_FIELDS = ('_id',)
+# String element, preceded by the start of its document if it is the
+# first one: end of the previous document (or a NUL put before the
+# batch), int32 size and ObjectId _id, if any. Then type, name, int32
+# size of value and its NUL, value and its NUL (the closing quote).
+STRING_ELEMENT = re.compile(rb'(\x00....(?:\x07_id\x00.{12})?)?'
+                            rb'\x02([^\x00]*)\x00(....)([^\x00]*\x00)', re.S)
+# Bytes of names and values json has as is between quotes (UTF-8 too)
+PLAIN_BYTES = bytes(range(0x20, 0x100)).translate(None, b'"\\')
+INT32 = struct.Struct('<i')
+# Documents split at once: the pieces of a split weigh about 15 times
+# as much as the documents
+CHUNK_SIZE = 32
+
+
+def document_ends(data: bytes) -> List[int]:
+    """Returns offsets of the ends of concatenated raw BSON documents."""
+    ends = []
+    offset = 0
+    while offset < len(data):
+        size = INT32.unpack_from(data, offset)[0]
+        if size < 5:
+            raise InvalidBSON('invalid document size')
+        offset += size
+        ends.append(offset)
+    return ends
+
+
+def transcode_strings(data: bytes, ndjson: bool, capture: Iterable[str]) \
+        -> Optional[Tuple[bytes, List[Dict[str, Any]]]]:
+    """
+    Transcodes concatenated raw BSON documents of string fields only,
+    past their ObjectId _id. Returns None if data holds anything else.
+    """
+    parts = STRING_ELEMENT.split(b'\x00' + data)
+    gaps, starts, names, values = \
+        parts[0::5], parts[1::5], parts[2::5], parts[4::5]
+    # Elements must follow each other up to the end of the last document,
+    # with the size BSON stores for every value. A value holding a NUL,
+    # cut short by the split, fails the size check.
+    if gaps[-1] != b'\x00' or any(gaps[:-1]) \
+            or b''.join(parts[3::5]) != struct.pack(
+                '<%di' % len(values), *map(len, values)) \
+            or b'_id' in names \
+            or b''.join(names).translate(None, PLAIN_BYTES) \
+            or b''.join(values).translate(None, PLAIN_BYTES + b'\x00'):
+        return None
+    captured: List[Dict[str, Any]] = []
+    if capture:
+        wanted = {name.encode() for name in capture}
+        fields: Dict[str, Any] = {}
+        for start, name, value in zip(starts, names, values):
+            if start is not None:
+                fields = {}
+                captured.append(fields)
+            if name in wanted:
+                fields[name.decode()] = value[:-1].decode()
+    # Starts of documents after the first one end the previous document
+    separators: Dict[Optional[bytes], bytes] = {None: b',"'}
+    between = b'}\n{"' if ndjson else b'},{"'
+    parts[1::5] = [b'{"', *map(separators.get, starts[1:], repeat(between))]
+    parts[-1] = b'}\n' if ndjson else b'}'
+    parts[3::5] = repeat(b'":"', len(values))
+    body = b''.join(parts).replace(b'\x00', b'"')
+    if not body.isascii():
+        try:  # As the decoder would, refuse what is not UTF-8
+            body.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    return body, captured
+
+
+def transcode_decoded(data: bytes, ndjson: bool, capture: Iterable[str]) \
+        -> Tuple[bytes, List[Dict[str, Any]]]:
+    """Transcodes concatenated raw BSON documents by decoding them."""
+    documents = bson.decode_all(data)
+    for document in documents:
+        for name in EXCLUDED_FIELDS:
+            document.pop(name, None)
+    captured = [{name: document[name] for name in capture
+                 if name in document}
+                for document in documents] if capture else []
+    if ndjson:
+        body = b''.join(dumps_json(document, pretty=False) + b'\n'
+                        for document in documents)
+    else:
+        body = dumps_json(documents, pretty=False)[1:-1]
+    return body, captured
+
+
+@timed(SERIALIZE)
+def transcode_batch(data: bytes, limit: Optional[int] = None,
+                    ndjson: bool = False,
+                    capture: Iterable[str] = ()) \
+        -> Tuple[bytes, List[Dict[str, Any]], int]:
+    """
+    Transcodes concatenated raw BSON documents, up to limit of them,
+    to json array items joined by commas, or to NDJSON lines.
+    Returns the json, the captured fields of every transcoded document
+    and the count of all documents of the batch.
+    """
+    ends = document_ends(data)
+    count = len(ends)
+    if limit is not None:
+        del ends[limit:]
+    bodies: List[bytes] = []
+    captured: List[Dict[str, Any]] = []
+    start = 0
+    for end in ends[CHUNK_SIZE - 1::CHUNK_SIZE] + ends[-1:]:
+        if end > start:
+            chunk = data[start:end]
+            body, fields = transcode_strings(chunk, ndjson, capture) \
+                or transcode_decoded(chunk, ndjson, capture)
+            bodies.append(body)
+            captured.extend(fields)
+            start = end
+    return (b'' if ndjson else b',').join(bodies), captured, count
+
+
+def transcode_document(raw: bytes, capture: Iterable[str] = ()) \
+        -> Tuple[bytes, Dict[str, Any]]:
+    """Transcodes one raw BSON document, returns json and captured fields."""
+    body, captured, _ = transcode_batch(raw, capture=capture)
+    return body, captured[0] if captured else {}
@@ -2,60 +2,156 @@
 This is a collection of different validators (request query, body, methods).
 """
 import re
-from jsonschema import validate, ValidationError
-from typing import Dict, Union, Any, List
+from jsonschema import RefResolver
+from jsonschema.validators import validator_for
+from typing import Dict, Union, Any, List, Optional, Tuple
 
 import errors
 from config import (
-    SUPPORTED_CONTENT_TYPE,
-    UUID_MATCH_PATTERN
+    UUID_MATCH_PATTERN,
+    PAGINATION
 )
-from scripts import log_exception
-
-
+from scripts import (
+    log_exception, negotiate_content_type, body_content_types
+)
+from timing import timed, VALIDATE
+
+EMAIL_REGEX = re.compile(r'^\w+([\.-]?\w+)*@\w+([\.-]?\w+)*(\.\w{2,3})+$')
+UUID_REGEX = re.compile(UUID_MATCH_PATTERN)
+# Most errors reported for one request body
+MAX_BODY_ERRORS = 100
+
+# id(spec) -> (spec, validator). Holding spec keeps its id from reuse.
+_validators: Dict[int, Tuple[Dict[str, Any], Any]] = {}
+
+
+def compile_spec_validators(*documents: Dict[str, Any]):
+    """
+    Builds validators of all definitions of the documents (swagger.yaml,
+    definitions.yaml) once, at startup. $refs of definitions are
+    resolved against the whole document they are in.
+    """
+    for document in documents:
+        resolver = RefResolver('', document)
+        for spec in document.get('definitions', {}).values():
+            validator_cls = validator_for(spec)
+            validator_cls.check_schema(spec)
+            _validators[id(spec)] = (spec,
+                                     validator_cls(spec, resolver=resolver))
+
+
+def get_validator(spec: Dict[str, Any]) -> Any:
+    """Returns compiled validator of spec, compiles it on first use."""
+    compiled = _validators.get(id(spec))
+    if compiled is None:
+        validator_cls = validator_for(spec)
+        validator_cls.check_schema(spec)
+        compiled = _validators[id(spec)] = (spec, validator_cls(spec))
+    return compiled[1]
+
+
+@timed(VALIDATE)
 def validate_user_email(email: str):
-    regex = '^\w+([\.-]?\w+)*@\w+([\.-]?\w+)*(\.\w{2,3})+$'
-    if not bool(re.search(regex, email)):
-        raise ValueError()
+    if not EMAIL_REGEX.search(email):
+        raise errors.BadRequestQuery()
 
 
-def validate_accept_header(accept_header, supported_content_type):
-    if supported_content_type not in accept_header.lower():
+@timed(VALIDATE)
+def validate_accept_header(accept_header):
+    if negotiate_content_type(accept_header) is None:
         raise errors.AcceptTypeError()
 
 
+@timed(VALIDATE)
 def validate_request_method(method, supported_methods):
     if method not in supported_methods:
         raise errors.WrongMethod()
 
 
+@timed(VALIDATE)
 def validate_request_headers(headers):
     accept_header = headers.get('Accept')
     if accept_header:
-        validate_accept_header(accept_header, SUPPORTED_CONTENT_TYPE)
+        validate_accept_header(accept_header)
 
     content_type_header = headers.get('Content-Type')
     if content_type_header:
         validate_content_type_header(content_type_header,
-                                     SUPPORTED_CONTENT_TYPE)
+                                     body_content_types())
 
 
+@timed(VALIDATE)
 def validate_user_uuid(user_uuid: str):
-    valid_user_uuid = bool(re.match(UUID_MATCH_PATTERN, user_uuid))
+    valid_user_uuid = bool(UUID_REGEX.match(user_uuid))
     if not valid_user_uuid:
         raise errors.BadRequestQuery()
 
 
+@timed(VALIDATE)
+def validate_page_query(limit: Optional[str], after: Optional[str]) \
+        -> Tuple[int, Optional[str]]:
+    """Returns page size and the uuid to start after."""
+    if limit is None or limit == '':
+        page_size = PAGINATION['DEFAULT_LIMIT']
+    elif limit.isdigit() and 0 < int(limit) <= PAGINATION['MAX_LIMIT']:
+        page_size = int(limit)
+    else:
+        raise errors.BadRequestQuery()
+    if after:
+        validate_user_uuid(after)
+    return page_size, after or None
+
+
+@timed(VALIDATE)
+def validate_stream_query(stream: str) -> bool:
+    """Returns True if NDJSON stream is requested, False for JSON array."""
+    if stream not in ('json', 'ndjson'):
+        raise errors.BadRequestQuery()
+    return stream == 'ndjson'
+
+
+@timed(VALIDATE)
 def validate_content_type_header(content_type_header,
-                                 supported_content_type):
-    if supported_content_type not in content_type_header.lower():
+                                 supported_content_types):
+    content_type = content_type_header.split(';')[0].strip().lower()
+    if content_type not in supported_content_types:
         raise errors.ContentTypeError()
 
 
+@timed(VALIDATE)
 def validate_json_object(obj: Dict[Union[str, int], Any],
-                         spec: List[str]) -> validate:
-    try:
-        validate(obj, spec)
-    except ValidationError as e:
+                         spec: Dict[str, Any]):
+    errors_found = [error.message
+                    for error in get_validator(spec).iter_errors(obj)]
+    if errors_found:
+        e = errors.BadRequestBody()
+        e.message_json = 'Wrong body scheme: ' + '; '.join(errors_found)
+        log_exception(e)
+        raise e
+
+
+@timed(VALIDATE)
+def validate_json_objects(objs: List[Dict[Union[str, int], Any]],
+                          spec: Dict[str, Any]):
+    """
+    Validates a batch of objects in one pass, collecting every error
+    (up to MAX_BODY_ERRORS) together with the index of its object.
+    """
+    if not isinstance(objs, list):
+        e = errors.BadRequestBody()
+        e.message_json = 'Wrong body scheme: a list of users is expected.'
+        raise e
+    validator = get_validator(spec)
+    errors_found: List[str] = []
+    for index, obj in enumerate(objs):
+        for error in validator.iter_errors(obj):
+            errors_found.append(f'[{index}] {error.message}')
+            if len(errors_found) >= MAX_BODY_ERRORS:
+                break
+        if len(errors_found) >= MAX_BODY_ERRORS:
+            break
+    if errors_found:
+        e = errors.BadRequestBody()
+        e.message_json = 'Wrong body scheme: ' + '; '.join(errors_found)
         log_exception(e)
-        raise errors.BadRequestBody()
+        raise e
@@ -0,0 +1,91 @@
+"""
+Compares WSGI and asyncio serving modes at high concurrency.
+
+Start the API twice against the same MongoDB, e.g.
+
+    SERVER_SETTINGS_MODE=wsgi SERVER_SETTINGS_SERVER_PORT=8080 python main.py
+    SERVER_SETTINGS_MODE=asyncio SERVER_SETTINGS_SERVER_PORT=8081 \
+        python main.py
+
+then run
+
+    python bench_modes.py --wsgi http://127.0.0.1:8080 \
+        --asyncio http://127.0.0.1:8081 --concurrency 500
+
+A user is created first and then read by uuid by all clients.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import aiohttp
+
+WEB_BASE = '/api/v1'
+
+
+async def create_user(session, base_url):
+    user = {
+        'firstname': 'Bench',
+        'lastname': 'Mark',
+        'company': 'Bench',
+        'email': 'bench.%s@example.com' % uuid.uuid4().hex,
+        'status': 'confirmed',
+    }
+    async with session.post(base_url + WEB_BASE + '/post_user',
+                            json=user) as response:
+        return json.loads(await response.text())['uuid']
+
+
+async def worker(session, url, requests, latencies, errors):
+    while requests:
+        requests.pop()
+        started = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+        except aiohttp.ClientError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - started)
+
+
+async def bench(base_url, total, concurrency):
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        user_uuid = await create_user(session, base_url)
+        url = base_url + WEB_BASE + '/get_user_by_uuid/' + user_uuid
+        requests = list(range(total))
+        latencies, errors = [], []
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            worker(session, url, requests, latencies, errors)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests/s': round(total / elapsed, 1),
+        'p50 ms': round(statistics.median(latencies) * 1000, 2),
+        'p99 ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--wsgi', default='http://127.0.0.1:8080')
+    parser.add_argument('--asyncio', default='http://127.0.0.1:8081')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    args = parser.parse_args()
+    for mode, base_url in (('wsgi', args.wsgi), ('asyncio', args.asyncio)):
+        result = asyncio.run(bench(base_url, args.requests, args.concurrency))
+        print(mode, result)
+
+
+if __name__ == '__main__':
+    main()